@@ -0,0 +1,444 @@
+"""
+Synthetic-load benchmarks for the bot's hot paths.
+
+Builds a trades database per size, then times the sync pipeline (against
+an in-memory order source, or mock_bybit.py with --sync-mock), the ledger, the profit and report functions
+and the PDF export. Results go to a JSON file that can be diffed across
+commits:
+
+    python benchmark.py --sizes 10000,100000,1000000 --out bench.json
+    python benchmark.py --sizes 10000 --compare bench.json
+
+Nothing here talks to Bybit or Telegram.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+
+import profitcal as bot
+
+
+# ========================= SYNTHETIC DATA =========================
+MEAN_GAP_MS = 150_000          # average time between trades
+CHECKPOINT_SLICES = 8          # ledger refresh + inventory checkpoint after each slice
+INSERT_CHUNK = 50_000
+CLOSED_DAYS = 40               # daily_balances rows with a closing balance
+
+
+def synthetic_trades(n, seed=1, end_ms=None):
+    """
+    n trades ending around `end_ms`. Buys are a bit more frequent than
+    sells, and sell sizes are drawn independently of lot sizes. Most
+    sells therefore split a lot or span several (partial fills). Prices
+    follow a slow random walk, with sells quoted above buys.
+    """
+    r = random.Random(seed)
+    end_ms = end_ms or int(time.time() * 1000)
+    gaps = [int(r.expovariate(1 / MEAN_GAP_MS)) + 1 for _ in range(n)]
+    t = end_ms - sum(gaps)   # newest trade lands exactly on end_ms, never in the future
+    mid = 1500.0
+
+    for i, gap in enumerate(gaps):
+        t += gap
+        mid = max(500.0, mid + r.gauss(0, 0.5))
+
+        side = 0 if r.random() < 0.52 else 1
+        qty = round(r.lognormvariate(4, 0.9), 4)      # median ~55 USDT, long tail
+        spread = r.uniform(0, 8)
+        price = round(mid - spread if side == 0 else mid + spread, 2)
+        fee = qty * bot.BUY_FEE_RATE if side == 0 and r.random() < 0.8 else 0.0
+
+        yield (
+            f"bench_{i}", side, "USDT", qty, round(qty * price, 2), price, fee,
+            "bench", bot.SYNC_STATUS, t - 60_000, t,
+        )
+
+
+def synthetic_orders(n, seed=2, end_ms=None):
+    """simplifyList-shaped orders, as parse_order expects them."""
+    for row in synthetic_trades(n, seed, end_ms):
+        order_id, side, token, qty, fiat, price, _, _, status, created, completed = row
+        yield {
+            "id": f"sync_{order_id}",
+            "side": side,
+            "tokenId": token,
+            "currencyId": bot.SYNC_FIAT,
+            "status": status,
+            "amount": str(fiat),
+            "price": str(price),
+            "notifyTokenQuantity": str(qty),
+            "targetNickName": "bench",
+            "createDate": str(created),
+            "updateDate": str(completed),
+        }
+
+
+class FakeOrderSource:
+    """Stands in for BybitClient.iter_order_pages, serving pages from memory."""
+
+    def __init__(self, orders, page_size=30, latency=0.0):
+        self.orders = orders
+        self.page_size = page_size
+        self.latency = latency
+
+    async def iter_order_pages(self, begin_ms, end_ms, status=50, size=30):
+        for i in range(0, len(self.orders), self.page_size):
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            yield self.orders[i:i + self.page_size]
+
+
+_mock = None
+
+
+def order_source(args, now_ms):
+    """
+    The in-memory source, or with --sync-mock the real BybitClient talking
+    to mock_bybit.py over HTTP, so signing, retries and the
+    rate limiter are timed too.
+    """
+    global _mock
+    if not args.sync_mock:
+        orders = list(synthetic_orders(args.sync_orders, args.seed + 1, now_ms))
+        return FakeOrderSource(orders, latency=args.sync_latency_ms / 1000)
+
+    import mock_bybit
+
+    if _mock is None:
+        bot.API_KEY = bot.API_KEY or "bench-key"
+        bot.API_SECRET = bot.API_SECRET or "bench-secret"
+        _mock = mock_bybit.MockBybit(
+            orders=args.sync_orders, seed=args.seed + 1, end_ms=now_ms,
+            api_key=bot.API_KEY, api_secret=bot.API_SECRET,
+            latency_ms=args.sync_latency_ms,
+            throttle_rate=args.mock_throttle_rate,
+            duplicate_rate=args.mock_duplicate_rate,
+        )
+        _mock.client = bot.BybitClient(base_url=_mock.start())
+    return _mock.client
+
+
+def use_database(path):
+    """Point the bot's shared connections at `path`."""
+    bot.db.close()
+    bot.db = bot.Database(path)
+    bot.report_cache = bot.ReportCache()
+    bot.init_db()
+
+
+def build_database(path, n, seed):
+    """Fill a fresh database with n trades, the ledger, checkpoints, rollup and closed days."""
+    use_database(path)
+    rows = synthetic_trades(n, seed)
+    per_slice = max(1, -(-n // CHECKPOINT_SLICES))
+    inserted = 0
+
+    while inserted < n:
+        target = min(n, inserted + per_slice)
+        while inserted < target:
+            chunk = [next(rows) for _ in range(min(INSERT_CHUNK, target - inserted))]
+            with bot.db.writer() as conn:
+                conn.executemany("""
+                    INSERT INTO trades (
+                        id, side, token, amount, fiat_amount, price, fee,
+                        counterparty, status, created_at, completed_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, chunk)
+            inserted += len(chunk)
+
+        bot.refresh_ledger()
+        bot.take_inventory_checkpoint()
+
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    with bot.db.writer() as conn:
+        conn.executemany("""
+            INSERT OR REPLACE INTO daily_balances (date, opening_balance, closing_balance)
+            VALUES (?, ?, ?)
+        """, [
+            ((today - timedelta(days=d)).strftime("%Y-%m-%d"), 1_000_000.0, 1_000_000.0)
+            for d in range(1, CLOSED_DAYS + 1)
+        ])
+        conn.execute("INSERT INTO trading_day (started_at) VALUES (?)", (int(today.timestamp() * 1000),))
+
+
+# ========================= TIMING =========================
+def percentile(sorted_values, pct):
+    # Nearest rank; fine for the handful of samples a run takes
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[k]
+
+
+def measure(fn, repeat=5, rows=None, trace=True, setup=None):
+    """
+    Run fn `repeat` times for latencies, then once more under tracemalloc
+    for peak Python heap (tracing slows code down, so it isn't timed).
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+
+    peak = None
+    if trace:
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            fn()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    times.sort()
+    p50 = percentile(times, 50)
+    return {
+        "runs": len(times),
+        "mean_ms": round(sum(times) / len(times) * 1000, 3),
+        "p50_ms": round(p50 * 1000, 3),
+        "p90_ms": round(percentile(times, 90) * 1000, 3),
+        "p99_ms": round(percentile(times, 99) * 1000, 3),
+        "max_ms": round(times[-1] * 1000, 3),
+        "rows": rows,
+        "rows_per_sec": round(rows / p50, 1) if rows and p50 else None,
+        "peak_mb": round(peak / 1024 / 1024, 2) if peak is not None else None,
+    }
+
+
+class _Message:
+    async def reply_text(self, text, **kwargs):
+        return None
+
+
+class _Bot:
+    async def send_message(self, chat_id, text, **kwargs):
+        return None
+
+
+class _Update:
+    message = _Message()
+
+
+class _Context:
+    def __init__(self, args=()):
+        self.args = list(args)
+        self.bot = _Bot()
+
+
+# ========================= BENCHMARKS =========================
+def run_size(n, args, workdir, loop):
+    path = os.path.join(workdir, f"bench_{n}.db")
+    if os.path.exists(path) and args.reuse:
+        use_database(path)
+        setup_s = None
+    else:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        t = time.perf_counter()
+        build_database(path, n, args.seed)
+        setup_s = round(time.perf_counter() - t, 3)
+
+    results = {"setup_s": setup_s}
+    repeat, heavy = args.repeat, args.heavy_repeat
+
+    def wanted(name):
+        return not args.only or name in args.only
+
+    def run(name, fn, **kw):
+        if not wanted(name):
+            return
+        log(f"  {name} …")
+        results[name] = measure(fn, **kw)
+        log(f"    p50 {results[name]['p50_ms']} ms, peak {results[name]['peak_mb']} MB")
+
+    def cold_cache():
+        bot.report_cache = bot.ReportCache()
+
+    now_ms = int(time.time() * 1000)
+    day_ms = 24 * 60 * 60 * 1000
+    periods = bot.standard_periods()
+
+    # Ledger and profit
+    run("ledger_rebuild_full", lambda: bot.rebuild_ledger_with_writer(full=True), repeat=heavy, rows=n)
+    run("ledger_rebuild_checkpoint", lambda: bot.rebuild_ledger_with_writer(full=False), repeat=heavy)
+    run("spread_profit_all", lambda: bot.calculate_simple_spread_profit(0, now_ms), repeat=repeat)
+    run("spread_profit_30d", lambda: bot.calculate_simple_spread_profit(now_ms - 30 * day_ms, now_ms), repeat=repeat)
+
+    def totals(start_ms, vectorized):
+        saved = bot.FIFO_VECTORIZED
+        bot.FIFO_VECTORIZED = vectorized and bot.HAVE_NUMPY
+        try:
+            with bot.db.reader() as conn:
+                return bot.window_totals(conn, start_ms, now_ms)
+        finally:
+            bot.FIFO_VECTORIZED = saved
+
+    run("fifo_replay_all_loop", lambda: totals(0, False), repeat=heavy, rows=n)
+    if bot.HAVE_NUMPY:
+        run("fifo_replay_all_numpy", lambda: totals(0, True), repeat=heavy, rows=n)
+
+    # Reports: engine directly, then the handlers as a user triggers them
+    run("report_engine_standard", lambda: bot.compute_period_reports(periods), repeat=repeat)
+    run("report_cache_hit", lambda: bot.cached_period_reports(periods), repeat=repeat,
+        setup=lambda: bot.cached_period_reports(periods))
+    run("rollup_closed_month", lambda: bot.rollup_closed_days((datetime.now() - timedelta(days=31)).strftime("%Y-%m-%d")),
+        repeat=repeat)
+
+    handlers = {
+        "handler_daily": lambda: bot.send_daily_report(_Context()),
+        "handler_weekly": lambda: bot.send_weekly_report(_Context()),
+        "handler_monthly": lambda: bot.send_monthly_report(_Context()),
+        "handler_yesterday": lambda: bot.yesterday(_Update(), _Context()),
+        "handler_summarydays_30": lambda: bot.summary_days(_Update(), _Context(["30"])),
+        "handler_summarydays_365": lambda: bot.summary_days(_Update(), _Context(["365"])),
+    }
+    for name, coro in handlers.items():
+        run(name, lambda coro=coro: loop.run_until_complete(coro()), repeat=repeat, setup=cold_cache)
+
+    # PDF export
+    pdf_path = os.path.join(workdir, "bench.pdf")
+    pdf_start = now_ms - args.pdf_days * day_ms
+    run("pdf_summary_all", lambda: bot.export_trades_to_pdf(pdf_path, summary_only=True), repeat=heavy)
+    run(f"pdf_detail_{args.pdf_days}d", lambda: bot.export_trades_to_pdf(pdf_path, pdf_start, now_ms), repeat=heavy)
+    if n <= args.pdf_full_max:
+        run("pdf_detail_all", lambda: bot.export_trades_to_pdf(pdf_path), repeat=heavy, rows=n)
+
+    # Sync pipeline into its own fresh database each run
+    if wanted("sync_insert") or wanted("sync_duplicates"):
+        source = order_source(args, now_ms)
+        sync_path = os.path.join(workdir, "bench_sync.db")
+
+        def fresh_sync_db():
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(sync_path + suffix):
+                    os.remove(sync_path + suffix)
+            use_database(sync_path)
+
+        def sync():
+            stats = loop.run_until_complete(bot.sync_completed_orders(source))
+            if stats["partial"]:
+                raise RuntimeError(stats["error"])
+
+        run("sync_insert", sync, repeat=heavy, rows=args.sync_orders, setup=fresh_sync_db)
+        # Same orders again: dedup path only, nothing inserted
+        run("sync_duplicates", sync, repeat=repeat, rows=args.sync_orders)
+
+        use_database(path)
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+
+    print(f"\n{'size':>10} {'benchmark':<28} {'base p50':>12} {'new p50':>12} {'ratio':>7}")
+    for size, benches in current["results"].items():
+        old = baseline.get("results", {}).get(size, {})
+        for name, r in benches.items():
+            if not isinstance(r, dict) or name not in old:
+                continue
+            before, after = old[name]["p50_ms"], r["p50_ms"]
+            ratio = after / before if before else float("inf")
+            print(f"{size:>10} {name:<28} {before:>12.2f} {after:>12.2f} {ratio:>6.2f}x")
+
+
+def log(msg):
+    print(msg, file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark sync, FIFO, reports and PDF export on synthetic data.")
+    parser.add_argument("--sizes", default="10000,100000", help="comma-separated trade counts (e.g. 10000,1000000,10000000)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs for fast benchmarks")
+    parser.add_argument("--heavy-repeat", type=int, default=1, help="timed runs for rebuilds, replays, PDFs and sync")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--dir", help="keep generated databases here (default: a temp dir)")
+    parser.add_argument("--reuse", action="store_true", help="reuse databases already in --dir")
+    parser.add_argument("--only", type=lambda s: set(s.split(",")), help="comma-separated benchmark names")
+    parser.add_argument("--sync-orders", type=int, default=5000, help="orders served by the fake order source")
+    parser.add_argument("--sync-latency-ms", type=float, default=0.0, help="simulated latency per page")
+    parser.add_argument("--sync-mock", action="store_true", help="sync through BybitClient against mock_bybit.py instead of in memory")
+    parser.add_argument("--mock-throttle-rate", type=float, default=0.0, help="with --sync-mock: chance of retCode 10006 per request")
+    parser.add_argument("--mock-duplicate-rate", type=float, default=0.0, help="with --sync-mock: chance a page repeats earlier items")
+    parser.add_argument("--pdf-days", type=int, default=7, help="range for the detailed PDF benchmark")
+    parser.add_argument("--pdf-full-max", type=int, default=20000, help="largest size that also gets a full-history detailed PDF")
+    parser.add_argument("--compare", help="baseline JSON to print p50 ratios against")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    workdir = args.dir or tempfile.mkdtemp(prefix="mullabot-bench-")
+    os.makedirs(workdir, exist_ok=True)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": bot.sqlite3.sqlite_version,
+            "numpy": bot.HAVE_NUMPY,
+            "platform": platform.platform(),
+            "args": {k: (sorted(v) if isinstance(v, set) else v) for k, v in vars(args).items()},
+        },
+        "results": {},
+    }
+
+    loop = asyncio.new_event_loop()
+    try:
+        for n in sizes:
+            log(f"size {n:,}")
+            report["results"][str(n)] = run_size(n, args, workdir, loop)
+    finally:
+        loop.run_until_complete(bot.bybit.close())
+        if _mock is not None:
+            report["meta"]["mock_stats"] = _mock.stats()
+            loop.run_until_complete(_mock.client.close())
+            _mock.stop()
+        loop.close()
+        bot.db_pool.shutdown()
+        bot.cpu_pool.shutdown()
+        bot.db.close()
+
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report["meta"]["max_rss_mb"] = round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    log(f"wrote {args.out}")
+
+    if args.compare:
+        compare(report, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,251 @@
+"""
+FIFO matching of USDT buys against sells.
+
+One implementation shared by the profit reports and the PDF export.
+Rows are (side, usdt_amount, price_ngn, fee_usdt, completed_at_ms) with
+side 0 = BUY, 1 = SELL, in completion order.
+
+Matching rules (unchanged from the original report loops):
+- a SELL consumes the oldest open BUY lots first
+- fee share = lot fee × matched / lot quantity remaining at match time
+- net profit = matched × (sell - buy price) - fee share in NGN
+- a SELL with no open lots (or the part exceeding them) is ignored
+- a BUY with no quantity opens no lot
+
+match_arrays is a vectorized equivalent for long replays; it needs numpy,
+which is optional.
+"""
+
+import itertools
+from collections import deque
+
+try:
+    import numpy as np
+except ImportError:  # only the vectorized engine needs it
+    np = None
+
+HAVE_NUMPY = np is not None
+
+QTY_SCALE = 10 ** 8   # vectorized sums run on integer 1e-8 USDT units, so they stay exact
+ARRAY_CHUNK = 20000   # trades per match_arrays call in iter_array_matches
+
+
+class Lot:
+    __slots__ = ("qty", "price", "fee", "time", "trade_id")
+
+    def __init__(self, qty, price, fee, time, trade_id=None):
+        self.qty = qty
+        self.price = price
+        self.fee = fee
+        self.time = time
+        self.trade_id = trade_id
+
+    def __repr__(self):
+        return f"Lot(qty={self.qty}, price={self.price}, fee={self.fee}, time={self.time})"
+
+
+class MatchedLot:
+    __slots__ = (
+        "buy_time", "sell_time", "qty", "buy_price", "sell_price", "fee_ngn", "net_profit",
+        "buy_id", "sell_id",
+    )
+
+    def __init__(self, buy_time, sell_time, qty, buy_price, sell_price, fee_ngn, net_profit,
+                 buy_id=None, sell_id=None):
+        self.buy_time = buy_time
+        self.sell_time = sell_time
+        self.qty = qty
+        self.buy_price = buy_price
+        self.sell_price = sell_price
+        self.fee_ngn = fee_ngn
+        self.net_profit = net_profit
+        self.buy_id = buy_id
+        self.sell_id = sell_id
+
+    def __repr__(self):
+        return (
+            f"MatchedLot(buy_time={self.buy_time}, sell_time={self.sell_time}, "
+            f"qty={self.qty}, net_profit={self.net_profit})"
+        )
+
+
+class FifoMatcher:
+    """Open BUY lots in a deque; each SELL yields the lots it closes."""
+
+    __slots__ = ("lots",)
+
+    def __init__(self, lots=None):
+        self.lots = deque(lots or ())
+
+    def buy(self, qty, price, fee, ts, trade_id=None):
+        if float(qty) <= 0:
+            return
+        self.lots.append(Lot(float(qty), float(price), float(fee), ts, trade_id))
+
+    def sell(self, qty, price, ts, trade_id=None):
+        lots = self.lots
+        remaining = float(qty)
+        price = float(price)
+
+        while remaining > 0 and lots:
+            lot = lots[0]
+            if lot.qty <= 0:   # carried from before buy() skipped them
+                lots.popleft()
+                continue
+
+            matched = min(lot.qty, remaining)
+            fee_ngn = (lot.fee * (matched / lot.qty)) * lot.price
+            net_profit = matched * (price - lot.price) - fee_ngn
+
+            yield MatchedLot(lot.time, ts, matched, lot.price, price, fee_ngn, net_profit,
+                             lot.trade_id, trade_id)
+
+            remaining -= matched
+
+            # Partially used lots stay at the front with their original fee
+            leftover = lot.qty - matched
+            if leftover > 0:
+                lot.qty = leftover
+            else:
+                lots.popleft()
+
+    def feed(self, side, qty, price, fee, ts, trade_id=None):
+        """Apply one trade; returns the list of lots a SELL closed."""
+        if side == 0:
+            self.buy(qty, price, fee, ts, trade_id)
+        elif side == 1:
+            return list(self.sell(qty, price, ts, trade_id))
+        return []
+
+
+def match_trades(rows, matcher=None):
+    """
+    Stream (side, amount, price, fee, completed_at) rows — a cursor works —
+    and yield a MatchedLot for every buy/sell pairing.
+    """
+    matcher = matcher if matcher is not None else FifoMatcher()
+
+    for side, qty, price, fee, ts in rows:
+        if side == 0:
+            matcher.buy(qty, price, fee, ts)
+        elif side == 1:
+            yield from matcher.sell(qty, price, ts)
+
+
+# ========================= VECTORIZED =========================
+def load_trade_arrays(rows, lots=()):
+    """
+    Stream (side, amount, price, fee, completed_at) rows — a cursor works —
+    into float arrays (side, qty, price, fee, time), after any carried
+    open `lots` (as buys).
+    """
+    carried = ((0, lot.qty, lot.price, lot.fee, lot.time) for lot in lots)
+    flat = np.fromiter(
+        itertools.chain.from_iterable(itertools.chain(carried, rows)),
+        dtype=np.float64,
+    )
+    side, qty, price, fee, ts = flat.reshape(-1, 5).T
+    return side.copy(), qty.copy(), price.copy(), fee.copy(), ts.copy()
+
+
+class ArrayMatches:
+    """
+    match_arrays result. buy/sell are indexes into the input arrays;
+    open_buys/open_qty are the lots left open, oldest first.
+    """
+
+    __slots__ = ("buy", "sell", "qty", "fee_ngn", "net_profit", "open_buys", "open_qty")
+
+    def __init__(self, buy, sell, qty, fee_ngn, net_profit, open_buys, open_qty):
+        self.buy = buy
+        self.sell = sell
+        self.qty = qty
+        self.fee_ngn = fee_ngn
+        self.net_profit = net_profit
+        self.open_buys = open_buys
+        self.open_qty = open_qty
+
+    def __len__(self):
+        return len(self.qty)
+
+
+def match_arrays(side, qty, price, fee):
+    """
+    FIFO matching over whole arrays, same rules as FifoMatcher.
+
+    With B_k and S_k the cumulative buy and sell quantity through trade k,
+    the quantity actually sold (excess sells dropped) is
+
+        C_k = S_k + min(0, min_{j<=k} (B_j - S_j))
+
+    Buy ends B and sold ends C cut [0, C_n) into segments. Each segment
+    is one (lot, sell) match, found with searchsorted. The lot's
+    remaining quantity at the match is its end minus the segment start,
+    which gives the fee share exactly as the loop computes it.
+    """
+    units = np.maximum(np.rint(qty * QTY_SCALE).astype(np.int64), 0)
+    is_buy = side == 0
+    is_sell = side == 1
+
+    bought = np.cumsum(np.where(is_buy, units, 0))
+    sold_raw = np.cumsum(np.where(is_sell, units, 0))
+    sold = sold_raw + np.minimum(0, np.minimum.accumulate(bought - sold_raw))
+
+    buys = np.flatnonzero(is_buy)
+    sells = np.flatnonzero(is_sell)
+    buy_end = bought[buys]
+    sell_end = sold[sells]
+    total = sold[-1] if len(sold) else 0
+
+    # Both inputs are already sorted, so a stable sort just merges them
+    points = np.concatenate(([0], buy_end[buy_end < total], sell_end, [total]))
+    points.sort(kind="stable")
+    start = points[:-1]
+    length = np.diff(points)
+    keep = length > 0
+    start, length = start[keep], length[keep]
+
+    lot = np.searchsorted(buy_end, start, side="right")
+    sale = np.searchsorted(sell_end, start, side="right")
+    b = buys[lot]
+    s = sells[sale]
+
+    fee_ngn = fee[b] * (length / (buy_end[lot] - start)) * price[b]
+    matched = length / QTY_SCALE
+    net_profit = matched * (price[s] - price[b]) - fee_ngn
+
+    open_from = np.searchsorted(buy_end, total, side="right")
+    open_buys = buys[open_from:]
+    open_units = buy_end[open_from:] - np.maximum(buy_end[open_from:] - units[open_buys], total)
+    has_qty = open_units > 0
+    open_buys, open_units = open_buys[has_qty], open_units[has_qty]
+
+    return ArrayMatches(b, s, matched, fee_ngn, net_profit, open_buys, open_units / QTY_SCALE)
+
+
+def iter_array_matches(rows, lots=(), chunk=ARRAY_CHUNK):
+    """
+    match_arrays over a stream of rows, `chunk` trades at a time. The lots
+    left open by one chunk are carried into the next, which gives the
+    same matches as one call over everything, while memory stays bounded
+    by the chunk plus the open inventory. Yields (ArrayMatches, (side,
+    qty, price, fee, time)) per chunk; indexes refer to that chunk's
+    arrays, which start with the carried lots.
+    """
+    rows = iter(rows)
+    lots = list(lots)
+
+    while True:
+        arrays = load_trade_arrays(itertools.islice(rows, chunk), lots)
+        if len(arrays[0]) == len(lots):
+            return   # no rows left
+
+        side, qty, price, fee, ts = arrays
+        r = match_arrays(side, qty, price, fee)
+        yield r, arrays
+
+        # Remaining quantity with the original fee, as FifoMatcher keeps them
+        lots = [
+            Lot(q, float(price[i]), float(fee[i]), int(ts[i]))
+            for i, q in zip(r.open_buys.tolist(), r.open_qty.tolist())
+        ]
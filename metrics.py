@@ -0,0 +1,223 @@
+"""
+In-process counters and latency histograms.
+
+Cheap enough to leave on in production: a metric update takes a lock and
+touches one dict entry. Histograms use fixed buckets, Prometheus style,
+so memory stays constant however many observations arrive. Quantiles
+are estimated by interpolating inside the bucket that holds them.
+
+    metrics.inc("bybit_requests_total", endpoint="/v5/...", ret_code=0)
+    with metrics.timer("fifo_seconds", op="replay"):
+        ...
+
+Each process has its own registry. Work done in the spawned CPU pool is
+timed from the parent, around the pool call.
+"""
+
+import os
+import time
+import math
+import bisect
+import asyncio
+import functools
+import threading
+from contextlib import contextmanager
+
+# Seconds; spans SQLite point reads up to full ledger rebuilds
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0,
+)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum", "min", "max")
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # last slot is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Estimate from the buckets, clamped to the observed min/max."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        lower = 0.0
+        for i, n in enumerate(self.counts):
+            upper = self.buckets[i] if i < len(self.buckets) else self.max
+            if n and seen + n >= rank:
+                value = lower + (upper - lower) * (rank - seen) / n
+                return min(max(value, self.min), self.max)
+            seen += n
+            lower = upper
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "max": self.max if self.count else None,
+        }
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{_escape(v)}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Registry:
+    """Counters and histograms keyed by (name, sorted labels)."""
+
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.started = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, metric, value=1, /, **labels):
+        key = (metric, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, metric, seconds, /, **labels):
+        key = (metric, _label_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+            hist.observe(seconds)
+
+    @contextmanager
+    def timer(self, metric, /, **labels):
+        """Observe the block's duration; an exception adds error="1"."""
+        t = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(metric, time.perf_counter() - t, **labels, error=1)
+            raise
+        self.observe(metric, time.perf_counter() - t, **labels)
+
+    def timed(self, metric, /, **labels):
+        """Decorator form of timer(), for plain and async functions."""
+        def wrap(fn):
+            if asyncio.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(metric, **labels):
+                        return await fn(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(metric, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return wrap
+
+    def snapshot(self):
+        """(counters, histogram summaries) as {(name, labels): value} copies."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: h.summary() for k, h in self._histograms.items()}
+        return counters, histograms
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started = time.time()
+
+    def render_prometheus(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(
+                ((k, list(h.counts), h.sum, h.count, h.buckets) for k, h in self._histograms.items()),
+                key=lambda item: item[0],
+            )
+
+        lines = []
+        typed = set()
+        for (name, key), value in counters:
+            full = self.prefix + name
+            if full not in typed:
+                lines.append(f"# TYPE {full} counter")
+                typed.add(full)
+            lines.append(f"{full}{_format_labels(key)} {value}")
+
+        for (name, key), counts, total, count, buckets in histograms:
+            full = self.prefix + name
+            if full not in typed:
+                lines.append(f"# TYPE {full} histogram")
+                typed.add(full)
+            cumulative = 0
+            for bound, n in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += n
+                lines.append(f"{full}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{full}_sum{_format_labels(key)} {total}")
+            lines.append(f"{full}_count{_format_labels(key)} {count}")
+
+        lines.append(f"# TYPE {self.prefix}process_start_time_seconds gauge")
+        lines.append(f"{self.prefix}process_start_time_seconds {self.started}")
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Atomically replace `path`, for node_exporter's textfile collector."""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp, path)
+
+
+def serve_prometheus(registry, port, host="127.0.0.1"):
+    """Expose GET /metrics on a daemon thread; returns the server."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            data = registry.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,394 @@
+"""
+Local stand-in for Bybit's /v5/p2p/order/simplifyList.
+
+Serves a deterministic, paginated order history generated from a seed.
+It checks the same X-BAPI-* HMAC signature the bot sends, and can inject
+latency, throttling, HTTP errors, empty pages and duplicate items
+across pages. Only the standard library is needed:
+
+    python mock_bybit.py --orders 20000 --port 8765 --throttle-rate 0.05
+    BYBIT_BASE_URL=http://127.0.0.1:8765 python profitcal.py backfill --from 2026-01-01
+
+The API key/secret default to BYBIT_API_KEY / BYBIT_API_SECRET, so the bot's
+normal .env works unchanged. GET /stats returns request and fault counters.
+"""
+
+import os
+import sys
+import json
+import hmac
+import time
+import bisect
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ORDERS_ENDPOINT = "/v5/p2p/order/simplifyList"
+
+BUY_FEE_RATE = 0.00275   # same rate the bot assumes for online buys
+MEAN_GAP_MS = 150_000
+MAX_PAGE_SIZE = 30
+RECV_WINDOW_SLACK_MS = 1000
+
+# retCodes the bot treats specially (see BYBIT_RETRY_CODES in profitcal.py)
+RET_OK = 0
+RET_TIMESTAMP = 10002
+RET_BAD_KEY = 10003
+RET_BAD_SIGN = 10004
+RET_TOO_MANY = 10006
+
+
+# ========================= ORDER HISTORY =========================
+def make_order(r, index, seed, created_ms):
+    """One simplifyList item. `r` decides everything but the timestamp."""
+    side = 0 if r.random() < 0.52 else 1
+    qty = round(r.lognormvariate(4, 0.9), 4)
+    price = round(1500 + r.gauss(0, 15) + (-r.uniform(0, 8) if side == 0 else r.uniform(0, 8)), 2)
+
+    # A few orders the bot must filter out: cancelled, or another fiat
+    status = 40 if r.random() < 0.05 else 50
+    fiat = "GHS" if r.random() < 0.02 else "NGN"
+
+    return {
+        "id": str(10 ** 18 + seed * 10 ** 10 + index),
+        "orderType": "ORIGIN",
+        "side": side,
+        "tokenId": "USDT",
+        "currencyId": fiat,
+        "amount": f"{qty * price:.2f}",
+        "price": f"{price:.2f}",
+        "notifyTokenQuantity": f"{qty:.4f}",
+        "notifyTokenId": "USDT",
+        "fee": f"{qty * BUY_FEE_RATE:.4f}" if side == 0 else "0",
+        "targetNickName": f"trader{r.randrange(500)}",
+        "targetUserId": str(r.randrange(10 ** 8, 10 ** 9)),
+        "status": status,
+        "selfUnreadMsgCount": "0",
+        "createDate": str(created_ms),
+        "updateDate": str(created_ms + r.randrange(30_000, 900_000)),
+        "transferLastSeconds": "0",
+        "appraiseStatus": "0",
+    }
+
+
+class OrderBook:
+    """
+    Orders kept oldest first, so a time window is a bisect. The history
+    is built up front. With `live_interval` set, another order "completes"
+    every live_interval seconds while the server runs. New orders land at
+    the front of the newest-first pages, so they shift later pages the
+    way they do on Bybit.
+    """
+
+    def __init__(self, count, seed=1, end_ms=None, live_interval=0.0):
+        self.seed = seed
+        self.live_interval = live_interval
+        self.started = time.time()
+        self.live_added = 0
+        self._lock = threading.Lock()
+
+        r = random.Random(seed)
+        end_ms = end_ms or int(self.started * 1000)
+        gaps = [int(r.expovariate(1 / MEAN_GAP_MS)) + 1 for _ in range(count)]
+        t = end_ms - sum(gaps)   # newest order lands exactly on end_ms
+        self.orders = []
+        for i, gap in enumerate(gaps):
+            t += gap
+            self.orders.append(make_order(r, i, seed, t))
+        self.created = [int(o["createDate"]) for o in self.orders]
+        self.history = count
+
+    def _add_live(self):
+        if not self.live_interval:
+            return
+        due = int((time.time() - self.started) / self.live_interval)
+        with self._lock:
+            while self.live_added < due:
+                k = self.live_added
+                created = int((self.started + (k + 1) * self.live_interval) * 1000)
+                order = make_order(random.Random(self.seed * 1_000_003 + k), self.history + k, self.seed, created)
+                self.orders.append(order)
+                self.created.append(created)
+                self.live_added += 1
+
+    def window(self, begin_ms, end_ms, status=None):
+        """Orders created in [begin_ms, end_ms], newest first."""
+        self._add_live()
+        with self._lock:
+            lo = bisect.bisect_left(self.created, begin_ms)
+            hi = bisect.bisect_right(self.created, end_ms)
+            orders = self.orders[lo:hi]
+        if status is not None:
+            orders = [o for o in orders if o["status"] == status]
+        orders.reverse()
+        return orders
+
+
+# ========================= SERVER =========================
+class MockBybit:
+    """
+    The order book plus fault injection. Rates are per-request
+    probabilities drawn from a seeded RNG. `rate_limit` (requests/sec)
+    enforces a real server-side window, like Bybit's, and reports it in
+    X-Bapi-Limit-* headers.
+    """
+
+    def __init__(self, orders=5000, seed=1, end_ms=None, api_key=None, api_secret=None,
+                 latency_ms=0.0, jitter_ms=0.0, throttle_rate=0.0, rate_limit=0,
+                 error_rate=0.0, empty_rate=0.0, duplicate_rate=0.0, live_interval=0.0,
+                 check_timestamp=True):
+        self.book = OrderBook(orders, seed, end_ms, live_interval)
+        self.api_key = api_key if api_key is not None else os.getenv("BYBIT_API_KEY", "mock-key")
+        self.api_secret = api_secret if api_secret is not None else os.getenv("BYBIT_API_SECRET", "mock-secret")
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.duplicate_rate = duplicate_rate
+        self.check_timestamp = check_timestamp
+
+        self.rng = random.Random(seed + 1)
+        self.window_start = 0
+        self.window_used = 0
+        self.counters = {
+            "requests": 0, "ok": 0, "bad_key": 0, "bad_sign": 0, "bad_timestamp": 0,
+            "throttled": 0, "rate_limited": 0, "http_errors": 0, "empty_pages": 0,
+            "duplicated_items": 0, "items_served": 0,
+        }
+        self._lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def _chance(self, rate):
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self.rng.random() < rate
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, "orders": len(self.book.orders), "live_added": self.book.live_added}
+
+    def check_auth(self, headers, body):
+        """None if the request is signed like the bot signs it, else (retCode, retMsg)."""
+        key = headers.get("X-BAPI-API-KEY")
+        ts = headers.get("X-BAPI-TIMESTAMP", "")
+        recv_window = headers.get("X-BAPI-RECV-WINDOW", "5000")
+        sign = headers.get("X-BAPI-SIGN", "")
+
+        if key != self.api_key:
+            self._count("bad_key")
+            return RET_BAD_KEY, "API key is invalid."
+
+        payload = f"{ts}{key}{recv_window}{body}"
+        expected = hmac.new(self.api_secret.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, sign):
+            self._count("bad_sign")
+            return RET_BAD_SIGN, "error sign! origin_string[%s]" % payload
+
+        if self.check_timestamp:
+            try:
+                skew = int(time.time() * 1000) - int(ts)
+                window = int(recv_window)
+            except ValueError:
+                skew, window = None, 0
+            if skew is None or skew > window or skew < -RECV_WINDOW_SLACK_MS:
+                self._count("bad_timestamp")
+                return RET_TIMESTAMP, "invalid request, please check your server timestamp or recv_window param"
+
+        return None
+
+    def take_rate_limit(self):
+        """(allowed, remaining, reset_ms) for the current one-second window."""
+        now_ms = int(time.time() * 1000)
+        with self._lock:
+            if now_ms - self.window_start >= 1000:
+                self.window_start, self.window_used = now_ms, 0
+            self.window_used += 1
+            remaining = max(0, self.rate_limit - self.window_used)
+            return self.window_used <= self.rate_limit, remaining, self.window_start + 1000
+
+    def orders_page(self, body):
+        page = max(1, int(body.get("page", 1)))
+        size = max(1, min(MAX_PAGE_SIZE, int(body.get("size", MAX_PAGE_SIZE))))
+        begin_ms = int(body.get("beginTime") or 0)
+        end_ms = int(body.get("endTime") or 2 ** 62)
+        status = body.get("status")
+        status = int(status) if status not in (None, "") else None
+
+        orders = self.book.window(begin_ms, end_ms, status)
+        start = (page - 1) * size
+        items = orders[start:start + size]
+
+        if items and self._chance(self.empty_rate):
+            self._count("empty_pages")
+            items = []
+        elif page > 1 and items and self._chance(self.duplicate_rate):
+            # Repeat the tail of the previous page, as Bybit does when its list shifts
+            with self._lock:
+                repeat = self.rng.randint(1, max(1, size // 3))
+            items = orders[max(0, start - repeat):start] + items
+            self._count("duplicated_items", min(repeat, start))
+
+        self._count("items_served", len(items))
+        return {"count": len(orders), "items": items}
+
+    def handle(self, path, headers, body_str):
+        """(http_status, extra_headers, payload) for one POST."""
+        self._count("requests")
+
+        delay = self.latency_ms
+        if self.jitter_ms:
+            with self._lock:
+                delay += self.rng.uniform(0, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        if path != ORDERS_ENDPOINT:
+            return 404, {}, {"retCode": 10001, "retMsg": f"unknown path {path}"}
+
+        if self._chance(self.error_rate):
+            self._count("http_errors")
+            return 503, {"Retry-After": "0"}, {"retCode": 10016, "retMsg": "Service Unavailable"}
+
+        denied = self.check_auth(headers, body_str)
+        if denied:
+            return 200, {}, {"retCode": denied[0], "retMsg": denied[1], "result": {}}
+
+        extra = {}
+        if self.rate_limit:
+            allowed, remaining, reset_ms = self.take_rate_limit()
+            extra = {
+                "X-Bapi-Limit": str(self.rate_limit),
+                "X-Bapi-Limit-Status": str(remaining),
+                "X-Bapi-Limit-Reset-Timestamp": str(reset_ms),
+            }
+            if not allowed:
+                self._count("rate_limited")
+                return 200, extra, {"retCode": RET_TOO_MANY, "retMsg": "Too many visits!", "result": {}}
+
+        if self._chance(self.throttle_rate):
+            self._count("throttled")
+            reset_ms = int(time.time() * 1000) + 200
+            extra = {**extra, "X-Bapi-Limit-Status": "0", "X-Bapi-Limit-Reset-Timestamp": str(reset_ms)}
+            return 200, extra, {"retCode": RET_TOO_MANY, "retMsg": "Too many visits!", "result": {}}
+
+        try:
+            body = json.loads(body_str or "{}")
+            result = self.orders_page(body)
+        except (ValueError, TypeError) as e:
+            return 200, {}, {"retCode": 10001, "retMsg": f"params error: {e}", "result": {}}
+
+        self._count("ok")
+        return 200, extra, {
+            "retCode": RET_OK,
+            "retMsg": "SUCCESS",
+            "result": result,
+            "retExtInfo": {},
+            "time": int(time.time() * 1000),
+        }
+
+    def start(self, host="127.0.0.1", port=0, verbose=False):
+        """Serve in a background thread; returns the base URL."""
+        self.server = ThreadingHTTPServer((host, port), _handler_for(self, verbose))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-bybit", daemon=True)
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def _handler_for(mock, verbose):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # keep-alive, like the real API
+        disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+        def _send(self, status, headers, payload):
+            data = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body_str = self.rfile.read(length).decode("utf-8") if length else ""
+            self._send(*mock.handle(self.path, self.headers, body_str))
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send(200, {}, mock.stats())
+            elif self.path == "/health":
+                self._send(200, {}, {"ok": True})
+            else:
+                self._send(404, {}, {"retCode": 10001, "retMsg": f"unknown path {self.path}"})
+
+        def log_message(self, fmt, *args):
+            if verbose:
+                super().log_message(fmt, *args)
+
+    return Handler
+
+
+# ========================= MAIN =========================
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mock Bybit P2P order history server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--orders", type=int, default=5000, help="orders in the seeded history")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--end-ms", type=int, help="newest history timestamp (default: now); fix it for byte-identical runs")
+    parser.add_argument("--live-interval", type=float, default=0.0, help="seconds between new orders while running (0 = off)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added to every request")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="extra uniform random latency")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="chance of retCode 10006 per request")
+    parser.add_argument("--rate-limit", type=int, default=0, help="server-side requests/sec before 10006 (0 = off)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="chance of HTTP 503 per request")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="chance a non-empty page comes back empty")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0, help="chance a page repeats the previous page's tail")
+    parser.add_argument("--no-timestamp-check", action="store_true", help="accept any X-BAPI-TIMESTAMP")
+    parser.add_argument("--verbose", action="store_true", help="log every request")
+    args = parser.parse_args(argv)
+
+    mock = MockBybit(
+        orders=args.orders, seed=args.seed, end_ms=args.end_ms,
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        throttle_rate=args.throttle_rate, rate_limit=args.rate_limit,
+        error_rate=args.error_rate, empty_rate=args.empty_rate,
+        duplicate_rate=args.duplicate_rate, live_interval=args.live_interval,
+        check_timestamp=not args.no_timestamp_check,
+    )
+    url = mock.start(args.host, args.port, args.verbose)
+    print(f"Mock Bybit serving {args.orders:,} orders on {url}{ORDERS_ENDPOINT}")
+    print(f"Point the bot at it with BYBIT_BASE_URL={url}")
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.stop()
+        print(json.dumps(mock.stats(), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
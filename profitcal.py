@@ -1,12 +1,33 @@
 import os
+import sys
 import time
 import hmac
 import hashlib
 import json
 import sqlite3
+import asyncio
+import random
+import logging
+import signal
+import re
+import argparse
+import io
+import pstats
+import cProfile
+import itertools
+import functools
+import contextvars
+import tracemalloc
+from collections import OrderedDict
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
 from datetime import datetime, timedelta
 
-import requests
+import httpx
 from dotenv import load_dotenv
 
 from telegram import (
@@ -16,6 +37,7 @@ from telegram import (
     InlineKeyboardMarkup,
 )
 
+from telegram.error import TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -29,8 +51,16 @@ from telegram.ext import (
 from enum import Enum, auto
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.platypus import BaseDocTemplate, PageTemplate, Frame, Table, TableStyle, Paragraph
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from fifo import FifoMatcher, Lot, match_trades, HAVE_NUMPY, load_trade_arrays, match_arrays, iter_array_matches
+from metrics import Registry, serve_prometheus
 
 
 class AddTradeState(Enum):
@@ -66,16 +96,567 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 DEFAULT_FIAT = os.getenv("DEFAULT_FIAT", "NGN")
 
-BASE_URL = "https://api.bybit.com"
+BASE_URL = os.getenv("BYBIT_BASE_URL", "https://api.bybit.com")   # e.g. http://127.0.0.1:8765 for mock_bybit.py
 DB_NAME = "mulla p2p.db"
 
+# Sync stream + incremental window
+SYNC_STATUS = 50
+SYNC_TOKEN = "USDT"
+SYNC_FIAT = "NGN"
+SYNC_START_DATE = os.getenv("SYNC_START_DATE", "2026-01-01")      # first sync only
+SYNC_OVERLAP_MINUTES = int(os.getenv("SYNC_OVERLAP_MINUTES", "60"))  # re-read window behind watermark
+
+# Bybit HTTP client
+BYBIT_TIMEOUT = float(os.getenv("BYBIT_TIMEOUT", "10"))                  # read/write/pool seconds
+BYBIT_CONNECT_TIMEOUT = float(os.getenv("BYBIT_CONNECT_TIMEOUT", "5"))
+BYBIT_MAX_CONNECTIONS = int(os.getenv("BYBIT_MAX_CONNECTIONS", "4"))
+
+# Bybit request scheduling
+BYBIT_RATE_LIMIT = float(os.getenv("BYBIT_RATE_LIMIT", "10"))         # requests/sec sustained
+BYBIT_RATE_BURST = int(os.getenv("BYBIT_RATE_BURST", "10"))
+BYBIT_MAX_RETRIES = int(os.getenv("BYBIT_MAX_RETRIES", "5"))
+BYBIT_BACKOFF_BASE = float(os.getenv("BYBIT_BACKOFF_BASE", "0.5"))    # seconds, doubled per retry
+BYBIT_BACKOFF_MAX = float(os.getenv("BYBIT_BACKOFF_MAX", "30"))
+BYBIT_BREAKER_THRESHOLD = int(os.getenv("BYBIT_BREAKER_THRESHOLD", "5"))  # consecutive failures
+BYBIT_BREAKER_COOLDOWN = float(os.getenv("BYBIT_BREAKER_COOLDOWN", "60"))
+BYBIT_MAX_PAGES = 1000                                                # per simplifyList walk
+
+# 10000 timeout, 10002 timestamp/recv_window, 10006 too many visits,
+# 10016 service error, 10018 IP rate limit
+BYBIT_RETRY_CODES = {10000, 10002, 10006, 10016, 10018}
+
+log = logging.getLogger("mullabot")
+
+# ========================= METRICS =========================
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE")               # Prometheus textfile, rewritten every interval
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))             # local http://127.0.0.1:PORT/metrics (0 = off)
+METRICS_INTERVAL = int(os.getenv("METRICS_INTERVAL", "60"))    # seconds between textfile writes
+SQL_METRICS = os.getenv("SQL_METRICS", "1") == "1"             # time every SQL statement, per fingerprint
+
+metrics = Registry(prefix="mullabot_")
+
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))       # log statements slower than this, with their plan
+SLOW_QUERY_LOG_EVERY = 60                                      # seconds between log lines per fingerprint
+EXPLAIN_VERBS = {"SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE"}
+
+_SQL_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_SQL_STRING = re.compile(r"'(?:[^']|'')*'")
+_SQL_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SQL_SPACE = re.compile(r"\s+")
+_SQL_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)", re.I)
+
+
+@functools.lru_cache(maxsize=2048)
+def sql_fingerprint(sql):
+    """The statement with literals as ? and IN lists collapsed, so call sites group."""
+    s = _SQL_COMMENT.sub(" ", sql)
+    s = _SQL_STRING.sub("?", s)
+    s = _SQL_NUMBER.sub("?", s)
+    s = _SQL_SPACE.sub(" ", s).strip()
+    return _SQL_IN_LIST.sub("IN (?, …)", s)
+
+
+def _sql_verb(fingerprint):
+    words = fingerprint.split(None, 1)
+    return words[0].upper() if words else ""
+
+
+class QueryStat:
+    __slots__ = ("fingerprint", "calls", "seconds", "max_seconds", "rows", "slow", "plan", "full_scan", "logged_at")
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.slow = 0
+        self.plan = None          # EXPLAIN QUERY PLAN lines, from the first slow run
+        self.full_scan = False
+        self.logged_at = None
+
+
+class QueryStats:
+    """Per-fingerprint totals for every traced statement in this process."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def record(self, fingerprint, seconds, rows, slow):
+        with self._lock:
+            stat = self._entries.get(fingerprint)
+            if stat is None:
+                stat = self._entries[fingerprint] = QueryStat(fingerprint)
+            stat.calls += 1
+            stat.seconds += seconds
+            stat.max_seconds = max(stat.max_seconds, seconds)
+            stat.rows += rows
+            stat.slow += slow
+            return stat
+
+    def top(self, n=10, order="total"):
+        keys = {
+            "total": lambda st: st.seconds,
+            "max": lambda st: st.max_seconds,
+            "avg": lambda st: st.seconds / st.calls,
+            "calls": lambda st: st.calls,
+            "rows": lambda st: st.rows,
+        }
+        with self._lock:
+            entries = list(self._entries.values())
+        return sorted(entries, key=keys[order], reverse=True)[:n]
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+
+
+query_stats = QueryStats()
+
+
+def explain_query_plan(conn, sql, parameters):
+    # A plain cursor, so the EXPLAIN itself isn't traced
+    try:
+        rows = sqlite3.Connection.cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error as e:
+        return [f"(EXPLAIN failed: {e})"]
+    return [row[-1] for row in rows]
+
+
+def record_query(conn, sql, parameters, seconds, rows):
+    fingerprint = sql_fingerprint(sql)
+    verb = _sql_verb(fingerprint)
+    slow = seconds * 1000 >= SLOW_QUERY_MS
+
+    metrics.observe("sql_seconds", seconds, role=conn.role, verb=verb)
+    stat = query_stats.record(fingerprint, seconds, rows, slow)
+
+    if not slow:
+        return
+    # Batched writes can be slow hundreds of times a minute; one line per fingerprint is enough
+    now = time.monotonic()
+    if stat.logged_at is not None and now - stat.logged_at < SLOW_QUERY_LOG_EVERY:
+        return
+    stat.logged_at = now
+
+    if stat.plan is None and verb in EXPLAIN_VERBS and parameters is not None:
+        stat.plan = explain_query_plan(conn, sql, parameters)
+        # SEARCH uses an index; SCAN without USING INDEX reads the whole table
+        stat.full_scan = any(d.startswith("SCAN ") and " USING " not in d for d in stat.plan)
+    log.warning(
+        "Slow query %.0f ms, %d row(s) [%s, %d slow so far]: %s%s",
+        seconds * 1000, rows, conn.role, stat.slow, fingerprint,
+        "".join(f"\n    plan: {d}" for d in stat.plan or ()),
+    )
+
+
+SQL_FETCH_CHUNK = 2000   # rows per fetchmany in stream_rows
+
+
+def stream_rows(cursor, size=SQL_FETCH_CHUNK):
+    """
+    Iterate a big result set through fetchmany. Rows are built in C and
+    TracedCursor sees one call per chunk rather than one per row.
+    """
+    return itertools.chain.from_iterable(iter(functools.partial(cursor.fetchmany, size), []))
+
+
+class TracedCursor(sqlite3.Cursor):
+    """
+    Times each statement, from execute through the last row read, and
+    counts its rows. Figures go to sql_seconds{role, verb} and to
+    query_stats under the statement's fingerprint. A SELECT is recorded
+    when it is exhausted, re-executed, closed or dropped.
+    """
+
+    _pending = None   # [sql, parameters, seconds, rows] while a result set is being read
+
+    def _finish(self):
+        pending = self._pending
+        if pending is not None:
+            self._pending = None
+            record_query(self.connection, *pending)
+
+    def _traced(self, sql, parameters, run):
+        self._finish()
+        t = time.perf_counter()
+        try:
+            run()
+        except BaseException:
+            record_query(self.connection, sql, None, time.perf_counter() - t, 0)
+            raise
+        elapsed = time.perf_counter() - t
+
+        if self.description is None:
+            # No result set: done now, rowcount is the rows changed
+            record_query(self.connection, sql, parameters, elapsed, max(self.rowcount, 0))
+        else:
+            self._pending = [sql, parameters, elapsed, 0]
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._traced(sql, parameters, lambda: super(TracedCursor, self).execute(sql, parameters))
+
+    def executemany(self, sql, seq_of_parameters):
+        # The parameters may be a one-shot iterator, so there is nothing to EXPLAIN with
+        return self._traced(sql, None, lambda: super(TracedCursor, self).executemany(sql, seq_of_parameters))
+
+    def executescript(self, sql_script):
+        return self._traced(sql_script, None, lambda: super(TracedCursor, self).executescript(sql_script))
+
+    def __next__(self):
+        t = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            if self._pending is not None:
+                self._pending[2] += time.perf_counter() - t
+            self._finish()
+            raise
+        pending = self._pending
+        if pending is not None:
+            pending[2] += time.perf_counter() - t
+            pending[3] += 1
+        return row
+
+    def fetchone(self):
+        t = time.perf_counter()
+        row = super().fetchone()
+        pending = self._pending
+        if pending is not None:
+            pending[2] += time.perf_counter() - t
+            if row is None:
+                self._finish()
+            else:
+                pending[3] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        t = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        pending = self._pending
+        if pending is not None:
+            pending[2] += time.perf_counter() - t
+            pending[3] += len(rows)
+            if len(rows) < (self.arraysize if size is None else size):
+                self._finish()
+        return rows
+
+    def fetchall(self):
+        t = time.perf_counter()
+        rows = super().fetchall()
+        pending = self._pending
+        if pending is not None:
+            pending[2] += time.perf_counter() - t
+            pending[3] += len(rows)
+            self._finish()
+        return rows
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class TracedConnection(sqlite3.Connection):
+    """
+    Hands out TracedCursors. The connection shortcuts are overridden too:
+    the C versions call the cursor's C execute directly.
+    """
+
+    role = "rw"
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+
+# ========================= CONNECTIONS =========================
+DB_READERS = int(os.getenv("DB_READERS", "4"))                 # read-only pool size
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", "16384"))          # page cache per connection
+DB_MMAP_MB = int(os.getenv("DB_MMAP_MB", "256"))
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "10"))   # seconds to wait on another process
+DB_STATEMENT_CACHE = 256                                      # prepared statements kept per connection
+
+
+class Database:
+    """
+    Long-lived SQLite connections in WAL mode: one writer, serialized by a
+    lock, and a small pool of read-only connections. In WAL, readers see
+    the last committed state and never wait on the writer.
+    Connections open lazily and are not shared across processes.
+    """
+
+    def __init__(self, path, readers=DB_READERS):
+        self.path = path
+        self.readers = max(1, readers)
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._writer_depth = 0
+        self._pool = queue.LifoQueue()
+        self._pool_lock = threading.Lock()
+        self._opened = 0
+
+    def _check_process(self):
+        # A forked child must not reuse the parent's connections
+        if self._pid != os.getpid():
+            self._reset()
+
+    def _connect(self, readonly=False):
+        if readonly:
+            target, uri = Path(self.path).resolve().as_uri() + "?mode=ro", True
+        else:
+            target, uri = self.path, False
+
+        conn = sqlite3.connect(
+            target,
+            uri=uri,
+            timeout=DB_BUSY_TIMEOUT,
+            check_same_thread=False,     # handed between asyncio worker threads
+            cached_statements=DB_STATEMENT_CACHE,
+            factory=TracedConnection if SQL_METRICS else sqlite3.Connection,
+        )
+        if SQL_METRICS:
+            conn.role = "ro" if readonly else "rw"
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_MB * 1024 * 1024}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+
+        if not readonly:
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")   # durable at checkpoints; safe with WAL
+
+        return conn
+
+    @contextmanager
+    def writer(self):
+        """
+        The single writer connection. Commits when the outermost block
+        exits cleanly, rolls back on error. Re-entrant within a thread.
+        """
+        self._check_process()
+
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+
+            self._writer_depth += 1
+            try:
+                yield self._writer
+                if self._writer_depth == 1:
+                    self._writer.commit()
+            except BaseException:
+                if self._writer_depth == 1:
+                    self._writer.rollback()
+                raise
+            finally:
+                self._writer_depth -= 1
+
+    @contextmanager
+    def reader(self):
+        """A pooled read-only connection."""
+        self._check_process()
+
+        if self._writer is None:
+            # First touch creates the WAL files a read-only connection needs
+            with self.writer():
+                pass
+
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            with self._pool_lock:
+                grow = self._opened < self.readers
+                if grow:
+                    self._opened += 1
+            conn = self._connect(readonly=True) if grow else self._pool.get()
+
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+
+    def close(self):
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self._opened = 0
+
+
+db = Database(DB_NAME)
+
+
+@contextmanager
+def write_transaction(conn):
+    """
+    BEGIN IMMEDIATE ... COMMIT on the writer. Takes SQLite's write lock
+    before the first read, so state read inside the block cannot be
+    changed by another process (the sync worker) before it is written
+    back. Joins the transaction if one is already open.
+    """
+    if conn.in_transaction:
+        yield conn
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
+# ========================= EXECUTORS =========================
+DB_THREADS = int(os.getenv("DB_THREADS", "4"))         # SQLite calls from async handlers/jobs
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", "2"))       # processes for PDF builds and big FIFO replays
+FIFO_PROCESS_MIN_TRADES = int(os.getenv("FIFO_PROCESS_MIN_TRADES", "20000"))  # smaller replays stay in a thread
+
+
+def _timed_call(fn, args, kwargs):
+    # Runs inside the worker; the start time shows how long the task queued
+    return time.time(), fn(*args, **kwargs)
+
+
+_profile_session = contextvars.ContextVar("profile_session", default=None)   # set during /profile runs
+
+
+def _profiled_call(session, fn, args, kwargs):
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError:
+        # 3.12+: cProfile sits on sys.monitoring, which is process-wide, so the
+        # event-loop profile is already recording this thread
+        return _timed_call(fn, args, kwargs)
+    try:
+        return _timed_call(fn, args, kwargs)
+    finally:
+        prof.disable()
+        session.add_profile(prof)
+
+
+class WorkerPool:
+    """
+    An executor the event loop awaits, with counters: tasks in flight
+    beyond `workers` are waiting in the executor's queue.
+    """
+
+    def __init__(self, name, workers, factory):
+        self.name = name
+        self.workers = max(1, workers)
+        self._factory = factory
+        self._executor = None
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def queued(self):
+        return max(0, self.in_flight - self.workers)
+
+    def executor(self):
+        if self._executor is None:
+            self._executor = self._factory(self.workers)
+        return self._executor
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        submitted = time.time()
+
+        self.in_flight += 1
+        if self.queued:
+            log.info("%s pool saturated: %d task(s) queued", self.name, self.queued)
+
+        # A /profile session follows the call into DB threads; processes can't be joined
+        session = _profile_session.get()
+        executor = self.executor()
+        if session is not None and isinstance(executor, ThreadPoolExecutor):
+            call, call_args = _profiled_call, (session, fn, args, kwargs)
+        else:
+            call, call_args = _timed_call, (fn, args, kwargs)
+
+        try:
+            started, result = await loop.run_in_executor(executor, call, *call_args)
+        except BaseException:
+            self.failed += 1
+            metrics.inc("pool_failures_total", pool=self.name)
+            raise
+        finally:
+            self.in_flight -= 1
+
+        self.completed += 1
+        self.last_wait = max(0.0, started - submitted)
+        self.max_wait = max(self.max_wait, self.last_wait)
+        metrics.observe("pool_wait_seconds", self.last_wait, pool=self.name)
+        metrics.observe("pool_task_seconds", max(0.0, time.time() - started), pool=self.name)
+        return result
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "running": min(self.in_flight, self.workers),
+            "queued": self.queued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "last_wait_s": round(self.last_wait, 3),
+            "max_wait_s": round(self.max_wait, 3),
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+# Threads share the process's Database; spawned processes open their own
+db_pool = WorkerPool(
+    "db", DB_THREADS,
+    lambda n: ThreadPoolExecutor(max_workers=n, thread_name_prefix="mullabot-db"),
+)
+cpu_pool = WorkerPool(
+    "cpu", CPU_WORKERS,
+    lambda n: ProcessPoolExecutor(max_workers=n, mp_context=multiprocessing.get_context("spawn")),
+)
+
+
 # ========================= DATABASE =========================
 
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+# Schema changes are numbered migrations tracked in PRAGMA user_version.
+# Append new ones; never edit one that has shipped.
 
+def _migration_1_base_schema(c):
     # Trades table
     c.execute("""
     CREATE TABLE IF NOT EXISTS trades (
@@ -121,1224 +702,3520 @@ def init_db():
     )
     """)
 
-    conn.commit()
-    conn.close()
+    # Sync high-water mark per order stream
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sync_state (
+        status INTEGER,
+        token TEXT,
+        fiat TEXT,
+        last_update_ms INTEGER,
+        synced_at INTEGER,
+        PRIMARY KEY (status, token, fiat)
+    )
+    """)
 
+    # Backfill checkpoints: one row per finished time window
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS backfill_windows (
+        status INTEGER,
+        token TEXT,
+        fiat TEXT,
+        window_start INTEGER,
+        window_end INTEGER,
+        fetched INTEGER,
+        inserted INTEGER,
+        completed_at INTEGER,
+        PRIMARY KEY (status, token, fiat, window_start, window_end)
+    )
+    """)
 
+    # FIFO ledger: closed buy/sell pairings + buys not yet sold
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS matched_lots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        buy_id TEXT,
+        sell_id TEXT,
+        buy_time INTEGER,
+        sell_time INTEGER,
+        qty REAL,
+        buy_price REAL,
+        sell_price REAL,
+        fee_ngn REAL,
+        net_profit REAL
+    )
+    """)
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_matched_lots_sell_time
+    ON matched_lots (sell_time, net_profit)
+    """)
 
-def get_current_day_range():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS open_inventory (
+        seq INTEGER PRIMARY KEY,
+        buy_id TEXT,
+        qty REAL,
+        price REAL,
+        fee REAL,
+        buy_time INTEGER
+    )
+    """)
 
+    # How far the ledger has replayed trades, and how many it has seen
     c.execute("""
-        SELECT started_at, COALESCE(ended_at, strftime('%s','now')*1000)
-        FROM trading_day
-        ORDER BY id DESC
-        LIMIT 1
+    CREATE TABLE IF NOT EXISTS ledger_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        applied_through INTEGER,
+        trade_count INTEGER,
+        updated_at INTEGER
+    )
     """)
-    row = c.fetchone()
-    conn.close()
 
-    return row if row else (None, None)
+    # Per-date totals for weekly/monthly reports
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS daily_rollup (
+        date TEXT PRIMARY KEY,
+        buy_usdt REAL,
+        sell_usdt REAL,
+        buy_fiat REAL,
+        sell_fiat REAL,
+        buy_count INTEGER,
+        sell_count INTEGER,
+        fee_usdt REAL,
+        fee_ngn REAL,
+        profit_ngn REAL,
+        updated_at INTEGER
+    )
+    """)
 
+    # Open FIFO lots as of taken_at (= every trade completed <= taken_at applied)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS inventory_checkpoints (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        taken_at INTEGER UNIQUE,
+        trade_count INTEGER,
+        lots TEXT,
+        created_at INTEGER
+    )
+    """)
 
-# ========================= SIGNATURE =========================
-def _bybit_sign(body_str: str, ts_ms: str, recv_window: str) -> str:
-    payload = f"{ts_ms}{API_KEY}{recv_window}{body_str}"
-    return hmac.new(API_SECRET.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).hexdigest()
 
+def _migration_2_typed_trades(c):
+    # Rebuild trades so every value is stored with its declared type
+    # (replaces /fixdb's CAST(side AS INTEGER) patch-up)
+    c.execute("""
+    CREATE TABLE trades_typed (
+        id TEXT PRIMARY KEY,
+        side INTEGER,
+        token TEXT,
+        amount REAL,
+        fiat_amount REAL,
+        price REAL,
+        fee REAL,
+        counterparty TEXT,
+        status INTEGER,
+        created_at INTEGER,
+        completed_at INTEGER
+    )
+    """)
+    c.execute("""
+    INSERT INTO trades_typed
+    SELECT
+        CAST(id AS TEXT),
+        CAST(side AS INTEGER),
+        token,
+        CAST(amount AS REAL),
+        CAST(fiat_amount AS REAL),
+        CAST(price AS REAL),
+        CAST(COALESCE(fee, 0) AS REAL),
+        counterparty,
+        CAST(status AS INTEGER),
+        CAST(created_at AS INTEGER),
+        CAST(completed_at AS INTEGER)
+    FROM trades
+    """)
+    c.execute("DROP TABLE trades")
+    c.execute("ALTER TABLE trades_typed RENAME TO trades")
 
-# ========================= BYBIT API =========================
-def _request_bybit(endpoint: str, *, method: str = "POST", body: dict | None = None):
-    ts_ms = str(int(time.time() * 1000))
-    recv_window = "5000"
-    body = body or {}
+    # Sides may have changed: derived tables are rebuilt on startup
+    c.execute("DELETE FROM ledger_state")
+    c.execute("DELETE FROM inventory_checkpoints")
+    c.execute("DELETE FROM daily_rollup")
 
-    body_str = json.dumps(body, separators=(",", ":"))
-    sign = _bybit_sign(body_str, ts_ms, recv_window)
 
-    headers = {
-        "X-BAPI-API-KEY": API_KEY,
-        "X-BAPI-TIMESTAMP": ts_ms,
-        "X-BAPI-RECV-WINDOW": recv_window,
-        "X-BAPI-SIGN": sign,
-        "Content-Type": "application/json"
-    }
+def _migration_3_covering_indexes(c):
+    # Range scans on completed_at, already ordered for FIFO replay
+    # (completed_at, id) and carrying every column reports read
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_trades_completed
+    ON trades (completed_at, id, side, amount, fiat_amount, price, fee)
+    """)
 
-    url = BASE_URL + endpoint
+    c.execute("DROP INDEX IF EXISTS idx_matched_lots_sell_time")
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_matched_lots_sell_time
+    ON matched_lots (sell_time, net_profit, fee_ngn)
+    """)
 
-    try:
-        resp = requests.post(url, data=body_str, headers=headers, timeout=10)
-        return resp.json()
-    except Exception as e:
-        print("API ERROR:", e)
-        return None
 
-def export_trades_to_pdf(filename="p2p_report.pdf"):
-    from reportlab.lib.styles import ParagraphStyle
+def _migration_4_data_version(c):
+    # Counter bumped by every change to trades; caches key on it
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS data_version (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    c.execute("INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)")
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trades_bump_version_{event.lower()}
+        AFTER {event} ON trades
+        BEGIN
+            UPDATE data_version SET version = version + 1 WHERE id = 1;
+        END
+        """)
 
     c.execute("""
-        SELECT side, amount, price, fee, completed_at
-        FROM trades
-        ORDER BY completed_at ASC
-    """)
-    rows = c.fetchall()
-    conn.close()
-
-    buy_count = sum(1 for r in rows if r[0] == 0)
-    sell_count = sum(1 for r in rows if r[0] == 1)
-
-    buys = []
-    total_profit_ngn = 0.0
-    total_buy_fees_ngn = 0.0
-
-    table_data = [[
-        "Buy Time", "Sell Time",
-        "USDT", "Buy Price", "Sell Price",
-        "Buy Fee ₦", "Profit ₦"
-    ]]
-
-    for side, usdt, price, fee, ts in rows:
-        usdt = float(usdt)
-        price = float(price)
-        fee = float(fee)
-        trade_time = datetime.fromtimestamp(ts / 1000).strftime("%m-%d %H:%M")
-
-        if side == 0:
-            buys.append([usdt, price, fee, trade_time])
-
-        elif side == 1 and buys:
-            sell_remaining = usdt
-            sell_price = price
-            sell_time = trade_time
-
-            while sell_remaining > 0 and buys:
-                buy_usdt, buy_price, buy_fee, buy_time = buys.pop(0)
-
-                matched = min(buy_usdt, sell_remaining)
-                fee_ratio = matched / buy_usdt
-                buy_fee_ngn = (buy_fee * fee_ratio) * buy_price
-
-                gross_profit = matched * (sell_price - buy_price)
-                net_profit = gross_profit - buy_fee_ngn
-
-                total_profit_ngn += net_profit
-                total_buy_fees_ngn += buy_fee_ngn
-
-                table_data.append([
-                    buy_time,
-                    sell_time,
-                    f"{matched:.4f}",
-                    f"{buy_price}",
-                    f"{sell_price}",
-                    f"{buy_fee_ngn:,.2f}",
-                    f"{net_profit:,.2f}"
-                ])
-
-                sell_remaining -= matched
-                leftover = buy_usdt - matched
-                if leftover > 0:
-                    buys.insert(0, [leftover, buy_price, buy_fee, buy_time])
-
-    styles = getSampleStyleSheet()
-    small_style = ParagraphStyle(name="small", fontSize=9)
-
-    summary = Paragraph(
-        f"<b>TOTAL PROFIT:</b> ₦{total_profit_ngn:,.2f}<br/>"
-        f"<b>TOTAL BUY FEES:</b> ₦{total_buy_fees_ngn:,.2f}<br/>"
-        f"<b>TRADES:</b> {buy_count} Buys • {sell_count} Sells",
-        small_style
+    CREATE TABLE IF NOT EXISTS pdf_cache (
+        cache_key TEXT PRIMARY KEY,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        data_version INTEGER NOT NULL,
+        file_id TEXT,
+        created_at INTEGER NOT NULL,
+        last_used INTEGER NOT NULL
     )
+    """)
 
-    pdf = SimpleDocTemplate(filename, pagesize=A4)
 
-    table = Table(table_data, repeatRows=1)
-    table.setStyle(TableStyle([
-        ("GRID", (0, 0), (-1, -1), 0.5, colors.black),
-        ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-        ("FONTSIZE", (0, 0), (-1, -1), 8),
-        ("ALIGN", (0, 0), (-1, -1), "CENTER"),
-    ]))
+def _migration_5_backdated_version(c):
+    # Second counter for changes at or before the ledger's high-water mark:
+    # only those can alter a period the ledger has already covered
+    c.execute("ALTER TABLE data_version ADD COLUMN backdated INTEGER NOT NULL DEFAULT 0")
+
+    covered = "(SELECT applied_through FROM ledger_state WHERE id = 1)"
+    for event, when in (
+        ("INSERT", f"NEW.completed_at <= {covered}"),
+        ("UPDATE", f"OLD.completed_at <= {covered} OR NEW.completed_at <= {covered}"),
+        ("DELETE", f"OLD.completed_at <= {covered}"),
+    ):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trades_bump_backdated_{event.lower()}
+        AFTER {event} ON trades
+        WHEN {when}
+        BEGIN
+            UPDATE data_version SET backdated = backdated + 1 WHERE id = 1;
+        END
+        """)
+
+    # Balances feed the weekly/monthly reports; ledger progress feeds profit
+    for table, event in (
+        ("daily_balances", "INSERT"), ("daily_balances", "UPDATE"), ("daily_balances", "DELETE"),
+        ("ledger_state", "INSERT"), ("ledger_state", "UPDATE"),
+    ):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS {table}_bump_version_{event.lower()}
+        AFTER {event} ON {table}
+        BEGIN
+            UPDATE data_version SET version = version + 1 WHERE id = 1;
+        END
+        """)
+
+
+def _migration_6_sync_events(c):
+    # Outbox from the standalone sync worker (`profitcal.py syncd`) to the bot
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sync_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at INTEGER NOT NULL,
+        fetched INTEGER NOT NULL DEFAULT 0,
+        inserted INTEGER NOT NULL DEFAULT 0,
+        partial INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        elapsed_s REAL,
+        delivered_at INTEGER
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sync_events_pending ON sync_events (id) WHERE delivered_at IS NULL")
 
-    pdf.build([summary, table])
-    return filename
 
+def _migration_7_sync_requests(c):
+    # /syncnow and /startday from the bot to the external sync worker
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sync_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        requested_at INTEGER NOT NULL,
+        reason TEXT,
+        handled_at INTEGER
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sync_requests_pending ON sync_requests (id) WHERE handled_at IS NULL")
 
-def get_trade_counts(start_ms, end_ms):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    # When the worker plans its next run (for the bot's staleness check), and the request it answered
+    c.execute("ALTER TABLE sync_events ADD COLUMN next_at INTEGER")
+    c.execute("ALTER TABLE sync_events ADD COLUMN request_id INTEGER")
 
-    # COUNT BUYS
-    c.execute("""
-        SELECT COUNT(*) FROM trades
-        WHERE side = 0 AND completed_at BETWEEN ? AND ?
-    """, (start_ms, end_ms))
-    buy_count = c.fetchone()[0]
 
-    # COUNT SELLS
+def _migration_8_trade_changes(c):
+    # Where back-dated edits landed, so the ledger (and checkpoints) can
+    # tell they are stale even when the trade count still matches
     c.execute("""
-        SELECT COUNT(*) FROM trades
-        WHERE side = 1 AND completed_at BETWEEN ? AND ?
-    """, (start_ms, end_ms))
-    sell_count = c.fetchone()[0]
+    CREATE TABLE IF NOT EXISTS trade_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        completed_at INTEGER NOT NULL
+    )
+    """)
 
-    conn.close()
-    return buy_count, sell_count
+    covered = """MAX(
+        COALESCE((SELECT applied_through FROM ledger_state WHERE id = 1), -1),
+        COALESCE((SELECT MAX(taken_at) FROM inventory_checkpoints), -1)
+    )"""
+    for event, when, at in (
+        ("INSERT", f"NEW.completed_at <= {covered}", "NEW.completed_at"),
+        ("UPDATE OF side, amount, price, fee, completed_at",
+         f"OLD.completed_at <= {covered} OR NEW.completed_at <= {covered}",
+         "MIN(OLD.completed_at, NEW.completed_at)"),
+        ("DELETE", f"OLD.completed_at <= {covered}", "OLD.completed_at"),
+    ):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trades_log_change_{event.split()[0].lower()}
+        AFTER {event} ON trades
+        WHEN {when}
+        BEGIN
+            INSERT INTO trade_changes (completed_at) VALUES ({at});
+        END
+        """)
+
+    # Last trade_changes.seq the ledger reflects; -1 rebuilds it once
+    c.execute("ALTER TABLE ledger_state ADD COLUMN change_seq INTEGER NOT NULL DEFAULT -1")
+
+
+def _migration_9_checkpoint_changes(c):
+    # Last trade_changes.seq each checkpoint reflects
+    c.execute("ALTER TABLE inventory_checkpoints ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0")
+
+    # Older checkpoints were only validated by trade count: drop them and
+    # rebuild the ledger from scratch once; the checkpoint job makes new ones
+    c.execute("DELETE FROM inventory_checkpoints")
+    c.execute("UPDATE ledger_state SET change_seq = -1")
+
+
+def _migration_10_resync_requests(c):
+    # /resync in external mode: the worker rewinds its watermark to this date first
+    c.execute("ALTER TABLE sync_requests ADD COLUMN resync_from INTEGER")
+
+
+MIGRATIONS = [
+    _migration_1_base_schema,
+    _migration_2_typed_trades,
+    _migration_3_covering_indexes,
+    _migration_4_data_version,
+    _migration_5_backdated_version,
+    _migration_6_sync_events,
+    _migration_7_sync_requests,
+    _migration_8_trade_changes,
+    _migration_9_checkpoint_changes,
+    _migration_10_resync_requests,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate_db(conn):
+    """Apply pending migrations in order, each in its own transaction."""
+    c = conn.cursor()
+    c.execute("PRAGMA user_version")
+    version = c.fetchone()[0]
 
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        c.execute("BEGIN")
+        try:
+            migration(c)
+            c.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        log.info("Database migrated to schema version %d", number)
 
+    return max(version, SCHEMA_VERSION)
 
-async def summary_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # User must type a number
-    if not context.args:
-        return await update.message.reply_text("Usage: /summarydays <number_of_days>")
 
-    try:
-        days = int(context.args[0])
-        if days <= 0 or days > 365:
-            return await update.message.reply_text("Enter a value between 1 and 365 days.")
-    except:
-        return await update.message.reply_text("Invalid number.")
+def init_db():
+    with db.writer() as conn:
+        c = conn.cursor()
 
-    now = datetime.now()
-    start = now - timedelta(days=days)
-    start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        migrate_db(conn)
+        refresh_ledger(conn)
 
-    start_ms = int(start.timestamp() * 1000)
-    end_ms = int(now.timestamp() * 1000)
+        # Existing databases: fill the rollup once
+        c.execute("SELECT EXISTS (SELECT 1 FROM daily_rollup)")
+        if not c.fetchone()[0]:
+            refresh_daily_rollup(conn)
 
-    # ==== GET BUY TOTALS ====
-    conn = sqlite3.connect(DB_NAME)
+
+
+def get_data_version(conn):
     c = conn.cursor()
+    c.execute("SELECT version FROM data_version WHERE id = 1")
+    row = c.fetchone()
+    return row[0] if row else 0
 
-    c.execute("""
-        SELECT amount FROM trades
-        WHERE side = 0 AND completed_at BETWEEN ? AND ?
-    """, (start_ms, end_ms))
-    buys_rows = c.fetchall()
-    buys = sum([row[0] for row in buys_rows])
 
-    # ==== GET SELL TOTALS ====
-    c.execute("""
-        SELECT amount FROM trades
-        WHERE side = 1 AND completed_at BETWEEN ? AND ?
-    """, (start_ms, end_ms))
-    sells_rows = c.fetchall()
-    sells = sum([row[0] for row in sells_rows])
+def get_current_day_range():
+    with db.reader() as conn:
+        c = conn.cursor()
 
-    conn.close()
+        c.execute("""
+            SELECT started_at, COALESCE(ended_at, strftime('%s','now')*1000)
+            FROM trading_day
+            ORDER BY id DESC
+            LIMIT 1
+        """)
+        row = c.fetchone()
 
-    # ==== SIMPLE SPREAD PROFIT ====
-    profit = calculate_simple_spread_profit(start_ms, end_ms)
+    return row if row else (None, None)
 
-    # ==== SEND RESULT ====
-    await update.message.reply_text(
-        f"""
-📊 <b>Summary of the last {days} days</b>
 
-💰 Bought: ₦{buys:,.2f}
-💵 Sold: ₦{sells:,.2f}
-📈 Profit (Spread): ₦{profit:,.2f}
-""",
-        parse_mode="HTML"
-    )
+# ========================= SYNC STATE =========================
+def get_sync_watermark(status=SYNC_STATUS, token=SYNC_TOKEN, fiat=SYNC_FIAT):
+    with db.reader() as conn:
+        c = conn.cursor()
 
+        c.execute("""
+            SELECT last_update_ms FROM sync_state
+            WHERE status = ? AND token = ? AND fiat = ?
+        """, (status, token, fiat))
+        row = c.fetchone()
 
-async def yesterday(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.now()
+    return row[0] if row else None
 
-    # Yesterday range
-    start = (now - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-    end = (now - timedelta(days=1)).replace(hour=23, minute=59, second=59, microsecond=0)
 
-    start_ms = int(start.timestamp() * 1000)
-    end_ms = int(end.timestamp() * 1000)
+def set_sync_watermark(last_update_ms, status=SYNC_STATUS, token=SYNC_TOKEN, fiat=SYNC_FIAT):
+    with db.writer() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO sync_state (status, token, fiat, last_update_ms, synced_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (status, token, fiat, int(last_update_ms), int(time.time() * 1000)))
 
-    # ==== BUY TOTAL ====
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
 
-    c.execute("""
-        SELECT amount FROM trades
-        WHERE side = 0 AND completed_at BETWEEN ? AND ?
-    """, (start_ms, end_ms))
-    buys = sum([row[0] for row in c.fetchall()])
+def rewind_sync_watermark(start_ms):
+    # Overlap is subtracted on the next sync, so add it back to land on the date
+    set_sync_watermark(start_ms + SYNC_OVERLAP_MINUTES * 60 * 1000)
 
-    # ==== SELL TOTAL ====
-    c.execute("""
-        SELECT amount FROM trades
-        WHERE side = 1 AND completed_at BETWEEN ? AND ?
-    """, (start_ms, end_ms))
-    sells = sum([row[0] for row in c.fetchall()])
 
-    conn.close()
+def get_sync_begin_ms(status=SYNC_STATUS, token=SYNC_TOKEN, fiat=SYNC_FIAT):
+    """
+    Start of the next sync window: watermark minus overlap,
+    or SYNC_START_DATE if this stream has never been synced.
+    """
+    watermark = get_sync_watermark(status, token, fiat)
+    if watermark is None:
+        start = datetime.strptime(SYNC_START_DATE, "%Y-%m-%d")
+        return int(start.timestamp() * 1000)
 
-    # ==== PROFIT ====
-    profit = calculate_simple_spread_profit(start_ms, end_ms)
+    return max(0, watermark - SYNC_OVERLAP_MINUTES * 60 * 1000)
 
-    await update.message.reply_text(
-        f"""
-📊 <b>YESTERDAY'S SUMMARY</b>
 
-🗓 Date: {start.strftime('%Y-%m-%d')}
+# ========================= LEDGER =========================
+LEDGER_CHUNK = 1000   # matched lots buffered per executemany
+FIFO_VECTORIZED = HAVE_NUMPY and os.getenv("FIFO_VECTORIZED", "1") == "1"   # numpy engine for bulk replays
 
-💰 Bought: ₦{buys:,.2f}
-💵 Sold: ₦{sells:,.2f}
-📈 Profit (Spread): ₦{profit:,.2f}
-""",
-        parse_mode="HTML"
-    )
+LEDGER_TRADES_SQL = """
+    SELECT id, side, amount, price, fee, completed_at
+    FROM trades
+    WHERE completed_at > ?
+    ORDER BY completed_at ASC, id ASC
+"""
 
+MATCHED_LOTS_INSERT_SQL = """
+    INSERT INTO matched_lots (
+        buy_id, sell_id, buy_time, sell_time, qty,
+        buy_price, sell_price, fee_ngn, net_profit
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
 
 
+def _matched_row(m):
+    return (m.buy_id, m.sell_id, m.buy_time, m.sell_time, m.qty,
+            m.buy_price, m.sell_price, m.fee_ngn, m.net_profit)
 
 
-def sync_completed_orders():
-    BUY_FEE_RATE = 0.00275
+def _lot_row(lot):
+    # Same order as Lot(); picklable for the process pool
+    return (lot.qty, lot.price, lot.fee, lot.time, lot.trade_id)
 
-    def safe_float(x, default=0.0):
-        try:
-            return float(str(x).replace(",", "").strip())
-        except:
-            return default
 
-    def safe_int(x, default=0):
-        try:
-            return int(x)
-        except:
-            try:
-                return int(float(x))
-            except:
-                return default
+def _load_open_lots(c):
+    c.execute("SELECT qty, price, fee, buy_time, buy_id FROM open_inventory ORDER BY seq")
+    return FifoMatcher(Lot(*row) for row in c.fetchall())
+
 
-    conn = sqlite3.connect(DB_NAME)
+def _replay_into_ledger(conn, matcher, after_ms):
+    """
+    Feed trades completed after `after_ms` through matcher, appending
+    matched lots as they close. Returns (last completed_at, rows seen).
+    """
     c = conn.cursor()
+    w = conn.cursor()
+    last_ms = after_ms
+    seen = 0
+    pending = []
 
-    START_DATE = datetime(2026, 1, 1)  # 🔁 change year if needed
-    begin_ms = int(START_DATE.timestamp() * 1000)
-    now_ms = int(time.time() * 1000)
+    def flush():
+        w.executemany(MATCHED_LOTS_INSERT_SQL, [_matched_row(m) for m in pending])
+        pending.clear()
 
+    c.execute(LEDGER_TRADES_SQL, (after_ms,))
+    for trade_id, side, qty, price, fee, ts in stream_rows(c):
+        seen += 1
+        last_ms = ts
+        pending.extend(matcher.feed(side, qty, price, fee, ts, trade_id))
+        if len(pending) >= LEDGER_CHUNK:
+            flush()
 
-    new_count = 0
+    flush()
+    return last_ms, seen
 
-    for order in fetch_orders_simplify_list(begin_ms, now_ms, status=50):
 
-        order_id = str(order.get("id") or order.get("orderId") or "")
-        if not order_id:
-            continue
+def _latest_change_seq(c):
+    c.execute("SELECT COALESCE(MAX(seq), 0) FROM trade_changes")
+    return c.fetchone()[0]
 
-        c.execute("SELECT 1 FROM trades WHERE id=?", (order_id,))
-        if c.fetchone():
-            continue
 
-        if order.get("currencyId") != "NGN":
-            continue
-        if order.get("tokenId") != "USDT":
-            continue
+def _save_ledger_state(conn, matcher, applied_through, trade_count, change_seq):
+    c = conn.cursor()
 
-        status = safe_int(order.get("status"))
-        if status != 50:
-            continue
+    c.execute("DELETE FROM open_inventory")
+    c.executemany("""
+        INSERT INTO open_inventory (seq, buy_id, qty, price, fee, buy_time)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [
+        (i, lot.trade_id, lot.qty, lot.price, lot.fee, lot.time)
+        for i, lot in enumerate(matcher.lots)
+    ])
 
-        side = safe_int(order.get("side", 0))
-        fiat_amount = safe_float(order.get("amount"))
-        price = safe_float(order.get("price"))
+    c.execute("""
+        INSERT OR REPLACE INTO ledger_state (id, applied_through, trade_count, change_seq, updated_at)
+        VALUES (1, ?, ?, ?, ?)
+    """, (applied_through, trade_count, change_seq, int(time.time() * 1000)))
 
-        raw_crypto = safe_float(
-            order.get("notifyTokenQuantity")
-            or order.get("tokenQuantity")
-            or order.get("tokenAmount")
-            or 0
-        )
 
-        # ✅ VERY IMPORTANT:
-        # ✅ STORE FULL USDT — DO NOT REMOVE BUY FEE HERE
-        crypto_amount = raw_crypto
+def _bump_backdated(c):
+    # A rebuild rewrites matched lots inside periods reports may have cached
+    c.execute("UPDATE data_version SET backdated = backdated + 1 WHERE id = 1")
 
-        fee = crypto_amount * BUY_FEE_RATE if side == 0 else 0.0
 
-        counterparty = order.get("targetNickName", "") or order.get("targetUserId", "")
+@metrics.timed("fifo_seconds", op="rebuild_ledger")
+def rebuild_ledger(conn, full=False):
+    """
+    Replay trades into the ledger, starting from the newest still-valid
+    inventory checkpoint (or from scratch if there is none, or `full`).
+    Needed after back-dated or edited trades. Returns trades replayed.
+    """
+    with write_transaction(conn):
+        checkpoint = None if full else find_inventory_checkpoint(conn, prune=True)
+        c = conn.cursor()
 
-        created_at = safe_int(order.get("createDate", 0))
-        completed_at = safe_int(order.get("updateDate", created_at))
+        if checkpoint is None:
+            c.execute("DELETE FROM matched_lots")
+            matcher, after_ms, base_count = FifoMatcher(), -1, 0
+        else:
+            matcher, after_ms, base_count = checkpoint
+            c.execute("DELETE FROM matched_lots WHERE sell_time > ?", (after_ms,))
 
-        c.execute("""
-            INSERT OR REPLACE INTO trades (
-                id, side, token, amount, fiat_amount, price, fee,
-                counterparty, status, created_at, completed_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            order_id,
-            side,
-            "USDT",
-            crypto_amount,   # ✅ FULL USDT
-            fiat_amount,
-            price,
-            fee,
-            counterparty,
-            50,
-            created_at,
-            completed_at
-        ))
+        last_ms, seen = _replay_into_ledger(conn, matcher, after_ms)
+        _save_ledger_state(conn, matcher, last_ms, base_count + seen, _latest_change_seq(c))
+        _bump_backdated(c)
 
-        new_count += 1
+        refresh_daily_rollup(conn, after_ms)
 
-    conn.commit()
-    conn.close()
-    return new_count
+    return seen
 
 
+@metrics.timed("fifo_seconds", op="update_ledger")
+def update_ledger(conn):
+    """
+    Match trades inserted since the last update against the persisted
+    open lots. If a trade at or before the ledger's high-water mark was
+    inserted, edited or deleted since (see trade_changes), the FIFO order
+    changed: rebuild instead.
+    State is read and written back in one write transaction, so a bot and
+    a sync worker sharing the database never match the same sells twice.
+    """
+    with write_transaction(conn):
+        c = conn.cursor()
+        c.execute("SELECT applied_through, trade_count, change_seq FROM ledger_state WHERE id = 1")
+        state = c.fetchone()
 
+        if state is None:
+            return rebuild_ledger(conn)
 
+        applied_through, trade_count, change_seq = state
+        if _latest_change_seq(c) > change_seq:
+            return rebuild_ledger(conn)
 
+        matcher = _load_open_lots(c)
+        last_ms, seen = _replay_into_ledger(conn, matcher, applied_through)
+        if seen:
+            _save_ledger_state(conn, matcher, last_ms, trade_count + seen, change_seq)
+            refresh_daily_rollup(conn, applied_through)
 
-async def raw(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    now_ms = int(time.time() * 1000)
-    begin_ms = now_ms - (3 * 24 * 60 * 60 * 1000)
+    return seen
 
-    res = _request_bybit("/v5/p2p/order/simplifyList", body={
-        "page": 1,
-        "size": 5,
-        "status": 50,
-        "beginTime": str(begin_ms),
-        "endTime": str(now_ms)
-    })
 
-    await update.message.reply_text(json.dumps(res, indent=2)[:4000])
+def refresh_ledger(conn=None):
+    # Takes the shared writer when called from a worker thread
+    if conn is not None:
+        return update_ledger(conn)
 
+    with db.writer() as conn:
+        return update_ledger(conn)
 
 
+@metrics.timed("fifo_seconds", op="replay_trades")
+def replay_trades(after_ms, lots=()):
+    """
+    Match trades completed after `after_ms`, starting from open `lots`,
+    on a read-only connection so it can run in a worker process.
+    Returns (matched lot rows, open lot rows, last completed_at, rows seen).
+    """
+    if FIFO_VECTORIZED:
+        with db.reader() as conn:
+            return _replay_trades_vectorized(conn, after_ms, [Lot(*lot) for lot in lots])
 
-def fetch_orders_simplify_list(begin_ms, end_ms, status=50, size=30):
-    endpoint = "/v5/p2p/order/simplifyList"
-    size = min(int(size or 30), 30)
-    page = 1
-    seen_ids = set()
-    consecutive_empty = 0
-    max_consecutive_empty = 3
+    matcher = FifoMatcher(Lot(*lot) for lot in lots)
+    matched = []
+    last_ms = after_ms
+    seen = 0
 
-    while True:
-        body = {
-            "page": page,
-            "size": size,
-            "status": status,
-            "beginTime": str(begin_ms),
-            "endTime": str(end_ms),
-        }
+    with db.reader() as conn:
+        for trade_id, side, qty, price, fee, ts in stream_rows(conn.execute(LEDGER_TRADES_SQL, (after_ms,))):
+            seen += 1
+            last_ms = ts
+            matched.extend(_matched_row(m) for m in matcher.feed(side, qty, price, fee, ts, trade_id))
 
-        res = _request_bybit(endpoint, method="POST", body=body)
-        if not res:
-            break
+    return matched, [_lot_row(lot) for lot in matcher.lots], last_ms, seen
 
-        result = res.get("result", {})
-        items = result.get("items") or result.get("list") or []
 
-        if not items:
-            consecutive_empty += 1
-            if consecutive_empty >= max_consecutive_empty:
-                break
-            page += 1
-            continue
+def _replay_trades_vectorized(conn, after_ms, lots):
+    ids = [lot.trade_id for lot in lots]
 
-        consecutive_empty = 0
+    def rows(c):
+        for trade_id, side, qty, price, fee, ts in stream_rows(c):
+            ids.append(trade_id)
+            yield side, qty, price, fee, ts
 
-        for it in items:
-            oid = str(it.get("id") or it.get("orderId") or "")
-            if not oid:
-                continue
-            if oid in seen_ids:
-                continue
-            seen_ids.add(oid)
-            yield it
+    side, qty, price, fee, ts = load_trade_arrays(rows(conn.execute(LEDGER_TRADES_SQL, (after_ms,))), lots)
+    r = match_arrays(side, qty, price, fee)
 
-        if len(items) < size:
-            break
+    buy, sell = r.buy.tolist(), r.sell.tolist()
+    matched = list(zip(
+        [ids[i] for i in buy], [ids[i] for i in sell],
+        ts[r.buy].astype("int64").tolist(), ts[r.sell].astype("int64").tolist(),
+        r.qty.tolist(), price[r.buy].tolist(), price[r.sell].tolist(),
+        r.fee_ngn.tolist(), r.net_profit.tolist(),
+    ))
+    open_lots = [
+        (q, float(price[i]), float(fee[i]), int(ts[i]), ids[i])
+        for i, q in zip(r.open_buys.tolist(), r.open_qty.tolist())
+    ]
 
-        page += 1
-        if page > 1000:
-            break
+    seen = len(ids) - len(lots)
+    last_ms = int(ts[-1]) if seen else after_ms
+    return matched, open_lots, last_ms, seen
 
-def calculate_simple_spread_profit(start_ms, end_ms):
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
 
-    c.execute("""
-        SELECT side, amount, price, fee
-        FROM trades
-        WHERE completed_at BETWEEN ? AND ?
-        ORDER BY completed_at ASC
-    """, (start_ms, end_ms))
+def rebuild_ledger_with_writer(full=False):
+    with db.writer() as conn:
+        return rebuild_ledger(conn, full=full)
 
-    rows = c.fetchall()
-    conn.close()
 
-    buys = []
-    total_profit_ngn = 0.0
+def _ledger_rebuild_start(full):
+    with db.writer() as conn, write_transaction(conn):
+        checkpoint = None if full else find_inventory_checkpoint(conn, prune=True)
+        matcher, after_ms, base_count = checkpoint or (FifoMatcher(), -1, 0)
 
-    for side, usdt, price, fee in rows:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM trades WHERE completed_at > ?", (after_ms,))
+        pending = c.fetchone()[0]
+        change_seq = _latest_change_seq(c)
 
-        # BUY
-        if side == 0:
-            buys.append([usdt, price, fee])
+    return [_lot_row(lot) for lot in matcher.lots], after_ms, base_count, pending, change_seq
 
-        # SELL
-        elif side == 1 and buys:
-            sell_remaining = usdt
-            sell_price = price
 
-            while sell_remaining > 0 and buys:
-                buy_usdt, buy_price, buy_fee = buys.pop(0)
+def _ledger_rebuild_apply(after_ms, base_count, change_seq, matched, lots, last_ms, seen):
+    with db.writer() as conn, write_transaction(conn):
+        c = conn.cursor()
 
-                matched = min(buy_usdt, sell_remaining)
+        # A trade inside the replayed range that committed after the replay's
+        # snapshot was not back-dated yet, so trade_changes missed it
+        c.execute("SELECT COUNT(*) FROM trades WHERE completed_at > ? AND completed_at <= ?", (after_ms, last_ms))
+        if c.fetchone()[0] != seen:
+            return rebuild_ledger(conn, full=after_ms < 0)
 
-                gross_profit = matched * (sell_price - buy_price)
+        c.execute("DELETE FROM matched_lots WHERE sell_time > ?", (after_ms,))
+        c.executemany(MATCHED_LOTS_INSERT_SQL, matched)
+        _save_ledger_state(conn, FifoMatcher(Lot(*lot) for lot in lots), last_ms, base_count + seen, change_seq)
+        _bump_backdated(c)
 
-                # ✅ use stored fee (offline = 0, online = real)
-                fee_ratio = matched / buy_usdt
-                fee_ngn = (buy_fee * fee_ratio) * buy_price
+        refresh_daily_rollup(conn, after_ms)
 
-                net_profit = gross_profit - fee_ngn
-                total_profit_ngn += net_profit
+    return seen
 
-                sell_remaining -= matched
 
-                leftover = buy_usdt - matched
-                if leftover > 0:
-                    buys.insert(0, [leftover, buy_price, buy_fee])
+@metrics.timed("fifo_seconds", op="rebuild_offloaded")
+async def rebuild_ledger_offloaded(full=False):
+    """
+    rebuild_ledger for the event loop. Replays of FIFO_PROCESS_MIN_TRADES
+    or more run in the process pool; the writer is only held to read the
+    starting point and to store the result. Back-dated changes made in
+    between are logged in trade_changes and rebuild on the next update.
+    """
+    lots, after_ms, base_count, pending, change_seq = await db_pool.run(_ledger_rebuild_start, full)
 
-    return round(total_profit_ngn, 2), 0.0
+    if pending < FIFO_PROCESS_MIN_TRADES:
+        return await db_pool.run(rebuild_ledger_with_writer, full)
 
+    matched, lots, last_ms, seen = await cpu_pool.run(replay_trades, after_ms, lots)
+    return await db_pool.run(_ledger_rebuild_apply, after_ms, base_count, change_seq, matched, lots, last_ms, seen)
 
 
+# ========================= INVENTORY CHECKPOINTS =========================
+def _checkpoint_is_valid(c, taken_at, change_seq):
+    # Stale once a trade at or before taken_at was inserted, edited or deleted after the snapshot
+    c.execute("""
+        SELECT NOT EXISTS (
+            SELECT 1 FROM trade_changes WHERE seq > ? AND completed_at <= ?
+        )
+    """, (change_seq, taken_at))
+    return bool(c.fetchone()[0])
 
-async def send_daily_report(context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.now()
 
-    # 🔑 Get user-defined trading day range
-    start_ms, end_ms = get_current_day_range()
+def find_inventory_checkpoint(conn, before_ms=None, prune=False):
+    """
+    Newest valid checkpoint strictly before `before_ms` (or at all) as
+    (FifoMatcher, taken_at, trade_count), or None. With prune=True
+    (writer connection only) checkpoints invalidated by back-dated
+    trades are dropped on the way.
+    """
+    c = conn.cursor()
 
-    if not start_ms:
-        await context.bot.send_message(
-            chat_id=CHAT_ID,
-            text="❌ Trading day not started. Use /startday"
-        )
-        return  # ✅ STOP HERE if no day started
+    if before_ms is None:
+        c.execute("""
+            SELECT id, taken_at, trade_count, change_seq, lots FROM inventory_checkpoints
+            ORDER BY taken_at DESC
+        """)
+    else:
+        c.execute("""
+            SELECT id, taken_at, trade_count, change_seq, lots FROM inventory_checkpoints
+            WHERE taken_at < ?
+            ORDER BY taken_at DESC
+        """, (before_ms,))
+
+    stale = []
+    found = None
+
+    for cp_id, taken_at, trade_count, change_seq, lots in c.fetchall():
+        if _checkpoint_is_valid(c, taken_at, change_seq):
+            matcher = FifoMatcher(Lot(*lot) for lot in json.loads(lots))
+            found = (matcher, taken_at, trade_count)
+            break
+        stale.append((cp_id,))
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    if stale and prune:
+        with write_transaction(conn):
+            c.executemany("DELETE FROM inventory_checkpoints WHERE id = ?", stale)
 
-    # USDT bought
-    c.execute("""
-        SELECT COALESCE(SUM(amount), 0)
-        FROM trades
-        WHERE side = 0 AND completed_at BETWEEN ? AND ?
-    """, (start_ms, end_ms))
-    buys = c.fetchone()[0]
+    return found
 
-    # USDT sold
-    c.execute("""
-        SELECT COALESCE(SUM(amount), 0)
-        FROM trades
-        WHERE side = 1 AND completed_at BETWEEN ? AND ?
-    """, (start_ms, end_ms))
-    sells = c.fetchone()[0]
 
-    conn.close()
+def take_inventory_checkpoint(conn=None):
+    """
+    Snapshot the ledger's open lots at its high-water mark.
+    Returns taken_at, or None if there is nothing to snapshot yet.
+    """
+    if conn is None:
+        with db.writer() as conn:
+            return take_inventory_checkpoint(conn)
+
+    with write_transaction(conn):
+        update_ledger(conn)
 
-    # Profit
-    profit_ngn, profit_usdt = calculate_simple_spread_profit(start_ms, end_ms)
+        c = conn.cursor()
+        c.execute("SELECT applied_through, trade_count, change_seq FROM ledger_state WHERE id = 1")
+        state = c.fetchone()
+        if not state or state[1] == 0:
+            return None
 
-    # Trade counts
-    buy_count, sell_count = get_trade_counts(start_ms, end_ms)
+        taken_at, trade_count, change_seq = state
+        c.execute("SELECT qty, price, fee, buy_time, buy_id FROM open_inventory ORDER BY seq")
+        lots = json.dumps(c.fetchall())
 
-    msg = f"""
-📊 <b>DAILY P2P REPORT</b>
+        c.execute("""
+            INSERT OR REPLACE INTO inventory_checkpoints (taken_at, trade_count, change_seq, lots, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (taken_at, trade_count, change_seq, lots, int(time.time() * 1000)))
 
-⏱ Period:
-{datetime.fromtimestamp(start_ms/1000).strftime('%Y-%m-%d %H:%M')}
-→ {datetime.fromtimestamp(end_ms/1000).strftime('%Y-%m-%d %H:%M')}
+        # Changes the ledger and every checkpoint have already absorbed
+        c.execute("""
+            DELETE FROM trade_changes
+            WHERE seq <= MIN(?, (SELECT MIN(change_seq) FROM inventory_checkpoints))
+        """, (change_seq,))
 
-💰 Bought: {buys:,.2f} USDT
-💵 Sold: {sells:,.2f} USDT
+    return taken_at
 
-🔄 Trades:
-• {buy_count} Buys
-• {sell_count} Sells
 
-📈 Profit (NGN): ₦{profit_ngn:,.2f}
-💎 Profit (USDT): {profit_usdt:,.4f} USDT
+WINDOW_TRADES_SQL = """
+    SELECT side, amount, price, fee, completed_at
+    FROM trades
+    WHERE completed_at > ? AND completed_at <= ?
+    ORDER BY completed_at ASC, id ASC
 """
 
-    await context.bot.send_message(
-        chat_id=CHAT_ID,
-        text=msg,
-        parse_mode="HTML"
-    )
 
-def get_day_range_by_date(date_str: str):
+def replay_fifo_window(conn, start_ms, end_ms):
     """
-    Returns (start_ms, end_ms) for a trading day based on manual open/close.
-    date_str format: YYYY-MM-DD
+    Yield MatchedLots for sells completed in [start_ms, end_ms].
+    Starts from the nearest checkpoint before the window with its carried
+    lots, so only trades between that checkpoint and end_ms are replayed.
     """
-    conn = sqlite3.connect(DB_NAME)
+    checkpoint = find_inventory_checkpoint(conn, before_ms=start_ms)
+    matcher, after_ms, _ = checkpoint or (FifoMatcher(), -1, 0)
+
     c = conn.cursor()
+    c.execute(WINDOW_TRADES_SQL, (after_ms, end_ms))
 
-    c.execute("""
-        SELECT opening_balance, closing_balance
-        FROM daily_balances
-        WHERE date = ?
-    """, (date_str,))
+    for m in match_trades(stream_rows(c), matcher):
+        if m.sell_time >= start_ms:
+            yield m
 
-    row = c.fetchone()
-    conn.close()
 
-    if not row:
-        return None, None
+@metrics.timed("fifo_seconds", op="window_totals")
+def window_totals(conn, start_ms, end_ms):
+    """
+    (profit_ngn, buy_fees_ngn, matched lots) for sells completed in
+    [start_ms, end_ms], vectorized when numpy is available. Trades are
+    matched in fixed-size chunks, so memory does not grow with the window.
+    """
+    if not FIFO_VECTORIZED:
+        profit = fees = 0.0
+        count = 0
+        for m in replay_fifo_window(conn, start_ms, end_ms):
+            profit += m.net_profit
+            fees += m.fee_ngn
+            count += 1
+        return profit, fees, count
+
+    checkpoint = find_inventory_checkpoint(conn, before_ms=start_ms)
+    matcher, after_ms, _ = checkpoint or (FifoMatcher(), -1, 0)
+
+    c = conn.cursor()
+    c.execute(WINDOW_TRADES_SQL, (after_ms, end_ms))
 
-    # Trading day runs from 00:00 to 23:59 *of that date*
-    # BUT it is ONLY valid if the day was CLOSED manually
-    start = datetime.strptime(date_str, "%Y-%m-%d").replace(
+    profit = fees = 0.0
+    count = 0
+    for r, (side, qty, price, fee, ts) in iter_array_matches(stream_rows(c), matcher.lots):
+        in_window = ts[r.sell] >= start_ms
+        profit += float(r.net_profit[in_window].sum())
+        fees += float(r.fee_ngn[in_window].sum())
+        count += int(in_window.sum())
+
+    return profit, fees, count
+
+
+# ========================= DAILY ROLLUP =========================
+@metrics.timed("report_seconds", op="refresh_daily_rollup")
+def refresh_daily_rollup(conn, from_ms=0):
+    """
+    Recompute daily_rollup for the local date of `from_ms` and every date
+    after it, from trades (volumes, counts, fees) and matched_lots (profit).
+    Called with the ledger's previous high-water mark, this only touches
+    the day(s) that just received trades.
+    """
+    day = datetime.fromtimestamp(max(from_ms, 0) / 1000).replace(
         hour=0, minute=0, second=0, microsecond=0
     )
-    end = start.replace(hour=23, minute=59, second=59, microsecond=999000)
-
-    return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+    day_ms = int(day.timestamp() * 1000)
+    day_str = day.strftime("%Y-%m-%d")
+    now_ms = int(time.time() * 1000)
 
+    with write_transaction(conn):
+        c = conn.cursor()
+        c.execute("DELETE FROM daily_rollup WHERE date >= ?", (day_str,))
 
+        c.execute("""
+            INSERT INTO daily_rollup (
+                date, buy_usdt, sell_usdt, buy_fiat, sell_fiat,
+                buy_count, sell_count, fee_usdt, fee_ngn, profit_ngn, updated_at
+            )
+            SELECT
+                date(completed_at / 1000, 'unixepoch', 'localtime') AS day,
+                TOTAL(CASE WHEN side = 0 THEN amount END),
+                TOTAL(CASE WHEN side = 1 THEN amount END),
+                TOTAL(CASE WHEN side = 0 THEN fiat_amount END),
+                TOTAL(CASE WHEN side = 1 THEN fiat_amount END),
+                COUNT(CASE WHEN side = 0 THEN 1 END),
+                COUNT(CASE WHEN side = 1 THEN 1 END),
+                TOTAL(fee),
+                0, 0, ?
+            FROM trades
+            WHERE completed_at >= ?
+            GROUP BY day
+        """, (now_ms, day_ms))
 
-async def send_weekly_report(context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.now()
-    week_ago = now - timedelta(days=7)
+        c.execute("""
+            SELECT date(sell_time / 1000, 'unixepoch', 'localtime') AS day,
+                   TOTAL(fee_ngn), TOTAL(net_profit)
+            FROM matched_lots
+            WHERE sell_time >= ?
+            GROUP BY day
+        """, (day_ms,))
+        c.executemany("""
+            UPDATE daily_rollup SET fee_ngn = ?, profit_ngn = ?
+            WHERE date = ?
+        """, [(fee_ngn, profit, d) for d, fee_ngn, profit in c.fetchall()])
+
+
+@metrics.timed("report_seconds", op="rollup_closed_days")
+def rollup_closed_days(since_date: str):
+    """
+    Totals over closed trading days (closing balance recorded) since
+    `since_date`, read from daily_rollup. Returns (days, totals).
+    """
+    with db.reader() as conn:
+        c = conn.cursor()
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+        c.execute("""
+            SELECT date FROM daily_balances
+            WHERE closing_balance IS NOT NULL
+            AND date >= ?
+            ORDER BY date ASC
+        """, (since_date,))
+        days = [row[0] for row in c.fetchall()]
 
-    # Get trading days closed in last 7 days
-    c.execute("""
-        SELECT date FROM daily_balances
-        WHERE closing_balance IS NOT NULL
-        AND date >= ?
-        ORDER BY date ASC
-    """, (week_ago.strftime("%Y-%m-%d"),))
+        c.execute("""
+            SELECT TOTAL(r.buy_usdt), TOTAL(r.sell_usdt),
+                   TOTAL(r.buy_count), TOTAL(r.sell_count),
+                   TOTAL(r.profit_ngn)
+            FROM daily_balances b
+            JOIN daily_rollup r ON r.date = b.date
+            WHERE b.closing_balance IS NOT NULL
+            AND b.date >= ?
+        """, (since_date,))
+        buys, sells, buy_count, sell_count, profit_ngn = c.fetchone()
+
+    return days, {
+        "buys": buys,
+        "sells": sells,
+        "buy_count": int(buy_count),
+        "sell_count": int(sell_count),
+        "profit_ngn": round(profit_ngn, 2),
+        "profit_usdt": 0.0,
+    }
 
-    days = [row[0] for row in c.fetchall()]
-    conn.close()
 
-    if not days:
-        await context.bot.send_message(
-            chat_id=CHAT_ID,
-            text="❌ No completed trading days in the last 7 days."
-        )
-        return
+# ========================= SIGNATURE =========================
+def _bybit_sign(body_str: str, ts_ms: str, recv_window: str) -> str:
+    payload = f"{ts_ms}{API_KEY}{recv_window}{body_str}"
+    return hmac.new(API_SECRET.encode("utf-8"), payload.encode("utf-8"), hashlib.sha256).hexdigest()
 
-    total_buys = total_sells = 0.0
-    total_profit_ngn = total_profit_usdt = 0.0
-    total_buy_count = total_sell_count = 0
 
-    for day in days:
-        start_ms, end_ms = get_day_range_by_date(day)
+# ========================= BYBIT API =========================
+def _bybit_headers(body_str: str) -> dict:
+    ts_ms = str(int(time.time() * 1000))
+    recv_window = "5000"
+    sign = _bybit_sign(body_str, ts_ms, recv_window)
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
+    return {
+        "X-BAPI-API-KEY": API_KEY,
+        "X-BAPI-TIMESTAMP": ts_ms,
+        "X-BAPI-RECV-WINDOW": recv_window,
+        "X-BAPI-SIGN": sign,
+        "Content-Type": "application/json"
+    }
 
-        c.execute("""
-            SELECT COALESCE(SUM(amount), 0)
-            FROM trades
-            WHERE side = 0 AND completed_at BETWEEN ? AND ?
-        """, (start_ms, end_ms))
-        total_buys += c.fetchone()[0]
 
-        c.execute("""
-            SELECT COALESCE(SUM(amount), 0)
-            FROM trades
-            WHERE side = 1 AND completed_at BETWEEN ? AND ?
-        """, (start_ms, end_ms))
-        total_sells += c.fetchone()[0]
+def _observe_bybit(endpoint, started, ret_code):
+    # One sample per HTTP attempt, so retries show up as extra requests
+    metrics.observe("bybit_request_seconds", time.perf_counter() - started, endpoint=endpoint)
+    metrics.inc("bybit_requests_total", endpoint=endpoint, ret_code=ret_code)
 
-        conn.close()
 
-        buy_count, sell_count = get_trade_counts(start_ms, end_ms)
-        total_buy_count += buy_count
-        total_sell_count += sell_count
+class BybitAPIError(Exception):
+    def __init__(self, message, ret_code=None, http_status=None):
+        super().__init__(message)
+        self.ret_code = ret_code
+        self.http_status = http_status
 
-        profit_ngn, profit_usdt = calculate_simple_spread_profit(start_ms, end_ms)
-        total_profitprofit_ngn += profit_ngn
-        total_profit_usdt += profit_usdt
 
-    msg = f"""
-📊 <b>WEEKLY P2P REPORT</b>
-📅 Trading days: {len(days)}
+class CircuitOpenError(BybitAPIError):
+    pass
 
-💰 Bought: {total_buys:,.2f} USDT
-💵 Sold: {total_sells:,.2f} USDT
 
-🔄 Trades:
-• {total_buy_count} Buys
-• {total_sell_count} Sells
+class TokenBucket:
+    """
+    Async token bucket; also honours Bybit's X-Bapi-Limit-* headers
+    by pausing until the server-side window resets.
+    """
 
-📈 Profit (NGN): ₦{total_profit_ngn:,.2f}
-💎 Profit (USDT): {total_profit_usdt:,.4f} USDT
-"""
+    def __init__(self, rate=BYBIT_RATE_LIMIT, burst=BYBIT_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
 
-    await context.bot.send_message(chat_id=CHAT_ID, text=msg, parse_mode="HTML")
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
 
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
 
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
 
-async def send_monthly_report(context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.now()
-    month_start = now.replace(day=1).strftime("%Y-%m-%d")
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
 
-    c.execute("""
-        SELECT date FROM daily_balances
-        WHERE closing_balance IS NOT NULL
-        AND date >= ?
-        ORDER BY date ASC
-    """, (month_start,))
+    def observe(self, headers):
+        remaining = headers.get("X-Bapi-Limit-Status")
+        reset_ms = headers.get("X-Bapi-Limit-Reset-Timestamp")
+        if remaining is None or reset_ms is None:
+            return
 
-    days = [row[0] for row in c.fetchall()]
-    conn.close()
+        try:
+            remaining = int(remaining)
+            wait = int(reset_ms) / 1000 - time.time()
+        except ValueError:
+            return
+
+        if remaining <= 0 and wait > 0:
+            self.pause(min(wait, BYBIT_BACKOFF_MAX))
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=BYBIT_BREAKER_THRESHOLD, cooldown=BYBIT_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def check(self):
+        if self.opened_at is None:
+            return
+        remaining = self.opened_at + self.cooldown - time.monotonic()
+        if remaining > 0:
+            raise CircuitOpenError(f"Bybit circuit open, retry in {remaining:.0f}s")
+        # Half-open: let one attempt through, the next failure re-opens it
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                log.warning("Bybit circuit opened after %d failures", self.failures)
+            self.opened_at = time.monotonic()
+
+
+class BybitClient:
+    """
+    Non-blocking Bybit client over one pooled keep-alive connection set.
+    Requests are signed by _bybit_headers; safe to await from handlers and jobs.
+    Requests are rate limited, retried with jittered backoff on throttling
+    and transient errors, and short-circuited while Bybit keeps failing.
+    """
 
-    if not days:
-        await context.bot.send_message(
-            chat_id=CHAT_ID,
-            text="❌ No completed trading days this month."
+    def __init__(self, base_url=BASE_URL, timeout=BYBIT_TIMEOUT,
+                 connect_timeout=BYBIT_CONNECT_TIMEOUT, max_connections=BYBIT_MAX_CONNECTIONS,
+                 max_retries=BYBIT_MAX_RETRIES):
+        self.base_url = base_url
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
         )
-        return
+        self.max_retries = max_retries
+        self.bucket = TokenBucket()
+        self.breaker = CircuitBreaker()
+        self._http = None
+
+    def _client(self):
+        # Created lazily so it binds to the loop that actually runs the bot
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=self.timeout,
+                limits=self.limits,
+            )
+        return self._http
+
+    async def request(self, endpoint: str, body: dict | None = None):
+        """
+        Signed POST returning the decoded response.
+        Raises BybitAPIError once retries are exhausted, CircuitOpenError
+        while the breaker is open. Non-retryable retCodes are returned as-is.
+        """
+        body = body or {}
+        body_str = json.dumps(body, separators=(",", ":"))
+        ret_code = http_status = None
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.breaker.check()
+            except CircuitOpenError:
+                metrics.inc("bybit_circuit_open_total", endpoint=endpoint)
+                raise
+            await self.bucket.acquire()
 
-    total_buys = total_sells = 0.0
-    total_profit_ngn = total_profit_usdt = 0.0
-    total_buy_count = total_sell_count = 0
+            # Re-sign every attempt so the timestamp stays inside recv_window
+            headers = _bybit_headers(body_str)
+            retry_after = 0.0
+            started = time.perf_counter()
 
-    for day in days:
-        start_ms, end_ms = get_day_range_by_date(day)
+            try:
+                resp = await self._client().post(endpoint, content=body_str, headers=headers)
+            except httpx.HTTPError as e:
+                reason = f"{type(e).__name__}: {e}"
+                outcome = type(e).__name__
+            else:
+                self.bucket.observe(resp.headers)
+                http_status = resp.status_code
+
+                if http_status in (403, 429) or http_status >= 500:
+                    reason = f"HTTP {http_status}"
+                    outcome = f"http_{http_status}"
+                    retry_after = safe_float(resp.headers.get("Retry-After"), 0.0)
+                else:
+                    try:
+                        data = resp.json()
+                    except ValueError:
+                        data = None
+
+                    ret_code = data.get("retCode") if isinstance(data, dict) else None
+                    outcome = ret_code if data is not None else "invalid_json"
+                    if data is None:
+                        reason = f"invalid JSON (HTTP {http_status})"
+                    elif ret_code in BYBIT_RETRY_CODES:
+                        reason = f"retCode {ret_code}: {data.get('retMsg', '')}"
+                    else:
+                        _observe_bybit(endpoint, started, outcome)
+                        self.breaker.record_success()
+                        return data
+
+            _observe_bybit(endpoint, started, outcome)
+            self.breaker.record_failure()
+
+            if attempt == self.max_retries:
+                break
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
+            delay = random.uniform(0, min(BYBIT_BACKOFF_MAX, BYBIT_BACKOFF_BASE * 2 ** attempt))
+            delay = max(delay, retry_after)
+            log.warning("Bybit %s attempt %d failed (%s), retrying in %.1fs",
+                        endpoint, attempt + 1, reason, delay)
+            await asyncio.sleep(delay)
 
-        c.execute("""
-            SELECT COALESCE(SUM(amount), 0)
-            FROM trades
-            WHERE side = 0 AND completed_at BETWEEN ? AND ?
-        """, (start_ms, end_ms))
-        total_buys += c.fetchone()[0]
+        raise BybitAPIError(
+            f"{endpoint} failed after {self.max_retries + 1} attempts: {reason}",
+            ret_code=ret_code,
+            http_status=http_status,
+        )
 
-        c.execute("""
-            SELECT COALESCE(SUM(amount), 0)
-            FROM trades
-            WHERE side = 1 AND completed_at BETWEEN ? AND ?
-        """, (start_ms, end_ms))
-        total_sells += c.fetchone()[0]
+    async def iter_order_pages(self, begin_ms, end_ms, status=50, size=30):
+        """
+        Yield each simplifyList page as a list of not-yet-seen orders.
+        An empty page before the end of the list is retried; if it stays
+        empty, or the walk passes BYBIT_MAX_PAGES, BybitAPIError is raised
+        so callers keep their watermark / backfill window open.
+        """
+        endpoint = "/v5/p2p/order/simplifyList"
+        size = min(int(size or 30), 30)
+        page = 1
+        seen_ids = set()
+        empty_retries = 0
+
+        while True:
+            body = {
+                "page": page,
+                "size": size,
+                "status": status,
+                "beginTime": str(begin_ms),
+                "endTime": str(end_ms),
+            }
+
+            res = await self.request(endpoint, body)
+            if res.get("retCode", 0) != 0:
+                raise BybitAPIError(
+                    f"{endpoint} page {page}: retCode {res.get('retCode')} {res.get('retMsg', '')}",
+                    ret_code=res.get("retCode"),
+                )
+
+            result = res.get("result") or {}
+            items = result.get("items") or result.get("list") or []
+
+            if not items:
+                try:
+                    total = int(result["count"])
+                except (KeyError, TypeError, ValueError):
+                    total = None
+
+                # Past the end, or a list that ends exactly on a page boundary
+                if (total is not None and (page - 1) * size >= total) or (total is None and page == 1):
+                    break
+
+                if empty_retries == self.max_retries:
+                    if total is None:
+                        break   # a full page, then nothing however often we ask: the end
+                    raise BybitAPIError(
+                        f"{endpoint} page {page}: still empty after {empty_retries + 1} attempts, "
+                        f"{total} orders listed"
+                    )
+
+                delay = random.uniform(0, min(BYBIT_BACKOFF_MAX, BYBIT_BACKOFF_BASE * 2 ** empty_retries))
+                empty_retries += 1
+                log.warning("Bybit %s page %d came back empty, retrying in %.1fs", endpoint, page, delay)
+                await asyncio.sleep(delay)
+                continue
 
-        conn.close()
+            empty_retries = 0
 
-        buy_count, sell_count = get_trade_counts(start_ms, end_ms)
-        total_buy_count += buy_count
-        total_sell_count += sell_count
+            fresh = []
+            for it in items:
+                oid = str(it.get("id") or it.get("orderId") or "")
+                if not oid:
+                    continue
+                if oid in seen_ids:
+                    continue
+                seen_ids.add(oid)
+                fresh.append(it)
 
-        profit_ngn, profit_usdt = calculate_simple_spread_profit(start_ms, end_ms)
-        total_profit_ngn += profit_ngn
-        total_profit_usdt += profit_usdt
+            if fresh:
+                yield fresh
 
-    msg = f"""
-📊 <b>MONTHLY P2P REPORT</b>
-📅 Trading days: {len(days)}
+            if len(items) < size:
+                break
 
-💰 Bought: {total_buys:,.2f} USDT
-💵 Sold: {total_sells:,.2f} USDT
+            page += 1
+            if page > BYBIT_MAX_PAGES:
+                raise BybitAPIError(f"{endpoint}: more than {BYBIT_MAX_PAGES} pages, narrow the window")
 
-🔄 Trades:
-• {total_buy_count} Buys
-• {total_sell_count} Sells
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
 
-📈 Profit (NGN): ₦{total_profit_ngn:,.2f}
-💎 Profit (USDT): {total_profit_usdt:,.4f} USDT
-"""
 
-    await context.bot.send_message(chat_id=CHAT_ID, text=msg, parse_mode="HTML")
+bybit = BybitClient()
 
-async def startday(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    now_ms = int(time.time() * 1000)
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+# ========================= PDF EXPORT =========================
+PDF_TABLE_ROWS = 40   # matched lots per table chunk, about one A4 page at 8pt
 
-    # Close any previous open day (safety)
-    c.execute("""
-        UPDATE trading_day
-        SET ended_at = ?
-        WHERE ended_at IS NULL
-    """, (now_ms,))
+PDF_HEADER = [
+    "Buy Time", "Sell Time",
+    "USDT", "Buy Price", "Sell Price",
+    "Buy Fee ₦", "Profit ₦"
+]
 
-    # Start new day
-    c.execute("""
-        INSERT INTO trading_day (started_at)
-        VALUES (?)
-    """, (now_ms,))
+PDF_TABLE_STYLE = TableStyle([
+    ("GRID", (0, 0), (-1, -1), 0.5, colors.black),
+    ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
+    ("FONTSIZE", (0, 0), (-1, -1), 8),
+    ("ALIGN", (0, 0), (-1, -1), "CENTER"),
+])
 
-    conn.commit()
-    conn.close()
 
-    await update.message.reply_text(
-        "✅ Trading day STARTED\n"
-        f"⏰ {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-    )
-async def endday(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    now_ms = int(time.time() * 1000)
+class StreamingDocTemplate(BaseDocTemplate):
+    """
+    Lays flowables out one at a time as an iterator produces them,
+    so the story is never held in memory as a whole.
+    """
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+    def __init__(self, filename, **kw):
+        super().__init__(filename, **kw)
+        frame = Frame(self.leftMargin, self.bottomMargin, self.width, self.height, id="normal")
+        self.addPageTemplates([PageTemplate(id="page", frames=frame, pagesize=self.pagesize)])
 
-    c.execute("""
-        UPDATE trading_day
-        SET ended_at = ?
-        WHERE ended_at IS NULL
-    """ , (now_ms,))
+    def build_stream(self, flowables):
+        self._startBuild()
+        canv = self.canv
+        canv._doctemplate = self
 
-    if c.rowcount == 0:
-        conn.close()
-        return await update.message.reply_text("❌ No open trading day.")
+        try:
+            for flowable in flowables:
+                # handle_flowable pops from the list and pushes back split remainders
+                pending = [flowable]
+                while pending:
+                    self.clean_hanging()
+                    self.handle_flowable(pending)
+        finally:
+            del canv._doctemplate
 
-    conn.commit()
-    conn.close()
+        self._endBuild()
 
-    await update.message.reply_text(
-        "🔒 Trading day ENDED\n"
-        f"⏰ {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-    )
 
+def _pdf_table(rows):
+    table = Table(rows, repeatRows=1)
+    table.setStyle(PDF_TABLE_STYLE)
+    return table
 
-async def opening_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat_id
-    text = update.message.text.strip()
 
-    if chat_id not in opening_states:
-        return
+def matched_lot_tables(matches, rows=PDF_TABLE_ROWS):
+    """Turn a stream of MatchedLots into Tables of at most `rows` lines each."""
+    chunk = [PDF_HEADER]
 
-    try:
-        amount = float(text)
-    except:
-        return await update.message.reply_text(
-            "❌ Invalid amount. Enter numbers only:"
-        )
+    for m in matches:
+        chunk.append([
+            datetime.fromtimestamp(m.buy_time / 1000).strftime("%m-%d %H:%M"),
+            datetime.fromtimestamp(m.sell_time / 1000).strftime("%m-%d %H:%M"),
+            f"{m.qty:.4f}",
+            f"{m.buy_price}",
+            f"{m.sell_price}",
+            f"{m.fee_ngn:,.2f}",
+            f"{m.net_profit:,.2f}"
+        ])
 
-    today = datetime.now().strftime("%Y-%m-%d")
+        if len(chunk) > rows:
+            yield _pdf_table(chunk)
+            chunk = [PDF_HEADER]
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        INSERT OR REPLACE INTO daily_balances (date, opening_balance)
-        VALUES (?, ?)
-    """, (today, amount))
-    conn.commit()
-    conn.close()
+    if len(chunk) > 1:
+        yield _pdf_table(chunk)
 
-    opening_states.pop(chat_id)
 
-    await update.message.reply_text(
-        f"✅ <b>Opening Balance Saved</b>\n\n"
-        f"📅 {today}\n"
-        f"💰 ₦{amount:,.2f}",
-        parse_mode="HTML"
+def export_trades_to_pdf(filename="p2p_report.pdf", start_ms=None, end_ms=None, summary_only=False):
+    """
+    Matched trades sold in [start_ms, end_ms] (all history by default).
+    The FIFO pass runs twice: once for the totals in the header, then
+    again streaming rows into per-page tables. summary_only skips the
+    second pass and the table.
+    """
+    period = "All trades" if start_ms is None and end_ms is None else (
+        (datetime.fromtimestamp(start_ms / 1000).strftime("%Y-%m-%d") if start_ms is not None else "first trade")
+        + " → "
+        + (datetime.fromtimestamp(end_ms / 1000).strftime("%Y-%m-%d") if end_ms is not None else "latest")
     )
 
+    start_ms = 0 if start_ms is None else start_ms
+    end_ms = int(time.time() * 1000) if end_ms is None else end_ms
 
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT side, COUNT(*) FROM trades
+            WHERE completed_at BETWEEN ? AND ?
+            GROUP BY side
+        """, (start_ms, end_ms))
+        side_counts = dict(c.fetchall())
 
+        total_profit_ngn, total_buy_fees_ngn, matched = window_totals(conn, start_ms, end_ms)
 
-async def addtrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """
-    Add an offline trade manually.
-    Usage: /addtrade <side 0/1> <usdt_amount> <fiat_amount_ngn> <price>
-    """
+        small_style = ParagraphStyle(name="small", fontSize=9)
 
-    if len(context.args) < 4:
-        return await update.message.reply_text(
-            "Usage:\n/addtrade <side 0=BUY, 1=SELL> <usdt_amount> <fiat_amount_ngn> <price>"
+        summary = Paragraph(
+            f"<b>PERIOD:</b> {period}<br/>"
+            f"<b>TOTAL PROFIT:</b> ₦{total_profit_ngn:,.2f}<br/>"
+            f"<b>TOTAL BUY FEES:</b> ₦{total_buy_fees_ngn:,.2f}<br/>"
+            f"<b>TRADES:</b> {side_counts.get(0, 0)} Buys • {side_counts.get(1, 0)} Sells • "
+            f"{matched} matched lots",
+            small_style
         )
 
-    try:
-        side = int(context.args[0])       # BUY = 0, SELL = 1
-        amount = float(context.args[1])   # USDT amount
-        fiat_amount = float(context.args[2])  # NGN amount
-        price = float(context.args[3])    # NGN per USDT
+        pdf = StreamingDocTemplate(filename, pagesize=A4)
 
-        if side not in (0, 1):
-            return await update.message.reply_text("Side must be 0 (BUY) or 1 (SELL).")
+        if summary_only:
+            pdf.build_stream([summary])
+        else:
+            tables = matched_lot_tables(replay_fifo_window(conn, start_ms, end_ms))
+            pdf.build_stream(itertools.chain([summary], tables))
 
-    except ValueError:
-        return await update.message.reply_text("❌ Invalid input. Use numbers only.")
+    return filename
 
-    completed_at = int(time.time() * 1000)
-    trade_id = f"manual_{completed_at}"
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
+# ========================= PDF CACHE =========================
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", "pdf_cache")
+PDF_CACHE_MAX_MB = float(os.getenv("PDF_CACHE_MAX_MB", "200"))
+PDF_CACHE_MAX_AGE_DAYS = float(os.getenv("PDF_CACHE_MAX_AGE_DAYS", "7"))
 
-    c.execute("""
-        INSERT INTO trades (
-            id, side, token, amount, fiat_amount, price, fee,
-            counterparty, status, created_at, completed_at
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        trade_id, side, "USDT", amount, fiat_amount, price, 0.0,
-        "offline", 50, completed_at, completed_at
-    ))
 
-    conn.commit()
-    conn.close()
+def pdf_cache_key(start_ms, end_ms, summary_only):
+    """
+    sha256 of the requested range, mode and trades data version.
+    Open ends stay None so "up to now" maps to the same key until
+    a trade changes. Returns (key, data_version).
+    """
+    with db.reader() as conn:
+        version = get_data_version(conn)
+
+    raw = f"{start_ms}|{end_ms}|{'summary' if summary_only else 'full'}|{version}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest(), version
+
+
+def pdf_cache_lookup(key):
+    """(path, file_id) of a cached export, or None. Marks it as used."""
+    with db.writer() as conn:
+        c = conn.cursor()
+        c.execute("SELECT path, file_id FROM pdf_cache WHERE cache_key = ?", (key,))
+        row = c.fetchone()
+        if not row:
+            return None
+
+        path, file_id = row
+        if not os.path.exists(path) and not file_id:
+            c.execute("DELETE FROM pdf_cache WHERE cache_key = ?", (key,))
+            return None
+
+        c.execute("UPDATE pdf_cache SET last_used = ? WHERE cache_key = ?",
+                  (int(time.time() * 1000), key))
+
+    return path, file_id
+
+
+def pdf_cache_store(key, path, version, file_id=None):
+    now_ms = int(time.time() * 1000)
+
+    with db.writer() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO pdf_cache (cache_key, path, size, data_version, file_id, created_at, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (key, path, os.path.getsize(path), version, file_id, now_ms, now_ms))
+
+    evict_pdf_cache()
+
+
+def pdf_cache_set_file_id(key, file_id):
+    with db.writer() as conn:
+        conn.execute("UPDATE pdf_cache SET file_id = ? WHERE cache_key = ?", (file_id, key))
+
+
+def evict_pdf_cache():
+    """
+    Drop exports built from an older data version (their key can't come
+    back), then anything unused for PDF_CACHE_MAX_AGE_DAYS, then the
+    least recently used until the directory fits PDF_CACHE_MAX_MB.
+    """
+    cutoff = int((time.time() - PDF_CACHE_MAX_AGE_DAYS * 86400) * 1000)
+    max_bytes = int(PDF_CACHE_MAX_MB * 1024 * 1024)
+
+    with db.writer() as conn:
+        c = conn.cursor()
+        version = get_data_version(conn)
+
+        c.execute("""
+            SELECT cache_key, path, size, data_version, last_used
+            FROM pdf_cache
+            ORDER BY last_used DESC
+        """)
+
+        evict = []
+        total = 0
+        for key, path, size, data_version, last_used in c.fetchall():
+            if data_version < version or last_used < cutoff or total + size > max_bytes:
+                evict.append((key, path))
+            else:
+                total += size
+
+        c.executemany("DELETE FROM pdf_cache WHERE cache_key = ?", [(key,) for key, _ in evict])
+
+    for _, path in evict:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    return len(evict)
+
+
+# ========================= REPORT ENGINE =========================
+REPORT_FIELDS = ("buy_usdt", "buy_fiat", "buy_count", "buy_fee", "sell_usdt", "sell_fiat", "sell_count", "sell_fee")
+
+
+def standard_periods(now=None):
+    """(start_ms, end_ms) for today, the trading day (if started), week, month and year."""
+    now = now or datetime.now()
+    midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    end_ms = int(now.timestamp() * 1000)
+
+    periods = {
+        "today": (int(midnight.timestamp() * 1000), end_ms),
+        "week": (int((midnight - timedelta(days=now.weekday())).timestamp() * 1000), end_ms),
+        "month": (int(midnight.replace(day=1).timestamp() * 1000), end_ms),
+        "year": (int((midnight - timedelta(days=365)).timestamp() * 1000), end_ms),
+    }
+
+    day_start, day_end = get_current_day_range()
+    if day_start:
+        periods["trading_day"] = (day_start, day_end)
+
+    return periods
+
+
+@metrics.timed("report_seconds", op="compute_period_reports")
+def compute_period_reports(periods):
+    """
+    Totals for every {name: (start_ms, end_ms)} period in one pass:
+    one GROUP BY side scan of trades bucketed per period, and one scan
+    of matched_lots for realised profit.
+
+    Returns {name: {buy_usdt, buy_fiat, buy_count, buy_fee,
+                    sell_usdt, sell_fiat, sell_count, sell_fee,
+                    profit_ngn, profit_usdt}}.
+    """
+    names = list(periods)
+    if not names:
+        return {}
+
+    lo = min(periods[n][0] for n in names)
+    hi = max(periods[n][1] for n in names)
+
+    trade_cols, trade_params = [], []
+    profit_cols, profit_params = [], []
+
+    for n in names:
+        start_ms, end_ms = periods[n]
+        trade_cols += [
+            "TOTAL(CASE WHEN completed_at BETWEEN ? AND ? THEN amount END)",
+            "TOTAL(CASE WHEN completed_at BETWEEN ? AND ? THEN fiat_amount END)",
+            "COUNT(CASE WHEN completed_at BETWEEN ? AND ? THEN 1 END)",
+            "TOTAL(CASE WHEN completed_at BETWEEN ? AND ? THEN fee END)",
+        ]
+        trade_params += [start_ms, end_ms] * 4
+        profit_cols.append("TOTAL(CASE WHEN sell_time BETWEEN ? AND ? THEN net_profit END)")
+        profit_params += [start_ms, end_ms]
+
+    reports = {n: {f: 0 for f in REPORT_FIELDS} for n in names}
+
+    with db.reader() as conn:
+        c = conn.cursor()
+
+        c.execute(f"""
+            SELECT side, {", ".join(trade_cols)}
+            FROM trades
+            WHERE completed_at BETWEEN ? AND ?
+            GROUP BY side
+        """, trade_params + [lo, hi])
+
+        for side, *values in c.fetchall():
+            if side not in (0, 1):
+                continue
+            prefix = "buy" if side == 0 else "sell"
+            for i, n in enumerate(names):
+                usdt, fiat, count, fee = values[i * 4:i * 4 + 4]
+                reports[n].update({
+                    f"{prefix}_usdt": usdt,
+                    f"{prefix}_fiat": fiat,
+                    f"{prefix}_count": count,
+                    f"{prefix}_fee": fee,
+                })
+
+        c.execute(f"""
+            SELECT {", ".join(profit_cols)}
+            FROM matched_lots
+            WHERE sell_time BETWEEN ? AND ?
+        """, profit_params + [lo, hi])
+        profits = c.fetchone()
+
+    for n, profit in zip(names, profits):
+        reports[n]["profit_ngn"] = round(profit, 2)
+        reports[n]["profit_usdt"] = 0.0
+
+    return reports
+
+
+# ========================= REPORT CACHE =========================
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "256"))   # report results kept in memory
+
+
+def report_versions(conn):
+    """(version, backdated, ledger applied_through, newest completed_at) for cache keys."""
+    c = conn.cursor()
+    c.execute("SELECT version, backdated FROM data_version WHERE id = 1")
+    version, backdated = c.fetchone() or (0, 0)
+    c.execute("SELECT applied_through FROM ledger_state WHERE id = 1")
+    row = c.fetchone()
+    c.execute("SELECT MAX(completed_at) FROM trades")
+    return version, backdated, row[0] if row else None, c.fetchone()[0]
+
+
+class ReportCache:
+    """
+    LRU of report results keyed by (kind, start_ms, end_ms, version).
+
+    A period ending at or before the ledger's high-water mark is closed:
+    only a back-dated change can alter it, so it keys on the backdated
+    counter and survives new trades. Anything else keys on the general
+    version and goes stale on the next write. An end past the newest
+    trade is stored as "latest" so "up to now" ranges can hit too.
+    """
+
+    def __init__(self, size=REPORT_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(kind, start_ms, end_ms, versions):
+        version, backdated, applied_through, newest = versions
+
+        if end_ms is not None and applied_through is not None and end_ms <= applied_through:
+            return kind, start_ms, end_ms, "closed", backdated
+        if end_ms is None or newest is None or end_ms >= newest:
+            return kind, start_ms, "latest", "open", version
+        return kind, start_ms, end_ms, "open", version
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                metrics.inc("report_cache_total", result="miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.inc("report_cache_total", result="hit")
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+report_cache = ReportCache()
+
+
+def cached_period_reports(periods):
+    """compute_period_reports, answering cached periods without a scan."""
+    with db.reader() as conn:
+        versions = report_versions(conn)
+
+    reports = {}
+    missing = {}
+    keys = {}
+
+    for name, (lo, hi) in periods.items():
+        keys[name] = ReportCache.key("period", lo, hi, versions)
+        hit = report_cache.get(keys[name])
+        if hit is None:
+            missing[name] = (lo, hi)
+        else:
+            reports[name] = dict(hit)
+
+    if missing:
+        for name, r in compute_period_reports(missing).items():
+            report_cache.put(keys[name], r)
+            reports[name] = dict(r)
+
+    return reports
+
+
+def cached_rollup_closed_days(since_date: str):
+    with db.reader() as conn:
+        versions = report_versions(conn)
+
+    # Depends on balances as well as trades: never treated as closed
+    key = ReportCache.key("rollup", since_date, None, versions)
+    hit = report_cache.get(key)
+    if hit is None:
+        hit = rollup_closed_days(since_date)
+        report_cache.put(key, hit)
+
+    days, totals = hit
+    return list(days), dict(totals)
+
+
+
+async def summary_days(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # User must type a number
+    if not context.args:
+        return await update.message.reply_text("Usage: /summarydays <number_of_days>")
+
+    try:
+        days = int(context.args[0])
+        if days <= 0 or days > 365:
+            return await update.message.reply_text("Enter a value between 1 and 365 days.")
+    except:
+        return await update.message.reply_text("Invalid number.")
+
+    now = datetime.now()
+    start = now - timedelta(days=days)
+    start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    start_ms = int(start.timestamp() * 1000)
+    end_ms = int(now.timestamp() * 1000)
+
+    r = (await db_pool.run(cached_period_reports, {"days": (start_ms, end_ms)}))["days"]
+
+    # ==== SEND RESULT ====
+    await update.message.reply_text(
+        f"""
+📊 <b>Summary of the last {days} days</b>
+
+💰 Bought: {r['buy_usdt']:,.2f} USDT (₦{r['buy_fiat']:,.2f})
+💵 Sold: {r['sell_usdt']:,.2f} USDT (₦{r['sell_fiat']:,.2f})
+🔄 Trades: {r['buy_count']} Buys • {r['sell_count']} Sells
+📈 Profit (Spread): ₦{r['profit_ngn']:,.2f}
+""",
+        parse_mode="HTML"
+    )
+
+
+async def yesterday(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.now()
+
+    # Yesterday range
+    start = (now - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    end = (now - timedelta(days=1)).replace(hour=23, minute=59, second=59, microsecond=0)
+
+    start_ms = int(start.timestamp() * 1000)
+    end_ms = int(end.timestamp() * 1000)
+
+    r = (await db_pool.run(cached_period_reports, {"yesterday": (start_ms, end_ms)}))["yesterday"]
+
+    await update.message.reply_text(
+        f"""
+📊 <b>YESTERDAY'S SUMMARY</b>
+
+🗓 Date: {start.strftime('%Y-%m-%d')}
+
+💰 Bought: {r['buy_usdt']:,.2f} USDT (₦{r['buy_fiat']:,.2f})
+💵 Sold: {r['sell_usdt']:,.2f} USDT (₦{r['sell_fiat']:,.2f})
+🔄 Trades: {r['buy_count']} Buys • {r['sell_count']} Sells
+📈 Profit (Spread): ₦{r['profit_ngn']:,.2f}
+""",
+        parse_mode="HTML"
+    )
+
+
+
+
+
+BUY_FEE_RATE = 0.00275
+SYNC_BATCH_SIZE = int(os.getenv("SYNC_BATCH_SIZE", "300"))  # orders per dedup/insert batch
+SQL_IN_CHUNK = 500                                          # stay under SQLite's variable limit
+SYNC_PREFETCH_PAGES = int(os.getenv("SYNC_PREFETCH_PAGES", "4"))  # pages fetched ahead of the parser
+SYNC_WRITE_QUEUE = int(os.getenv("SYNC_WRITE_QUEUE", "2"))        # parsed batches waiting for the writer
+
+
+def safe_float(x, default=0.0):
+    try:
+        return float(str(x).replace(",", "").strip())
+    except:
+        return default
+
+
+def safe_int(x, default=0):
+    try:
+        return int(x)
+    except:
+        try:
+            return int(float(x))
+        except:
+            return default
+
+
+def parse_order(order):
+    """
+    Normalise one simplifyList order into a trades row.
+    Returns None if the order is outside the synced stream.
+    """
+    order_id = str(order.get("id") or order.get("orderId") or "")
+    if not order_id:
+        return None
+
+    if order.get("currencyId") != SYNC_FIAT:
+        return None
+    if order.get("tokenId") != SYNC_TOKEN:
+        return None
+
+    status = safe_int(order.get("status"))
+    if status != SYNC_STATUS:
+        return None
+
+    side = safe_int(order.get("side", 0))
+    fiat_amount = safe_float(order.get("amount"))
+    price = safe_float(order.get("price"))
+
+    raw_crypto = safe_float(
+        order.get("notifyTokenQuantity")
+        or order.get("tokenQuantity")
+        or order.get("tokenAmount")
+        or 0
+    )
+
+    # ✅ VERY IMPORTANT:
+    # ✅ STORE FULL USDT — DO NOT REMOVE BUY FEE HERE
+    crypto_amount = raw_crypto
+
+    if crypto_amount <= 0:
+        log.warning("Skipping order %s: no token quantity", order_id)
+        return None
+
+    fee = crypto_amount * BUY_FEE_RATE if side == 0 else 0.0
+
+    counterparty = order.get("targetNickName", "") or order.get("targetUserId", "")
+
+    created_at = safe_int(order.get("createDate", 0))
+    completed_at = safe_int(order.get("updateDate", created_at))
+
+    return (
+        order_id,
+        side,
+        SYNC_TOKEN,
+        crypto_amount,   # ✅ FULL USDT
+        fiat_amount,
+        price,
+        fee,
+        counterparty,
+        SYNC_STATUS,
+        created_at,
+        completed_at
+    )
+
+
+def find_existing_trade_ids(c, ids):
+    known = set()
+    ids = list(ids)
+
+    for i in range(0, len(ids), SQL_IN_CHUNK):
+        chunk = ids[i:i + SQL_IN_CHUNK]
+        marks = ",".join("?" * len(chunk))
+        c.execute(f"SELECT id FROM trades WHERE id IN ({marks})", chunk)
+        known.update(row[0] for row in c.fetchall())
+
+    return known
+
+
+def write_trade_batch(conn, rows):
+    """
+    Insert a batch of parsed trade rows in one transaction.
+    Returns (skipped_duplicate, inserted).
+    """
+    if not rows:
+        return 0, 0
+
+    c = conn.cursor()
+    known = find_existing_trade_ids(c, (r[0] for r in rows))
+    new_rows = [r for r in rows if r[0] not in known]
+
+    if new_rows:
+        with conn:
+            c.executemany("""
+                INSERT OR IGNORE INTO trades (
+                    id, side, token, amount, fiat_amount, price, fee,
+                    counterparty, status, created_at, completed_at
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, new_rows)
+
+    return len(rows) - len(new_rows), len(new_rows)
+
+
+def store_trade_batch(rows):
+    # Shared writer; safe to call from a worker thread
+    with db.writer() as conn:
+        return write_trade_batch(conn, rows)
+
+
+async def sync_completed_orders(client=None):
+    """
+    Pull completed orders since the stream watermark and insert the new ones.
+
+    Runs as a fetch → parse → write pipeline joined by bounded queues, so
+    page N+1 downloads while page N is parsed and the previous batch is
+    written. Returns totals, per-batch stats (fetched, skipped_duplicate,
+    skipped_filter, inserted), busy seconds per stage and orders/sec.
+    """
+    client = client or bybit
+    begin_ms = await db_pool.run(get_sync_begin_ms)
+    now_ms = int(time.time() * 1000)
+
+    watermark = await db_pool.run(get_sync_watermark)
+    totals = {"fetched": 0, "skipped_duplicate": 0, "skipped_filter": 0, "inserted": 0}
+    batches = []
+    stage_seconds = {"fetch": 0.0, "parse": 0.0, "write": 0.0}
+
+    pages = asyncio.Queue(maxsize=SYNC_PREFETCH_PAGES)
+    parsed = asyncio.Queue(maxsize=SYNC_WRITE_QUEUE)
+
+    error = None
+
+    async def fetch_stage():
+        nonlocal error
+        t = time.perf_counter()
+        try:
+            async for items in client.iter_order_pages(begin_ms, now_ms, status=SYNC_STATUS):
+                stage_seconds["fetch"] += time.perf_counter() - t
+                await pages.put(items)   # blocks once SYNC_PREFETCH_PAGES are waiting
+                t = time.perf_counter()
+        except BybitAPIError as e:
+            # Keep what we already fetched, but report the sync as partial
+            error = str(e)
+            log.warning("Sync stopped early: %s", e)
+        stage_seconds["fetch"] += time.perf_counter() - t
+        await pages.put(None)
+
+    async def parse_stage():
+        nonlocal watermark
+        batch = {"fetched": 0, "skipped_filter": 0, "rows": []}
+
+        while (items := await pages.get()) is not None:
+            t = time.perf_counter()
+            for order in items:
+                batch["fetched"] += 1
+
+                row = parse_order(order)
+                if row is None:
+                    batch["skipped_filter"] += 1
+                    continue
+
+                # Track newest updateDate seen, even for orders we already have
+                update_ms = row[10]
+                if update_ms and (watermark is None or update_ms > watermark):
+                    watermark = update_ms
+
+                batch["rows"].append(row)
+            stage_seconds["parse"] += time.perf_counter() - t
+
+            if len(batch["rows"]) >= SYNC_BATCH_SIZE:
+                await parsed.put(batch)
+                batch = {"fetched": 0, "skipped_filter": 0, "rows": []}
+
+        if batch["fetched"]:
+            await parsed.put(batch)
+        await parsed.put(None)
+
+    async def write_stage():
+        while (batch := await parsed.get()) is not None:
+            t = time.perf_counter()
+            skipped, inserted = await db_pool.run(store_trade_batch, batch["rows"])
+            stage_seconds["write"] += time.perf_counter() - t
+
+            stats = {
+                "fetched": batch["fetched"],
+                "skipped_duplicate": skipped,
+                "skipped_filter": batch["skipped_filter"],
+                "inserted": inserted,
+            }
+            batches.append(stats)
+            for k, v in stats.items():
+                totals[k] += v
+
+    started = time.perf_counter()
+
+    # A failing stage cancels the others instead of leaving them blocked on a queue
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(fetch_stage())
+        tg.create_task(parse_stage())
+        tg.create_task(write_stage())
+
+    elapsed = time.perf_counter() - started
+
+    # Even with nothing new: catches the ledger up if an earlier sync
+    # stored its trades but failed to match them
+    await db_pool.run(refresh_ledger)
+
+    metrics.observe("sync_seconds", elapsed, partial=int(error is not None))
+    for stage, seconds in stage_seconds.items():
+        metrics.observe("sync_stage_seconds", seconds, stage=stage)
+    for result, n in totals.items():
+        metrics.inc("sync_orders_total", n, result=result)
+
+    # A partial sync may have skipped older pages: leave the watermark
+    # where it was so the next run re-reads the gap
+    if watermark is not None and error is None:
+        await db_pool.run(set_sync_watermark, watermark)
+
+    return {
+        **totals,
+        "partial": error is not None,
+        "error": error,
+        "batches": batches,
+        "stage_seconds": {k: round(v, 3) for k, v in stage_seconds.items()},
+        "elapsed_s": round(elapsed, 3),
+        "orders_per_sec": round(totals["fetched"] / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+
+
+async def raw(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    now_ms = int(time.time() * 1000)
+    begin_ms = now_ms - (3 * 24 * 60 * 60 * 1000)
+
+    try:
+        res = await bybit.request("/v5/p2p/order/simplifyList", body={
+            "page": 1,
+            "size": 5,
+            "status": 50,
+            "beginTime": str(begin_ms),
+            "endTime": str(now_ms)
+        })
+    except BybitAPIError as e:
+        return await update.message.reply_text(f"❌ Bybit API error:\n{e}")
+
+    await update.message.reply_text(json.dumps(res, indent=2)[:4000])
+
+
+
+
+def calculate_simple_spread_profit(start_ms, end_ms):
+    """
+    Realised FIFO profit for sells completed in the window, read from the
+    matched_lots ledger, so buys made before the window are accounted for.
+    """
+    with db.reader() as conn:
+        c = conn.cursor()
+
+        # ✅ fees are already netted per lot (offline = 0, online = real)
+        c.execute("""
+            SELECT COALESCE(SUM(net_profit), 0)
+            FROM matched_lots
+            WHERE sell_time BETWEEN ? AND ?
+        """, (start_ms, end_ms))
+        total_profit_ngn = c.fetchone()[0]
+
+    return round(total_profit_ngn, 2), 0.0
+
+
+
+
+async def send_daily_report(context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.now()
+
+    # 🔑 Get user-defined trading day range
+    start_ms, end_ms = await db_pool.run(get_current_day_range)
+
+    if not start_ms:
+        await context.bot.send_message(
+            chat_id=CHAT_ID,
+            text="❌ Trading day not started. Use /startday"
+        )
+        return  # ✅ STOP HERE if no day started
+
+    r = (await db_pool.run(cached_period_reports, {"trading_day": (start_ms, end_ms)}))["trading_day"]
+
+    msg = f"""
+📊 <b>DAILY P2P REPORT</b>
+
+⏱ Period:
+{datetime.fromtimestamp(start_ms/1000).strftime('%Y-%m-%d %H:%M')}
+→ {datetime.fromtimestamp(end_ms/1000).strftime('%Y-%m-%d %H:%M')}
+
+💰 Bought: {r['buy_usdt']:,.2f} USDT
+💵 Sold: {r['sell_usdt']:,.2f} USDT
+
+🔄 Trades:
+• {r['buy_count']} Buys
+• {r['sell_count']} Sells
+
+📈 Profit (NGN): ₦{r['profit_ngn']:,.2f}
+💎 Profit (USDT): {r['profit_usdt']:,.4f} USDT
+"""
+
+    await context.bot.send_message(
+        chat_id=CHAT_ID,
+        text=msg,
+        parse_mode="HTML"
+    )
+
+
+async def send_weekly_report(context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.now()
+    week_ago = now - timedelta(days=7)
+
+    # Trading days closed in last 7 days, summed from daily_rollup
+    days, totals = await db_pool.run(cached_rollup_closed_days, week_ago.strftime("%Y-%m-%d"))
+
+    if not days:
+        await context.bot.send_message(
+            chat_id=CHAT_ID,
+            text="❌ No completed trading days in the last 7 days."
+        )
+        return
+
+    msg = f"""
+📊 <b>WEEKLY P2P REPORT</b>
+📅 Trading days: {len(days)}
+
+💰 Bought: {totals['buys']:,.2f} USDT
+💵 Sold: {totals['sells']:,.2f} USDT
+
+🔄 Trades:
+• {totals['buy_count']} Buys
+• {totals['sell_count']} Sells
+
+📈 Profit (NGN): ₦{totals['profit_ngn']:,.2f}
+💎 Profit (USDT): {totals['profit_usdt']:,.4f} USDT
+"""
+
+    await context.bot.send_message(chat_id=CHAT_ID, text=msg, parse_mode="HTML")
+
+
+
+async def send_monthly_report(context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.now()
+    month_start = now.replace(day=1).strftime("%Y-%m-%d")
+
+    days, totals = await db_pool.run(cached_rollup_closed_days, month_start)
+
+    if not days:
+        await context.bot.send_message(
+            chat_id=CHAT_ID,
+            text="❌ No completed trading days this month."
+        )
+        return
+
+    msg = f"""
+📊 <b>MONTHLY P2P REPORT</b>
+📅 Trading days: {len(days)}
+
+💰 Bought: {totals['buys']:,.2f} USDT
+💵 Sold: {totals['sells']:,.2f} USDT
+
+🔄 Trades:
+• {totals['buy_count']} Buys
+• {totals['sell_count']} Sells
+
+📈 Profit (NGN): ₦{totals['profit_ngn']:,.2f}
+💎 Profit (USDT): {totals['profit_usdt']:,.4f} USDT
+"""
+
+    await context.bot.send_message(chat_id=CHAT_ID, text=msg, parse_mode="HTML")
+
+def start_trading_day(now_ms):
+    with db.writer() as conn:
+        c = conn.cursor()
+
+        # Close any previous open day (safety)
+        c.execute("""
+            UPDATE trading_day
+            SET ended_at = ?
+            WHERE ended_at IS NULL
+        """, (now_ms,))
+
+        # Start new day
+        c.execute("""
+            INSERT INTO trading_day (started_at)
+            VALUES (?)
+        """, (now_ms,))
+
+
+def end_trading_day(now_ms):
+    """Close the open trading day; False if there was none."""
+    with db.writer() as conn:
+        c = conn.cursor()
+
+        c.execute("""
+            UPDATE trading_day
+            SET ended_at = ?
+            WHERE ended_at IS NULL
+        """ , (now_ms,))
+
+        if c.rowcount == 0:
+            return False
+
+        # Later reports replay from here instead of from the first trade
+        take_inventory_checkpoint(conn)
+
+        # Settle today's rollup row for the weekly/monthly reports
+        refresh_daily_rollup(conn, now_ms)
+
+    return True
+
+
+async def startday(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    now_ms = int(time.time() * 1000)
+
+    await db_pool.run(start_trading_day, now_ms)
+    await request_sync(context, "startday")   # and switch to the active-session schedule
+
+    await update.message.reply_text(
+        "✅ Trading day STARTED\n"
+        f"⏰ {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    )
+async def endday(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    now_ms = int(time.time() * 1000)
+
+    if not await db_pool.run(end_trading_day, now_ms):
+        return await update.message.reply_text("❌ No open trading day.")
+    await request_sync(context, "endday")   # pick up the last fills before idling
+
+    await update.message.reply_text(
+        "🔒 Trading day ENDED\n"
+        f"⏰ {datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    )
+
+
+def save_opening_balance(date_str, amount):
+    with db.writer() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO daily_balances (date, opening_balance)
+            VALUES (?, ?)
+        """, (date_str, amount))
+
+
+def save_closing_balance(date_str, amount):
+    with db.writer() as conn:
+        conn.execute("""
+            UPDATE daily_balances
+            SET closing_balance = ?
+            WHERE date = ?
+        """, (amount, date_str))
+
+
+async def opening_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    text = update.message.text.strip()
+
+    if chat_id not in opening_states:
+        return
+
+    try:
+        amount = float(text)
+    except:
+        return await update.message.reply_text(
+            "❌ Invalid amount. Enter numbers only:"
+        )
+
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    await db_pool.run(save_opening_balance, today, amount)
+
+    opening_states.pop(chat_id)
+
+    await update.message.reply_text(
+        f"✅ <b>Opening Balance Saved</b>\n\n"
+        f"📅 {today}\n"
+        f"💰 ₦{amount:,.2f}",
+        parse_mode="HTML"
+    )
+
+
+
+
+def insert_manual_trade(trade_id, side, amount, fiat_amount, price, completed_at):
+    with db.writer() as conn:
+        c = conn.cursor()
+
+        c.execute("""
+            INSERT INTO trades (
+                id, side, token, amount, fiat_amount, price, fee,
+                counterparty, status, created_at, completed_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            trade_id, side, "USDT", amount, fiat_amount, price, 0.0,
+            "offline", 50, completed_at, completed_at
+        ))
+
+        # Same transaction: only this trade is matched against open lots
+        update_ledger(conn)
+
+
+async def addtrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Add an offline trade manually.
+    Usage: /addtrade <side 0/1> <usdt_amount> <fiat_amount_ngn> <price>
+    """
+
+    if len(context.args) < 4:
+        return await update.message.reply_text(
+            "Usage:\n/addtrade <side 0=BUY, 1=SELL> <usdt_amount> <fiat_amount_ngn> <price>"
+        )
+
+    try:
+        side = int(context.args[0])       # BUY = 0, SELL = 1
+        amount = float(context.args[1])   # USDT amount
+        fiat_amount = float(context.args[2])  # NGN amount
+        price = float(context.args[3])    # NGN per USDT
+
+        if side not in (0, 1):
+            return await update.message.reply_text("Side must be 0 (BUY) or 1 (SELL).")
+        if not amount > 0:
+            return await update.message.reply_text("USDT amount must be greater than 0.")
+
+    except ValueError:
+        return await update.message.reply_text("❌ Invalid input. Use numbers only.")
+
+    completed_at = int(time.time() * 1000)
+    trade_id = f"manual_{completed_at}"
+
+    await db_pool.run(insert_manual_trade, trade_id, side, amount, fiat_amount, price, completed_at)
+
+    await update.message.reply_text(
+        f"✅ Manual trade added!\n\n"
+        f"ID: {trade_id}\n"
+        f"Type: {'BUY' if side == 0 else 'SELL'}\n"
+        f"USDT: {amount}\n"
+        f"NGN: ₦{fiat_amount:,.2f}\n"
+        f"Rate: ₦{price:,.2f}"
+    )
+
+async def addtrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+
+    user_states[chat_id] = AddTradeState.SIDE
+    user_data[chat_id] = {}
+
+    keyboard = [
+        [
+            InlineKeyboardButton("BUY", callback_data="side_0"),
+            InlineKeyboardButton("SELL", callback_data="side_1")
+        ]
+    ]
+
+    await update.message.reply_text(
+        "Select trade type:",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+async def opening(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+
+    opening_states[chat_id] = OpeningBalanceState.AMOUNT
 
     await update.message.reply_text(
-        f"✅ Manual trade added!\n\n"
-        f"ID: {trade_id}\n"
-        f"Type: {'BUY' if side == 0 else 'SELL'}\n"
-        f"USDT: {amount}\n"
-        f"NGN: ₦{fiat_amount:,.2f}\n"
-        f"Rate: ₦{price:,.2f}"
+        "💰 Enter today's OPENING balance (NGN):"
+    )
+
+async def addtrade_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    chat_id = query.message.chat_id
+
+    if query.data.startswith("side_"):
+        side = int(query.data.split("_")[1])
+
+        user_data[chat_id]["side"] = side
+        user_states[chat_id] = AddTradeState.AMOUNT   # ✅ FIXED STATE
+
+        await query.edit_message_text(
+            f"Selected: {'BUY' if side == 0 else 'SELL'}\n\nEnter USDT amount:"
+        )
+
+
+async def addtrade_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    text = update.message.text.strip()
+
+    if chat_id not in user_states:
+        return
+
+    state = user_states[chat_id]
+
+    # ---- USDT INPUT ----
+    if state == AddTradeState.AMOUNT:   # ✅ FIXED
+        try:
+            amount = float(text)
+        except:
+            return await update.message.reply_text("Invalid amount. Enter USDT number only:")
+
+        if not amount > 0:
+            return await update.message.reply_text("USDT amount must be greater than 0. Enter it again:")
+
+        user_data[chat_id]["amount"] = amount
+
+        user_states[chat_id] = AddTradeState.PRICE
+        return await update.message.reply_text("Enter price (NGN per USDT):")
+
+    # ---- PRICE INPUT ----
+    if state == AddTradeState.PRICE:
+        try:
+            price = float(text)
+            amount = user_data[chat_id]["amount"]
+            side = user_data[chat_id]["side"]
+        except:
+            return await update.message.reply_text("Invalid price. Enter price again:")
+
+        fiat_amount = round(amount * price, 2)
+        completed_at = int(time.time() * 1000)
+        trade_id = f"manual_{completed_at}"
+
+        await db_pool.run(insert_manual_trade, trade_id, side, amount, fiat_amount, price, completed_at)
+
+        user_states.pop(chat_id)
+        user_data.pop(chat_id)
+
+        return await update.message.reply_text(
+            f"✅ Trade Added Successfully!\n\n"
+            f"Type: {'BUY' if side == 0 else 'SELL'}\n"
+            f"USDT: {amount}\n"
+            f"Rate: ₦{price:,.2f}\n"
+            f"Total: ₦{fiat_amount:,.2f}"
+        )
+
+async def show_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = """
+📌 <b>AVAILABLE BOT COMMANDS</b>
+
+📊 <b>Reports</b>
+/daily - Get today's report
+/weekly - Get this week's report
+/monthly - Get this month's report
+
+📄
+/exportpdf [from] [to] [summary] - Export matched trades as PDF
+
+🔁 <b>Sync</b>
+/syncnow - Sync Bybit orders right now
+/resync YYYY-MM-DD - Re-sync Bybit orders from a date
+/rebuildledger - Replay all trades into the FIFO ledger
+/workers - Worker pool load and queue depth
+
+💾 <b>Manual Trading</b>
+/addtrade - Add a BUY or SELL manually (auto-calculates NGN)
+
+
+✅ All calculations are automatic.
+✅ All exports are audit-ready.
+"""
+
+    await update.message.reply_text(text, parse_mode="HTML")
+
+async def closing_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    text = update.message.text.strip()
+
+    if chat_id not in closing_states:
+        return
+
+    try:
+        amount = float(text)
+    except:
+        return await update.message.reply_text(
+            "❌ Invalid amount. Enter numbers only:"
+        )
+
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    await db_pool.run(save_closing_balance, today, amount)
+
+    closing_states.pop(chat_id)
+
+    await update.message.reply_text(
+        f"✅ <b>Closing Balance Saved</b>\n\n"
+        f"📅 {today}\n"
+        f"💼 ₦{amount:,.2f}",
+        parse_mode="HTML"
+    )
+
+
+
+# ========================= SUMMARY =========================
+def summary(period):
+    # Every standard period comes out of the same scan; pick the one asked for
+    reports = cached_period_reports(standard_periods())
+    r = reports.get(period) or reports["year"]
+
+    return f"""
+📊 <b>P2P Summary ({period})</b>
+
+💰 Bought: {r['buy_usdt']:,.2f} USDT (₦{r['buy_fiat']:,.2f})
+💵 Sold: {r['sell_usdt']:,.2f} USDT (₦{r['sell_fiat']:,.2f})
+📈 Profit (Spread): ₦{r['profit_ngn']:,.2f}
+"""
+
+
+
+
+
+def fix_db():
+    with db.writer() as conn:
+        version = migrate_db(conn)
+    return version
+
+async def fixdb_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Column types are enforced by schema migrations now;
+    this just applies any that are pending.
+    """
+    version = await db_pool.run(fix_db)
+
+    await update.message.reply_text(f"✅ Database schema is up to date (version {version}).")
+
+
+def ledger_totals():
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*), COALESCE(SUM(net_profit), 0) FROM matched_lots")
+        lots, profit = c.fetchone()
+        c.execute("SELECT COALESCE(SUM(qty), 0) FROM open_inventory")
+        open_usdt = c.fetchone()[0]
+
+    return lots, profit, open_usdt
+
+
+async def rebuildledger(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Replay all trades into matched_lots / open_inventory.
+    Use after editing or deleting trades by hand.
+    """
+    count = await rebuild_ledger_offloaded(full=True)
+    lots, profit, open_usdt = await db_pool.run(ledger_totals)
+
+    await update.message.reply_text(
+        f"♻️ Ledger rebuilt from {count} trades\n"
+        f"🔗 {lots} matched lots • ₦{profit:,.2f} realised\n"
+        f"📦 Open inventory: {open_usdt:,.4f} USDT"
+    )
+
+
+def debug_last_trades():
+    with db.reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, side, fiat_amount FROM trades ORDER BY completed_at DESC LIMIT 5")
+        rows = c.fetchall()
+
+    msg = "Last 5 trades:\n"
+    for r in rows:
+        msg += f"ID: {r[0]} | Side: {r[1]} | ₦{r[2]:,.2f}\n"
+
+    return msg
+
+
+
+# ========================= TELEGRAM COMMANDS =========================
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Welcome to Bybit P2P Tracker 🚀")
+
+
+# ========================= MANUAL REPORT COMMANDS =========================
+
+async def manual_daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_daily_report(context)
+    await update.message.reply_text("✅ Daily report sent!")
+
+async def manual_weekly(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_weekly_report(context)
+    await update.message.reply_text("✅ Weekly report sent!")
+
+async def manual_monthly(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_monthly_report(context)
+    await update.message.reply_text("✅ Monthly report sent!")
+
+
+async def debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(await db_pool.run(debug_last_trades))
+async def exportpdf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Usage: /exportpdf [from YYYY-MM-DD] [to YYYY-MM-DD] [summary]
+    """
+    args = list(context.args or [])
+    summary_only = any(a.lower() == "summary" for a in args)
+    dates = [a for a in args if a.lower() != "summary"]
+
+    try:
+        start = datetime.strptime(dates[0], "%Y-%m-%d") if dates else None
+        end = datetime.strptime(dates[1], "%Y-%m-%d") if len(dates) > 1 else None
+    except ValueError:
+        return await update.message.reply_text(
+            "Usage: /exportpdf [from YYYY-MM-DD] [to YYYY-MM-DD] [summary]"
+        )
+
+    start_ms = int(start.timestamp() * 1000) if start else None
+    # `to` is inclusive: up to the last millisecond of that day
+    end_ms = int((end + timedelta(days=1)).timestamp() * 1000) - 1 if end else None
+
+    caption = "✅ Your P2P Trading Report" + (" (summary)" if summary_only else "")
+
+    try:
+        key, version = await db_pool.run(pdf_cache_key, start_ms, end_ms, summary_only)
+        cached = await db_pool.run(pdf_cache_lookup, key)
+        metrics.inc("pdf_cache_total", result="hit" if cached else "miss")
+
+        if cached:
+            path, file_id = cached
+
+            # Telegram keeps uploaded files; resending by id skips the upload
+            if file_id:
+                try:
+                    return await context.bot.send_document(
+                        chat_id=update.effective_chat.id, document=file_id, caption=caption
+                    )
+                except TelegramError as e:
+                    log.info("Cached file_id rejected, re-uploading: %s", e)
+
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    message = await context.bot.send_document(
+                        chat_id=update.effective_chat.id, document=f, caption=caption
+                    )
+                await db_pool.run(pdf_cache_set_file_id, key, message.document.file_id)
+                return
+
+        os.makedirs(PDF_CACHE_DIR, exist_ok=True)
+        filename = os.path.join(PDF_CACHE_DIR, f"{key}.pdf")
+
+        try:
+            # Full ReportLab build in a worker process; the bot keeps answering
+            with metrics.timer("pdf_export_seconds", summary=int(summary_only)):
+                await cpu_pool.run(export_trades_to_pdf, filename, start_ms, end_ms, summary_only)
+
+            with open(filename, "rb") as f:
+                message = await context.bot.send_document(
+                    chat_id=update.effective_chat.id, document=f, caption=caption
+                )
+        except Exception:
+            # Not in pdf_cache yet, so evict_pdf_cache would never remove it
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            raise
+
+        await db_pool.run(pdf_cache_store, key, filename, version, message.document.file_id)
+
+    except Exception as e:
+        await update.message.reply_text(f"❌ PDF Export Failed:\n{e}")
+async def closing(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+
+    closing_states[chat_id] = ClosingBalanceState.AMOUNT
+
+    await update.message.reply_text(
+        "💼 Enter today's CLOSING balance (NGN):"
     )
 
-async def addtrade(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat_id
 
-    user_states[chat_id] = AddTradeState.SIDE
-    user_data[chat_id] = {}
 
-    keyboard = [
-        [
-            InlineKeyboardButton("BUY", callback_data="side_0"),
-            InlineKeyboardButton("SELL", callback_data="side_1")
-        ]
-    ]
 
-    await update.message.reply_text(
-        "Select trade type:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+
+# ========================= BACKFILL =========================
+BACKFILL_WINDOWS = {"day": timedelta(days=1), "week": timedelta(weeks=1)}
+
+
+def split_backfill_windows(start: datetime, end: datetime, window="day"):
+    """[(start_ms, end_ms), ...] covering start..end, aligned to local midnight."""
+    step = BACKFILL_WINDOWS[window]
+    cursor = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    windows = []
+
+    while cursor < end:
+        nxt = min(cursor + step, end)
+        # endTime is inclusive on Bybit's side, so stop 1ms short of the next window
+        windows.append((int(cursor.timestamp() * 1000), int(nxt.timestamp() * 1000) - 1))
+        cursor = nxt
+
+    return windows
+
+
+def get_completed_backfill_windows():
+    with db.reader() as conn:
+        c = conn.cursor()
+
+        c.execute("""
+            SELECT window_start, window_end FROM backfill_windows
+            WHERE status = ? AND token = ? AND fiat = ?
+        """, (SYNC_STATUS, SYNC_TOKEN, SYNC_FIAT))
+        done = set(c.fetchall())
+
+    return done
+
+
+def mark_backfill_window(start_ms, end_ms, fetched, inserted):
+    with db.writer() as conn:
+        c = conn.cursor()
+
+        c.execute("""
+            INSERT OR REPLACE INTO backfill_windows (
+                status, token, fiat, window_start, window_end,
+                fetched, inserted, completed_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (SYNC_STATUS, SYNC_TOKEN, SYNC_FIAT, start_ms, end_ms,
+              fetched, inserted, int(time.time() * 1000)))
+
+
+async def backfill_window(client, start_ms, end_ms):
+    """Fetch one window with the same parsing rules as sync_completed_orders."""
+    fetched = inserted = 0
+    rows = []
+
+    async def flush():
+        nonlocal rows, inserted
+        _, n = await db_pool.run(store_trade_batch, rows)   # db.writer() serializes workers
+        inserted += n
+        rows = []
+
+    async for items in client.iter_order_pages(start_ms, end_ms, status=SYNC_STATUS):
+        for order in items:
+            fetched += 1
+            row = parse_order(order)
+            if row is not None:
+                rows.append(row)
+
+        if len(rows) >= SYNC_BATCH_SIZE:
+            await flush()
+
+    await flush()
+
+    # Only checkpoint once every page of the window is stored
+    await db_pool.run(mark_backfill_window, start_ms, end_ms, fetched, inserted)
+    return fetched, inserted
+
+
+async def run_backfill(start: datetime, end: datetime, workers=4, window="day", client=None):
+    """
+    Fetch start..end as independent windows with N concurrent workers.
+    Workers share one client, so they share its rate budget. Completed
+    windows are checkpointed and skipped on the next run.
+    """
+    client = client or BybitClient()
+    windows = split_backfill_windows(start, end, window)
+    done = await db_pool.run(get_completed_backfill_windows)
+    pending = [w for w in windows if w not in done]
+
+    work_queue = asyncio.Queue()
+    for w in pending:
+        work_queue.put_nowait(w)
+
+    totals = {"windows": len(windows), "skipped": len(windows) - len(pending),
+              "completed": 0, "failed": 0, "fetched": 0, "inserted": 0}
+    started = time.perf_counter()
+
+    async def worker():
+        while True:
+            try:
+                start_ms, end_ms = work_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            label = datetime.fromtimestamp(start_ms / 1000).strftime("%Y-%m-%d")
+            try:
+                fetched, inserted = await backfill_window(client, start_ms, end_ms)
+            except BybitAPIError as e:
+                totals["failed"] += 1
+                log.warning("Backfill window %s failed: %s", label, e)
+                continue
+
+            totals["completed"] += 1
+            totals["fetched"] += fetched
+            totals["inserted"] += inserted
+            print(f"✅ {label}: {fetched} orders, {inserted} new "
+                  f"({totals['completed'] + totals['skipped']}/{totals['windows']})")
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+    finally:
+        await client.close()
+
+    # Backfilled orders are usually older than the ledger head → rebuilds once
+    # Even with nothing new: catches the ledger up if an earlier sync
+    # stored its trades but failed to match them
+    await db_pool.run(refresh_ledger)
+
+    totals["elapsed_s"] = round(time.perf_counter() - started, 3)
+    return totals
+
+
+def backfill_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="profitcal.py backfill",
+        description="Resumable historical backfill of completed Bybit P2P orders.",
     )
-async def opening(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat_id
+    parser.add_argument("--from", dest="start", required=True, help="YYYY-MM-DD")
+    parser.add_argument("--to", dest="end", help="YYYY-MM-DD (exclusive, default: now)")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--window", choices=sorted(BACKFILL_WINDOWS), default="day")
+    args = parser.parse_args(argv)
+
+    start = datetime.strptime(args.start, "%Y-%m-%d")
+    end = datetime.strptime(args.end, "%Y-%m-%d") if args.end else datetime.now()
+
+    totals = asyncio.run(run_backfill(start, end, args.workers, args.window))
+
+    print(
+        f"Backfill {args.start} → {end.strftime('%Y-%m-%d')}: "
+        f"{totals['completed']} windows done, {totals['skipped']} already done, "
+        f"{totals['failed']} failed • {totals['fetched']} orders, "
+        f"{totals['inserted']} new • {totals['elapsed_s']}s"
+    )
+    if totals["failed"]:
+        print("Re-run the same command to retry the failed windows.")
 
-    opening_states[chat_id] = OpeningBalanceState.AMOUNT
+    return 1 if totals["failed"] else 0
 
-    await update.message.reply_text(
-        "💰 Enter today's OPENING balance (NGN):"
-    )
 
-async def addtrade_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+# ========================= SYNC WORKER =========================
+# "internal": the bot runs autosync itself. "external": `profitcal.py syncd`
+# syncs in its own process and the bot only relays its sync_events.
+SYNC_MODE = os.getenv("SYNC_MODE", "internal")
+SYNC_EVENTS_POLL = float(os.getenv("SYNC_EVENTS_POLL", "5"))       # seconds between outbox / request checks
+SYNCD_STALE_AFTER = float(os.getenv("SYNCD_STALE_AFTER", "300"))   # warn when syncd is this late for a run
+SYNC_EVENTS_KEEP_DAYS = 7
+SYNCD_LOCK = f"{DB_NAME}.syncd.lock"
 
-    chat_id = query.message.chat_id
+# Adaptive schedule: fast while fills keep arriving, backing off when quiet
+SYNC_INTERVAL_MIN = float(os.getenv("SYNC_INTERVAL_MIN", "20"))         # after a sync that found new trades
+SYNC_INTERVAL_ACTIVE = float(os.getenv("SYNC_INTERVAL_ACTIVE", "120"))  # longest wait while a trading day is open
+SYNC_INTERVAL_MAX = float(os.getenv("SYNC_INTERVAL_MAX", "1800"))       # longest wait outside trading days
+SYNC_BACKOFF = float(os.getenv("SYNC_BACKOFF", "2"))                    # wait multiplier per sync with nothing new
 
-    if query.data.startswith("side_"):
-        side = int(query.data.split("_")[1])
 
-        user_data[chat_id]["side"] = side
-        user_states[chat_id] = AddTradeState.AMOUNT   # ✅ FIXED STATE
+class SyncScheduler:
+    """
+    Delay before the next auto-sync. Drops to SYNC_INTERVAL_MIN whenever a
+    sync finds new trades, then grows by SYNC_BACKOFF per empty sync up to
+    SYNC_INTERVAL_ACTIVE during an open trading day, SYNC_INTERVAL_MAX otherwise.
+    """
 
-        await query.edit_message_text(
-            f"Selected: {'BUY' if side == 0 else 'SELL'}\n\nEnter USDT amount:"
+    def __init__(self):
+        self.delay = SYNC_INTERVAL_MIN
+        self.last_fill_at = None
+        self.next_at = None
+
+    def next_delay(self, inserted, day_open):
+        cap = SYNC_INTERVAL_ACTIVE if day_open else SYNC_INTERVAL_MAX
+        if inserted:
+            self.last_fill_at = time.time()
+            self.delay = SYNC_INTERVAL_MIN
+        else:
+            self.delay *= SYNC_BACKOFF
+
+        # Opening a day pulls a long idle wait straight down to the active cap
+        self.delay = max(SYNC_INTERVAL_MIN, min(self.delay, cap))
+        self.next_at = time.time() + self.delay
+        return self.delay
+
+
+sync_scheduler = SyncScheduler()
+
+
+def trading_day_open():
+    with db.reader() as conn:
+        row = conn.execute("SELECT ended_at IS NULL FROM trading_day ORDER BY id DESC LIMIT 1").fetchone()
+    return bool(row and row[0])
+
+
+def record_sync_event(stats, next_at, request_id=None):
+    """Queue a sync result for the bot; every run writes one, so it doubles as a heartbeat."""
+    now_ms = int(time.time() * 1000)
+    expired = now_ms - SYNC_EVENTS_KEEP_DAYS * 24 * 60 * 60 * 1000
+    with db.writer() as conn:
+        conn.execute("""
+            INSERT INTO sync_events (created_at, fetched, inserted, partial, error, elapsed_s, next_at, request_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (now_ms, stats["fetched"], stats["inserted"], int(stats["partial"]), stats["error"],
+              stats["elapsed_s"], int(next_at * 1000), request_id))
+        conn.execute("DELETE FROM sync_events WHERE delivered_at IS NOT NULL AND delivered_at < ?", (expired,))
+        conn.execute("DELETE FROM sync_requests WHERE handled_at IS NOT NULL AND handled_at < ?", (expired,))
+
+
+def pending_sync_events(limit=500):
+    """Undelivered events oldest first, and when the worker's next run is due."""
+    with db.reader() as conn:
+        events = conn.execute("""
+            SELECT id, created_at, fetched, inserted, partial, error, request_id
+            FROM sync_events
+            WHERE delivered_at IS NULL
+            ORDER BY id
+            LIMIT ?
+        """, (limit,)).fetchall()
+        row = conn.execute("""
+            SELECT COALESCE(next_at, created_at) FROM sync_events ORDER BY id DESC LIMIT 1
+        """).fetchone()
+
+    return events, row[0] if row else None
+
+
+def mark_sync_events_delivered(last_id):
+    with db.writer() as conn:
+        conn.execute(
+            "UPDATE sync_events SET delivered_at = ? WHERE id <= ? AND delivered_at IS NULL",
+            (int(time.time() * 1000), last_id),
         )
 
 
-async def addtrade_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat_id
-    text = update.message.text.strip()
+def add_sync_request(reason, resync_from=None):
+    with db.writer() as conn:
+        conn.execute(
+            "INSERT INTO sync_requests (requested_at, reason, resync_from) VALUES (?, ?, ?)",
+            (int(time.time() * 1000), reason, resync_from),
+        )
 
-    if chat_id not in user_states:
-        return
 
-    state = user_states[chat_id]
+def claim_sync_request():
+    """
+    Mark every pending sync request handled. Returns (newest id, earliest
+    resync_from), or (None, None) if nothing is pending.
+    """
+    with db.reader() as conn:
+        row = conn.execute("""
+            SELECT MAX(id), MIN(resync_from) FROM sync_requests WHERE handled_at IS NULL
+        """).fetchone()
+    if row[0] is None:
+        return None, None
 
-    # ---- USDT INPUT ----
-    if state == AddTradeState.AMOUNT:   # ✅ FIXED
-        try:
-            user_data[chat_id]["amount"] = float(text)
-        except:
-            return await update.message.reply_text("Invalid amount. Enter USDT number only:")
+    with db.writer() as conn:
+        conn.execute(
+            "UPDATE sync_requests SET handled_at = ? WHERE id <= ? AND handled_at IS NULL",
+            (int(time.time() * 1000), row[0]),
+        )
+    return row
 
-        user_states[chat_id] = AddTradeState.PRICE
-        return await update.message.reply_text("Enter price (NGN per USDT):")
 
-    # ---- PRICE INPUT ----
-    if state == AddTradeState.PRICE:
+def acquire_syncd_lock(path=SYNCD_LOCK):
+    """
+    Exclusive lock so only one sync worker polls Bybit per database.
+    Returns the open lock file, or None if another worker holds it.
+    """
+    f = open(path, "a+")
+    if fcntl is None:
+        return f   # no advisory locks on Windows
+
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+
+    f.seek(0)
+    f.truncate()
+    f.write(f"{os.getpid()}\n")
+    f.flush()
+    return f
+
+
+async def wait_for_sync_request(stop, delay):
+    """Sleep `delay` seconds, returning early on stop or a sync request (see claim_sync_request)."""
+    deadline = time.monotonic() + delay
+    while not stop.is_set():
+        request = await db_pool.run(claim_sync_request)
+        if request[0] is not None:
+            return request
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
         try:
-            price = float(text)
-            amount = user_data[chat_id]["amount"]
-            side = user_data[chat_id]["side"]
-        except:
-            return await update.message.reply_text("Invalid price. Enter price again:")
+            await asyncio.wait_for(stop.wait(), timeout=min(remaining, SYNC_EVENTS_POLL))
+        except TimeoutError:
+            pass
+    return None, None
 
-        fiat_amount = round(amount * price, 2)
-        completed_at = int(time.time() * 1000)
-        trade_id = f"manual_{completed_at}"
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
+async def run_syncd(interval=None, once=False, textfile=None):
+    """
+    Sync, record the result for the bot, wait; until SIGINT/SIGTERM.
+    The wait follows sync_scheduler unless a fixed `interval` is given.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:   # Windows: Ctrl+C still raises KeyboardInterrupt
+            pass
 
-        c.execute("""
-            INSERT INTO trades (
-                id, side, token, amount, fiat_amount, price, fee,
-                counterparty, status, created_at, completed_at
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            trade_id,
-            side,
-            "USDT",
-            amount,
-            fiat_amount,
-            price,
-            0.0,
-            "offline",
-            50,
-            completed_at,
-            completed_at
-        ))
+    # A request left over from before a restart is answered by the first run
+    request_id, resync_from = await db_pool.run(claim_sync_request)
+    try:
+        while not stop.is_set():
+            with metrics.timer("job_seconds", name="syncd"):
+                try:
+                    if resync_from is not None:
+                        await db_pool.run(rewind_sync_watermark, resync_from)
+                    stats = await sync_completed_orders()
+                except Exception as e:
+                    log.exception("Sync failed")
+                    stats = {"fetched": 0, "inserted": 0, "partial": True,
+                             "error": f"{type(e).__name__}: {e}", "elapsed_s": 0.0}
+
+                day_open = await db_pool.run(trading_day_open)
+                delay = interval or sync_scheduler.next_delay(stats["inserted"], day_open)
+                await db_pool.run(record_sync_event, stats, time.time() + delay, request_id)
+
+            log.info("Sync: %d orders, %d new in %.1fs%s; next in %.0fs", stats["fetched"], stats["inserted"],
+                     stats["elapsed_s"], f" (partial: {stats['error']})" if stats["partial"] else "", delay)
+            if textfile:
+                await asyncio.to_thread(metrics.write_textfile, textfile)
+
+            if once:
+                break
+            request_id, resync_from = await wait_for_sync_request(stop, delay)
+    finally:
+        await bybit.close()
 
-        conn.commit()
-        conn.close()
 
-        user_states.pop(chat_id)
-        user_data.pop(chat_id)
+def syncd_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="profitcal.py syncd",
+        description="Standalone sync worker. Run the bot with SYNC_MODE=external to receive its notices.",
+    )
+    parser.add_argument("--interval", type=float, help="fixed seconds between syncs (default: adaptive)")
+    parser.add_argument("--once", action="store_true", help="sync once and exit")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve /metrics on this local port")
+    parser.add_argument("--metrics-textfile", help="rewrite this Prometheus textfile after every sync")
+    args = parser.parse_args(argv)
+
+    lock = acquire_syncd_lock()
+    if lock is None:
+        print(f"Another sync worker is running (lock: {SYNCD_LOCK})")
+        return 1
+
+    if SYNC_MODE != "external":
+        log.warning("SYNC_MODE is %r: a running bot will sync too. Set SYNC_MODE=external for it.", SYNC_MODE)
+    if args.metrics_port:
+        serve_prometheus(metrics, args.metrics_port)
+        log.info("Prometheus metrics on http://127.0.0.1:%d/metrics", args.metrics_port)
+
+    log.info("Sync worker started (pid %d, %s)", os.getpid(),
+             f"every {args.interval:g}s" if args.interval else "adaptive interval")
+    try:
+        asyncio.run(run_syncd(args.interval, args.once, args.metrics_textfile))
+    finally:
+        db_pool.shutdown()
+        cpu_pool.shutdown()
+        db.close()
+        lock.close()
 
-        return await update.message.reply_text(
-            f"✅ Trade Added Successfully!\n\n"
-            f"Type: {'BUY' if side == 0 else 'SELL'}\n"
-            f"USDT: {amount}\n"
-            f"Rate: ₦{price:,.2f}\n"
-            f"Total: ₦{fiat_amount:,.2f}"
-        )
+    return 0
 
-async def show_commands(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = """
-📌 <b>AVAILABLE BOT COMMANDS</b>
 
-📊 <b>Reports</b>
-/daily - Get today's report
-/weekly - Get this week's report
-/monthly - Get this month's report
+# ========================= AUTOSYNC JOB =========================
+# Serializes autosync, /syncnow and /resync inside the bot
+sync_lock = asyncio.Lock()
 
-📄
-/exportpdf - Export all matched trades as PDF
 
-💾 <b>Manual Trading</b>
-/addtrade - Add a BUY or SELL manually (auto-calculates NGN)
+def sync_notice(new, error=None, requested=False):
+    if error:
+        return f"⚠️ Auto-sync partial: {new} new trades\n{error}"
+    if new > 0:
+        return f"🔄 Auto-sync: {new} new trades"
+    if requested:
+        return "✅ Sync done: no new trades"
+    return None
 
 
-✅ All calculations are automatic.
-✅ All exports are audit-ready.
-"""
+def schedule_autosync(job_queue, delay):
+    """Replace the pending autosync run with one `delay` seconds from now."""
+    for job in job_queue.get_jobs_by_name("autosync"):
+        job.schedule_removal()
+    job_queue.run_once(instrumented("autosync", autosync, kind="job"), when=delay, name="autosync")
 
-    await update.message.reply_text(text, parse_mode="HTML")
 
-async def closing_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat_id
-    text = update.message.text.strip()
+async def request_sync(context: ContextTypes.DEFAULT_TYPE, reason):
+    """Sync as soon as possible, in this process or the external worker."""
+    if SYNC_MODE == "external":
+        await db_pool.run(add_sync_request, reason)
+    else:
+        schedule_autosync(context.job_queue, 0)
 
-    if chat_id not in closing_states:
-        return
 
+async def autosync(context: ContextTypes.DEFAULT_TYPE):
+    stats = None
     try:
-        amount = float(text)
-    except:
-        return await update.message.reply_text(
-            "❌ Invalid amount. Enter numbers only:"
-        )
+        async with sync_lock:
+            stats = await sync_completed_orders()
+    finally:
+        # Re-arm even if the sync raised, or auto-sync would stop for good
+        day_open = await db_pool.run(trading_day_open)
+        schedule_autosync(context.job_queue, sync_scheduler.next_delay(stats["inserted"] if stats else 0, day_open))
 
-    today = datetime.now().strftime("%Y-%m-%d")
+    text = sync_notice(stats["inserted"], stats["error"])
+    if text:
+        await context.bot.send_message(chat_id=CHAT_ID, text=text)
 
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        UPDATE daily_balances
-        SET closing_balance = ?
-        WHERE date = ?
-    """, (amount, today))
-    conn.commit()
-    conn.close()
 
-    closing_states.pop(chat_id)
+async def syncnow(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Sync right away instead of waiting for the next scheduled run."""
+    if SYNC_MODE == "external":
+        await request_sync(context, "syncnow")
+        return await update.message.reply_text("⏩ Sync requested, the sync worker will report back shortly.")
+
+    if sync_lock.locked():
+        return await update.message.reply_text("⏳ A sync is already running.")
+
+    async with sync_lock:
+        stats = await sync_completed_orders()
+
+    day_open = await db_pool.run(trading_day_open)
+    delay = sync_scheduler.next_delay(stats["inserted"], day_open)
+    schedule_autosync(context.job_queue, delay)
 
     await update.message.reply_text(
-        f"✅ <b>Closing Balance Saved</b>\n\n"
-        f"📅 {today}\n"
-        f"💼 ₦{amount:,.2f}",
-        parse_mode="HTML"
+        f"🔄 Synced {stats['fetched']} orders in {stats['elapsed_s']}s\n"
+        f"✅ {stats['inserted']} new trades\n"
+        f"⏭ Next auto-sync in {delay:.0f}s"
+        + (f"\n⚠️ Partial sync: {stats['error']}" if stats["partial"] else "")
     )
 
 
+syncd_watch = {"since_ms": int(time.time() * 1000), "warned": False}
 
-# ========================= SUMMARY =========================
-def summary(period):
-    now = datetime.now()
 
-    if period == "today":
-        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-    elif period == "week":
-        start = now - timedelta(days=now.weekday())
-        start = start.replace(hour=0, minute=0, second=0, microsecond=0)
-    elif period == "month":
-        start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    else:  # year
-        start = now - timedelta(days=365)
-        start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+async def sync_events_job(context: ContextTypes.DEFAULT_TYPE):
+    """
+    SYNC_MODE=external: relay the sync worker's results as the usual
+    Auto-sync notices, and warn once if it misses a scheduled run.
+    """
+    events, due_ms = await db_pool.run(pending_sync_events)
+
+    if events:
+        # A backlog (bot was down) becomes one notice; only the newest run's error still matters
+        new = sum(e[3] for e in events)
+        latest = events[-1]
+        requested = any(e[6] is not None for e in events)
+        text = sync_notice(new, latest[5] if latest[4] else None, requested)
+        if text:
+            await context.bot.send_message(chat_id=CHAT_ID, text=text)
+        await db_pool.run(mark_sync_events_delivered, latest[0])
+
+    late_s = (time.time() * 1000 - max(due_ms or 0, syncd_watch["since_ms"])) / 1000
+    if late_s > SYNCD_STALE_AFTER and not syncd_watch["warned"]:
+        syncd_watch["warned"] = True
+        since = datetime.fromtimestamp(due_ms / 1000).strftime("%Y-%m-%d %H:%M") if due_ms else "never"
+        await context.bot.send_message(
+            chat_id=CHAT_ID,
+            text=f"⚠️ Sync worker missed its run due {since}. Is profitcal.py syncd running?",
+        )
+    elif late_s <= SYNCD_STALE_AFTER and syncd_watch["warned"]:
+        syncd_watch["warned"] = False
+        await context.bot.send_message(chat_id=CHAT_ID, text="✅ Sync worker is reporting again")
+
+
+async def resync(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Rewind the sync watermark to a date and sync from there.
+    Usage: /resync YYYY-MM-DD
+    """
+    if not context.args:
+        return await update.message.reply_text("Usage: /resync <YYYY-MM-DD>")
+
+    try:
+        start = datetime.strptime(context.args[0], "%Y-%m-%d")
+    except ValueError:
+        return await update.message.reply_text("❌ Invalid date. Use YYYY-MM-DD.")
 
     start_ms = int(start.timestamp() * 1000)
-    end_ms = int(now.timestamp() * 1000)
 
-    # BUY total inside period
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("""
-        SELECT amount FROM trades 
-        WHERE side = 0 AND completed_at BETWEEN ? AND ?
-    """, (start_ms, end_ms))
-    buys_rows = c.fetchall()
+    # The worker owns the watermark and the Bybit lock in external mode
+    if SYNC_MODE == "external":
+        await db_pool.run(add_sync_request, "resync", start_ms)
+        return await update.message.reply_text(
+            f"⏩ Resync from {start.strftime('%Y-%m-%d')} requested, the sync worker will report back."
+        )
 
-    buys = sum([row[0] for row in buys_rows])
+    async with sync_lock:
+        await db_pool.run(rewind_sync_watermark, start_ms)
+        stats = await sync_completed_orders()
+    await update.message.reply_text(
+        f"🔁 Resynced from {start.strftime('%Y-%m-%d')}\n"
+        f"📥 {stats['fetched']} orders fetched ({stats['orders_per_sec']:,.0f}/s)\n"
+        f"✅ {stats['inserted']} new trades"
+        + (f"\n⚠️ Partial sync: {stats['error']}" if stats["partial"] else "")
+    )
 
-    # SELL total inside period
-    c.execute("""
-        SELECT amount FROM trades 
-        WHERE side = 1 AND completed_at BETWEEN ? AND ?
-    """, (start_ms, end_ms))
-    sells_rows = c.fetchall()
 
-    sells = sum([row[0] for row in sells_rows])
+async def checkpoint_job(context: ContextTypes.DEFAULT_TYPE):
+    await db_pool.run(take_inventory_checkpoint)
 
-    conn.close()
 
-    # SIMPLE SPREAD PROFIT
-    profit = calculate_simple_spread_profit(start_ms, end_ms)
+async def workers_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Executor pool sizes and queue depth."""
+    lines = ["⚙️ <b>Worker pools</b>"]
+    for pool in (db_pool, cpu_pool):
+        st = pool.stats()
+        lines.append(
+            f"\n<b>{pool.name}</b>: {st['running']}/{st['workers']} busy • {st['queued']} queued\n"
+            f"done {st['completed']} • failed {st['failed']} • "
+            f"wait {st['last_wait_s']}s (max {st['max_wait_s']}s)"
+        )
 
-    return f"""
-📊 <b>P2P Summary ({period})</b>
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
 
-💰 Bought: ₦{buys:,.2f}
-💵 Sold: ₦{sells:,.2f}
-📈 Profit (Spread): ₦{profit:,.2f}
-"""
 
+def _fmt_seconds(value):
+    if value is None:
+        return "-"
+    if value < 0.001:
+        return f"{value * 1e6:.0f}µs"
+    return f"{value * 1000:.1f}ms" if value < 1 else f"{value:.2f}s"
 
 
+def format_metrics(match=None):
+    """Plain-text digest of the registry; `match` keeps names containing it."""
+    counters, histograms = metrics.snapshot()
+    lines = [f"📈 Metrics since {datetime.fromtimestamp(metrics.started):%Y-%m-%d %H:%M}"]
 
+    for (name, labels), h in sorted(histograms.items()):
+        if match and match not in name:
+            continue
+        label = " ".join(f"{k}={v}" for k, v in labels)
+        lines.append(
+            f"{name} {label}: n={h['count']} p50={_fmt_seconds(h['p50'])} "
+            f"p95={_fmt_seconds(h['p95'])} max={_fmt_seconds(h['max'])}"
+        )
 
-def fix_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE trades SET side = CAST(side AS INTEGER)")
-    conn.commit()
-    conn.close()
+    for (name, labels), value in sorted(counters.items()):
+        if match and match not in name:
+            continue
+        label = " ".join(f"{k}={v}" for k, v in labels)
+        lines.append(f"{name} {label}: {value:g}")
 
-async def fixdb_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if len(lines) == 1:
+        lines.append("No samples yet.")
+    return "\n".join(lines)
+
+
+async def metrics_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
-    Fixes incorrect 'side' values in the database (string → integer)
+    Latency histograms and counters.
+    Usage: /metrics [name filter] | /metrics reset
     """
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("UPDATE trades SET side = CAST(side AS INTEGER)")
-    conn.commit()
-    conn.close()
+    arg = context.args[0] if context.args else None
+    if arg == "reset":
+        metrics.reset()
+        return await update.message.reply_text("🧹 Metrics reset.")
+
+    text = format_metrics(arg)
+    if len(text) <= 3900:
+        return await update.message.reply_text(text)
+
+    # Past Telegram's message limit: send the full digest as a file
+    await context.bot.send_document(
+        chat_id=update.effective_chat.id,
+        document=text.encode("utf-8"),
+        filename="metrics.txt",
+        caption="📈 Metrics",
+    )
 
-    await update.message.reply_text("✅ Database fixed! Side values converted to integers.")
-def debug_last_trades():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    c.execute("SELECT id, side, fiat_amount FROM trades ORDER BY completed_at DESC LIMIT 5")
-    rows = c.fetchall()
-    conn.close()
 
-    msg = "Last 5 trades:\n"
-    for r in rows:
-        msg += f"ID: {r[0]} | Side: {r[1]} | ₦{r[2]:,.2f}\n"
+QUERY_ORDERS = ("total", "max", "avg", "calls", "rows")
 
-    return msg
 
+def format_slow_queries(n=10, order="total"):
+    lines = [f"🐢 Top {n} SQL statements by {order} (slow ≥ {SLOW_QUERY_MS:g} ms)"]
 
+    for i, st in enumerate(query_stats.top(n, order), 1):
+        flags = ""
+        if st.slow:
+            flags += f" • {st.slow} slow"
+        if st.full_scan:
+            flags += " • ⚠️ full scan"
+        lines.append(
+            f"\n{i}. {st.calls}× total {_fmt_seconds(st.seconds)} • "
+            f"avg {_fmt_seconds(st.seconds / st.calls)} • max {_fmt_seconds(st.max_seconds)} • "
+            f"{st.rows / st.calls:,.1f} rows/call{flags}"
+        )
+        sql = st.fingerprint
+        lines.append(sql if len(sql) <= 300 else sql[:300] + " …")
+        if st.plan:
+            lines.extend(f"  plan: {d}" for d in st.plan)
 
-# ========================= TELEGRAM COMMANDS =========================
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Welcome to Bybit P2P Tracker 🚀")
+    if len(lines) == 1:
+        lines.append("No statements traced yet." if SQL_METRICS else "SQL tracing is off (SQL_METRICS=0).")
+    return "\n".join(lines)
 
 
-# ========================= MANUAL REPORT COMMANDS =========================
+async def slowqueries_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    SQL statement fingerprints ranked by time spent.
+    Usage: /slowqueries [n] [total|max|avg|calls|rows] | /slowqueries reset
+    """
+    args = [a.lower() for a in (context.args or [])]
+    if "reset" in args:
+        query_stats.reset()
+        return await update.message.reply_text("🧹 Query stats reset.")
+
+    n, order = 10, "total"
+    for a in args:
+        if a.isdigit():
+            n = max(1, min(int(a), 50))
+        elif a in QUERY_ORDERS:
+            order = a
+        else:
+            return await update.message.reply_text(
+                "Usage: /slowqueries [n] [total|max|avg|calls|rows] | /slowqueries reset"
+            )
 
-async def manual_daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await send_daily_report(context)
-    await update.message.reply_text("✅ Daily report sent!")
+    text = format_slow_queries(n, order)
+    if len(text) <= 3900:
+        return await update.message.reply_text(text)
 
-async def manual_weekly(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await send_weekly_report(context)
-    await update.message.reply_text("✅ Weekly report sent!")
+    await context.bot.send_document(
+        chat_id=update.effective_chat.id,
+        document=text.encode("utf-8"),
+        filename="slowqueries.txt",
+        caption="🐢 Slow queries",
+    )
 
-async def manual_monthly(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await send_monthly_report(context)
-    await update.message.reply_text("✅ Monthly report sent!")
 
+async def metrics_textfile_job(context: ContextTypes.DEFAULT_TYPE):
+    await asyncio.to_thread(metrics.write_textfile, METRICS_TEXTFILE)
 
-async def debug(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(debug_last_trades())
-async def exportpdf(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        filename = f"p2p_report_{int(time.time())}.pdf"
 
-        export_trades_to_pdf(filename)
+# ========================= PROFILING =========================
+PROFILE_MAX_CALLS = 50
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "40"))     # functions listed per table in /profile reports
+
+
+class ProfileSession:
+    """
+    One /profile request. Collects a cProfile per profiled call from the
+    event-loop thread, plus one per DB-thread task that call awaited
+    (Python 3.11; from 3.12 the event-loop profile covers all threads).
+    With `memory`, it also sums tracemalloc growth by allocation site.
+    """
+
+    def __init__(self, calls, target, memory, chat_id):
+        self.calls = calls
+        self.remaining = calls
+        self.target = target
+        self.memory = memory
+        self.chat_id = chat_id
+        self.profiles = []
+        self.runs = []            # (name, seconds, peak bytes or None)
+        self.sites = {}           # "file:line" -> [bytes, blocks]
+        self._lock = threading.Lock()
+
+    def matches(self, name, kind):
+        if self.target is None:
+            return kind == "handler" and name != "profile"
+        return name == self.target
+
+    def add_profile(self, prof):
+        with self._lock:
+            self.profiles.append(prof)
+
+    def add_memory(self, diffs):
+        for d in diffs:
+            frame = d.traceback[0]
+            site = self.sites.setdefault(f"{frame.filename}:{frame.lineno}", [0, 0])
+            site[0] += d.size_diff
+            site[1] += d.count_diff
+
+    def report(self):
+        out = io.StringIO()
+        total = sum(r[1] for r in self.runs)
+        out.write(f"Profiled {len(self.runs)} call(s), {total:.3f}s wall in total\n")
+        for name, seconds, peak in self.runs:
+            line = f"  {name}: {seconds:.3f}s"
+            if peak is not None:
+                line += f", peak traced memory {peak / 1024 / 1024:.1f} MB"
+            out.write(line + "\n")
+        out.write(
+            "\nThe event-loop profile covers everything the loop ran meanwhile, "
+            "including other handlers. CPU pool (process) work shows only as waiting.\n"
+        )
+
+        if self.profiles:
+            stats = pstats.Stats(*self.profiles, stream=out).strip_dirs()
+            out.write("\n==== by cumulative time ====\n")
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+            out.write("\n==== by own time ====\n")
+            stats.sort_stats("tottime").print_stats(PROFILE_TOP)
+        else:
+            out.write("\nNo cProfile data: another profiler was active in this process.\n")
+
+        if self.memory:
+            out.write("\n==== net allocation growth by site ====\n")
+            top = sorted(self.sites.items(), key=lambda kv: abs(kv[1][0]), reverse=True)[:PROFILE_TOP]
+            for site, (size, count) in top:
+                out.write(f"{size / 1024:>12,.1f} KiB {count:>+10,} blocks  {site}\n")
+        return out.getvalue()
+
+
+class HandlerProfiler:
+    """
+    Arms a ProfileSession. instrumented() routes matching calls through
+    run(), one at a time. While a profiled call is running, other calls
+    run normally.
+    """
+
+    def __init__(self):
+        self.session = None
+        self._busy = asyncio.Lock()
+
+    def wants(self, name, kind):
+        session = self.session
+        return session is not None and session.remaining > 0 and session.matches(name, kind)
 
-        with open(filename, "rb") as f:
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=f,
-                caption="✅ Your P2P Trading Report"
+    async def run(self, name, fn, args, kwargs):
+        session = self.session
+        if self._busy.locked():
+            return await fn(*args, **kwargs)
+
+        async with self._busy:
+            if session is not self.session or session.remaining <= 0:
+                return await fn(*args, **kwargs)
+            session.remaining -= 1
+
+            started_tracing = session.memory and not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            if session.memory:
+                before = tracemalloc.take_snapshot()
+                tracemalloc.reset_peak()
+
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+            except ValueError as e:
+                # e.g. running under `python -m cProfile`: still time the call
+                log.warning("/profile could not profile %s: %s", name, e)
+                prof = None
+
+            token = _profile_session.set(session)
+            t = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t
+                _profile_session.reset(token)
+                if prof is not None:
+                    prof.disable()
+                    session.add_profile(prof)
+
+                peak = None
+                if session.memory:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    after = tracemalloc.take_snapshot()
+                    session.add_memory(after.compare_to(before, "lineno"))
+                    if started_tracing:
+                        tracemalloc.stop()
+                session.runs.append((name, elapsed, peak))
+
+                if session.remaining == 0:
+                    self.session = None
+                    await self._send_report(session, args[-1].bot)
+
+    async def _send_report(self, session, bot):
+        text = await asyncio.to_thread(session.report)
+        try:
+            await bot.send_document(
+                chat_id=session.chat_id,
+                document=text.encode("utf-8"),
+                filename=f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt",
+                caption=f"🔬 Profile of {len(session.runs)} call(s)",
             )
+        except TelegramError as e:
+            log.warning("Could not send profile report: %s", e)
 
-    except Exception as e:
-        await update.message.reply_text(f"❌ PDF Export Failed:\n{e}")
-async def closing(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat_id
 
-    closing_states[chat_id] = ClosingBalanceState.AMOUNT
+profiler = HandlerProfiler()
+
+
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Usage: /profile <n> [command] [mem] — profile the next n calls
+           /profile autosync [mem]       — profile the next autosync run
+           /profile off | /profile
+    """
+    if str(update.effective_chat.id) != str(CHAT_ID):
+        return await update.message.reply_text("⛔ /profile is restricted to the bot owner.")
+
+    args = [a.lower().lstrip("/") for a in (context.args or [])]
 
+    if not args:
+        session = profiler.session
+        if session is None:
+            return await update.message.reply_text("No profile armed. Usage: /profile <n> [command] [mem]")
+        return await update.message.reply_text(
+            f"🔬 Armed: {session.remaining}/{session.calls} call(s) of {session.target or 'any command'} left"
+        )
+
+    if args[0] == "off":
+        profiler.session = None
+        return await update.message.reply_text("🔬 Profiling off.")
+
+    memory = "mem" in args
+    calls, target = 1, None
+    for a in args:
+        if a == "mem":
+            continue
+        if a.isdigit():
+            calls = int(a)
+        else:
+            target = a
+
+    if not 1 <= calls <= PROFILE_MAX_CALLS:
+        return await update.message.reply_text(f"Enter between 1 and {PROFILE_MAX_CALLS} calls.")
+
+    profiler.session = ProfileSession(calls, target, memory, update.effective_chat.id)
     await update.message.reply_text(
-        "💼 Enter today's CLOSING balance (NGN):"
+        f"🔬 Profiling the next {calls} call(s) of {target or 'any command'}"
+        + (" with memory tracing" if memory else "")
+        + ". The report arrives as a file."
     )
 
 
+def instrumented(name, fn, kind="handler"):
+    """
+    Wrap a handler or job callback so its latency lands in
+    {kind}_seconds{name} and /profile can pick it up.
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        with metrics.timer(f"{kind}_seconds", name=name):
+            if profiler.wants(name, kind):
+                return await profiler.run(name, fn, args, kwargs)
+            return await fn(*args, **kwargs)
+    return wrapper
 
 
+def command(name, fn):
+    return CommandHandler(name, instrumented(name, fn))
+
+
+async def close_clients(app):
+    await bybit.close()
+    if METRICS_TEXTFILE:
+        metrics.write_textfile(METRICS_TEXTFILE)
+    db_pool.shutdown()
+    cpu_pool.shutdown()
+    db.close()
 
-# ========================= AUTOSYNC JOB =========================
-async def autosync(context: ContextTypes.DEFAULT_TYPE):
-    new = sync_completed_orders()
-    if new > 0:
-        await context.bot.send_message(chat_id=CHAT_ID, text=f"🔄 Auto-sync: {new} new trades")
 
 # ========================= MAIN =========================
 if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s %(name)s %(levelname)s %(message)s", level=logging.INFO)
     init_db()
 
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    if sys.argv[1:2] == ["backfill"]:
+        sys.exit(backfill_main(sys.argv[2:]))
+    if sys.argv[1:2] == ["syncd"]:
+        sys.exit(syncd_main(sys.argv[2:]))
+
+    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_shutdown(close_clients).build()
 
-    app.add_handler(CommandHandler("start", start))
+    app.add_handler(command("start", start))
 
-    app.add_handler(CommandHandler("daily", manual_daily))
-    app.add_handler(CommandHandler("weekly", manual_weekly))
-    app.add_handler(CommandHandler("monthly", manual_monthly))
+    app.add_handler(command("daily", manual_daily))
+    app.add_handler(command("weekly", manual_weekly))
+    app.add_handler(command("monthly", manual_monthly))
 
-    app.add_handler(CommandHandler("summarydays", summary_days))
-    app.add_handler(CommandHandler("fixdb", fixdb_cmd))
-    app.add_handler(CommandHandler("debug", debug))
-    app.add_handler(CommandHandler("raw", raw))
-    app.add_handler(CommandHandler("yesterday", yesterday))
-    app.add_handler(CommandHandler("exportpdf", exportpdf))
-    app.add_handler(CommandHandler("command", show_commands))
-    app.add_handler(CommandHandler("opening", opening))
-    app.add_handler(CommandHandler("closing", closing))
-    app.add_handler(CommandHandler("startday", startday))
-    app.add_handler(CommandHandler("endday", endday))
+    app.add_handler(command("summarydays", summary_days))
+    app.add_handler(command("fixdb", fixdb_cmd))
+    app.add_handler(command("debug", debug))
+    app.add_handler(command("raw", raw))
+    app.add_handler(command("yesterday", yesterday))
+    app.add_handler(command("exportpdf", exportpdf))
+    app.add_handler(command("command", show_commands))
+    app.add_handler(command("opening", opening))
+    app.add_handler(command("closing", closing))
+    app.add_handler(command("startday", startday))
+    app.add_handler(command("endday", endday))
+    app.add_handler(command("resync", resync))
+    app.add_handler(command("syncnow", syncnow))
+    app.add_handler(command("rebuildledger", rebuildledger))
+    app.add_handler(command("workers", workers_cmd))
+    app.add_handler(command("metrics", metrics_cmd))
+    app.add_handler(command("profile", profile_cmd))
+    app.add_handler(command("slowqueries", slowqueries_cmd))
 
 
 
@@ -1347,15 +4224,25 @@ if __name__ == "__main__":
 
 
     # Addtrade system
-    app.add_handler(CommandHandler("addtrade", addtrade))
-    app.add_handler(CallbackQueryHandler(addtrade_buttons, pattern="^side_"))
+    app.add_handler(command("addtrade", addtrade))
+    app.add_handler(CallbackQueryHandler(instrumented("addtrade_buttons", addtrade_buttons), pattern="^side_"))
 
     # TEXT HANDLER MUST BE LAST
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, addtrade_text))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented("addtrade_text", addtrade_text)))
 
 
     jq = app.job_queue
-    jq.run_repeating(autosync, interval=600, first=30)  # every 10 mins
+    if SYNC_MODE == "external":
+        jq.run_repeating(instrumented("sync_events", sync_events_job, kind="job"), interval=SYNC_EVENTS_POLL, first=5)
+    else:
+        schedule_autosync(jq, 30)   # then re-armed by each run, see SyncScheduler
+    jq.run_repeating(instrumented("checkpoint", checkpoint_job, kind="job"), interval=24 * 60 * 60, first=60 * 60)  # daily inventory snapshot
+
+    if METRICS_TEXTFILE:
+        jq.run_repeating(metrics_textfile_job, interval=METRICS_INTERVAL, first=METRICS_INTERVAL)
+    if METRICS_PORT:
+        serve_prometheus(metrics, METRICS_PORT)
+        log.info("Prometheus metrics on http://127.0.0.1:%d/metrics", METRICS_PORT)
 
     print("Bot running…")
     app.run_polling()
@@ -0,0 +1,171 @@
+"""
+Equivalence check: match_arrays / iter_array_matches against FifoMatcher.
+
+Run with `python -m unittest test_fifo` (or pytest). The array checks
+are skipped without numpy.
+"""
+
+import random
+import unittest
+from collections import defaultdict
+
+from fifo import (
+    HAVE_NUMPY, FifoMatcher, Lot, iter_array_matches, load_trade_arrays, match_arrays,
+)
+
+SEEDS = range(40)
+QTY_EPS = 1e-9     # float leftovers below this are loop dust, not a lot
+NGN_DELTA = 1e-4   # per match; the README promises the cent on totals
+
+
+def random_lots(rng, n, t0):
+    return [
+        Lot(round(rng.uniform(1, 500), rng.choice((0, 2, 4, 8))),
+            round(rng.uniform(1400, 1700), 2), round(rng.uniform(0, 0.5), 4), t0 + i)
+        for i in range(n)
+    ]
+
+
+def random_trades(rng, n, t0):
+    """Rows with partial fills, fees, and sells that exceed the open inventory."""
+    rows = []
+    for i in range(n):
+        side = 0 if rng.random() < 0.55 else 1
+        qty = round(rng.uniform(0.01, 800) ** rng.choice((1, 0.5)), rng.choice((0, 2, 4, 8)))
+        if rng.random() < 0.03:
+            qty = 0.0   # parse_order used to store these when the quantity was missing
+        fee = round(qty * rng.choice((0, 0.001, 0.0025)), 8) if side == 0 else 0.0
+        rows.append((side, qty, round(rng.uniform(1400, 1700), 2), fee, t0 + i))
+    return rows
+
+
+def copy_lots(lots):
+    return [Lot(l.qty, l.price, l.fee, l.time) for l in lots]
+
+
+def loop_result(rows, lots):
+    """Per (buy_time, sell_time) sums and open lots from the reference loop."""
+    matcher = FifoMatcher(copy_lots(lots))
+    pairs = defaultdict(lambda: [0.0, 0.0, 0.0])
+    for side, qty, price, fee, ts in rows:
+        for m in matcher.feed(side, qty, price, fee, ts):
+            p = pairs[(m.buy_time, m.sell_time)]
+            p[0] += m.qty
+            p[1] += m.fee_ngn
+            p[2] += m.net_profit
+    pairs = {k: v for k, v in pairs.items() if v[0] > QTY_EPS}
+    open_lots = [(l.time, l.qty) for l in matcher.lots if l.qty > QTY_EPS]
+    return pairs, open_lots
+
+
+def array_pairs(r, ts, pairs):
+    for b, s, q, f, p in zip(r.buy.tolist(), r.sell.tolist(), r.qty.tolist(),
+                             r.fee_ngn.tolist(), r.net_profit.tolist()):
+        acc = pairs[(int(ts[b]), int(ts[s]))]
+        acc[0] += q
+        acc[1] += f
+        acc[2] += p
+
+
+def arrays_result(rows, lots):
+    side, qty, price, fee, ts = load_trade_arrays(rows, lots)
+    r = match_arrays(side, qty, price, fee)
+    pairs = defaultdict(lambda: [0.0, 0.0, 0.0])
+    array_pairs(r, ts, pairs)
+    open_lots = [(int(ts[i]), q) for i, q in zip(r.open_buys.tolist(), r.open_qty.tolist())]
+    return dict(pairs), open_lots
+
+
+def chunked_result(rows, lots, chunk):
+    pairs = defaultdict(lambda: [0.0, 0.0, 0.0])
+    open_lots = [(l.time, l.qty) for l in lots]
+    for r, (side, qty, price, fee, ts) in iter_array_matches(rows, copy_lots(lots), chunk):
+        array_pairs(r, ts, pairs)
+        open_lots = [(int(ts[i]), q) for i, q in zip(r.open_buys.tolist(), r.open_qty.tolist())]
+    return dict(pairs), open_lots
+
+
+class FifoMatcherTest(unittest.TestCase):
+
+    def test_empty_lots_are_skipped(self):
+        # A zero-quantity lot used to raise ZeroDivisionError on the next SELL
+        matcher = FifoMatcher([Lot(0.0, 1500.0, 0.1, 1)])
+        matcher.feed(0, 0.0, 1500.0, 0.0, 2)
+        self.assertEqual(matcher.feed(1, 1.0, 1600.0, 0.0, 3), [])
+        self.assertEqual(len(matcher.lots), 0)
+
+
+@unittest.skipUnless(HAVE_NUMPY, "numpy not installed")
+class MatchArraysTest(unittest.TestCase):
+
+    def assert_same(self, expected, got):
+        exp_pairs, exp_open = expected
+        got_pairs, got_open = got
+
+        self.assertEqual(sorted(exp_pairs), sorted(got_pairs))
+        for key, (q, f, p) in exp_pairs.items():
+            gq, gf, gp = got_pairs[key]
+            self.assertAlmostEqual(q, gq, delta=QTY_EPS * 10, msg=key)
+            self.assertAlmostEqual(f, gf, delta=NGN_DELTA, msg=key)
+            self.assertAlmostEqual(p, gp, delta=NGN_DELTA, msg=key)
+
+        self.assertAlmostEqual(sum(v[2] for v in exp_pairs.values()),
+                               sum(v[2] for v in got_pairs.values()), delta=0.005)
+        self.assertAlmostEqual(sum(v[1] for v in exp_pairs.values()),
+                               sum(v[1] for v in got_pairs.values()), delta=0.005)
+
+        self.assertEqual([t for t, _ in exp_open], [t for t, _ in got_open])
+        for (_, q), (_, gq) in zip(exp_open, got_open):
+            self.assertAlmostEqual(q, gq, delta=QTY_EPS * 10)
+
+    def test_random_streams(self):
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                lots = random_lots(rng, rng.randrange(0, 6), 1_000)
+                rows = random_trades(rng, rng.randrange(1, 400), 10_000)
+                self.assert_same(loop_result(rows, lots), arrays_result(rows, lots))
+
+    def test_chunked_matches_loop(self):
+        for seed in SEEDS:
+            with self.subTest(seed=seed):
+                rng = random.Random(seed)
+                lots = random_lots(rng, rng.randrange(0, 6), 1_000)
+                rows = random_trades(rng, rng.randrange(1, 400), 10_000)
+                chunk = rng.choice((1, 7, 50, 1000))
+                self.assert_same(loop_result(rows, lots), chunked_result(rows, lots, chunk))
+
+    def test_exact_partial_fills(self):
+        lots = [Lot(10.0, 1500.0, 0.5, 1)]
+        rows = [
+            (0, 5.0, 1510.0, 0.25, 2),
+            (1, 4.0, 1600.0, 0.0, 3),    # part of the seeded lot
+            (1, 8.0, 1620.0, 0.0, 4),    # rest of it, then part of the buy
+            (1, 9.0, 1650.0, 0.0, 5),    # 3 left to sell, 6 dropped
+            (0, 2.0, 1490.0, 0.01, 6),
+        ]
+        expected = loop_result(rows, lots)
+        self.assertEqual(sorted(expected[0]), [(1, 3), (1, 4), (2, 4), (2, 5)])
+        self.assertEqual(expected[1], [(6, 2.0)])
+        self.assert_same(expected, arrays_result(rows, lots))
+        self.assert_same(expected, chunked_result(rows, lots, 2))
+
+    def test_zero_quantity_lots(self):
+        lots = [Lot(0.0, 1500.0, 0.0, 1), Lot(3.0, 1500.0, 0.03, 2)]
+        rows = [
+            (0, 0.0, 1510.0, 0.0, 3),    # opens nothing
+            (1, 2.0, 1600.0, 0.0, 4),
+            (0, 0.0, 1520.0, 0.0, 5),
+            (0, 1.0, 1530.0, 0.01, 6),
+            (1, 0.0, 1600.0, 0.0, 7),    # sells nothing
+            (1, 1.5, 1610.0, 0.0, 8),
+        ]
+        expected = loop_result(rows, lots)
+        self.assertEqual(sorted(expected[0]), [(2, 4), (2, 8), (6, 8)])
+        self.assertEqual(expected[1], [(6, 0.5)])
+        self.assert_same(expected, arrays_result(rows, lots))
+        self.assert_same(expected, chunked_result(rows, lots, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()